@@ -7,6 +7,7 @@ app = Dash(__name__,
 app.title = 'Mapping Your Transit'
 
 server = app.server
+register_routes(server)
 
 create_layout(app)
 register_callbacks(app)
@@ -0,0 +1,798 @@
+import os
+import re
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import base64
+import zipfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from contextlib import contextmanager
+
+from src import feed
+from src.feed import copy_feed
+
+#benchmarks for the feed pipeline, run from the repo root with: python -m src.benchmark
+
+SAMPLE_DIR = "data/samples/gtfs_files"
+
+
+def ingest_benchmark(samples_dir: str = SAMPLE_DIR) -> pd.DataFrame:
+    """builds a database for each sample feed and reports rows/sec per table"""
+    results = []
+
+    for name in sorted(os.listdir(samples_dir)):
+        gtfs_path = os.path.join(samples_dir, name)
+        if not os.path.isdir(gtfs_path):
+            continue
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            try:
+                gtfs_feed = feed.Feed(copy_feed(gtfs_path, work_dir))
+            except FileNotFoundError as error:
+                #some samples are missing required files (eg no stop_times.txt)
+                print(f"skipping {name}: {error}")
+                continue
+
+            for table_name, stats in gtfs_feed.ingest_stats.items():
+                seconds = stats['seconds']
+                results.append({
+                    'feed': name,
+                    'table': table_name,
+                    'rows': stats['rows'],
+                    'seconds': round(seconds, 4),
+                    'rows_per_sec': round(stats['rows'] / seconds) if seconds and stats['rows'] else None
+                })
+            gtfs_feed.close()
+
+    return pd.DataFrame(results)
+
+
+def synthetic_feed(work_dir: str, n_stop_times: int, seed: int = 0) -> str:
+    """writes a synthetic.generate_feed folder with about n_stop_times rows in stop_times.txt to
+    work_dir/gtfs_files/gtfs_synthetic (with a databases folder next to it) and returns it"""
+    from src import synthetic
+
+    os.makedirs(os.path.join(work_dir, "databases"), exist_ok=True)
+    return synthetic.generate_feed(os.path.join(work_dir, "gtfs_files", "gtfs_synthetic"), seed=seed,
+                                   **synthetic.feed_parameters(n_stop_times))
+
+
+def peak_rss_mb() -> int:
+    """peak resident memory of this process in MB"""
+    #VmHWM starts over when a process is exec'd, ru_maxrss carries over from the parent
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) // 1024
+    #ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+
+def _ingest_peak_rss(gtfs_path: str, chunksize: int) -> int:
+    """builds the feed database in this process and returns its peak rss in MB"""
+    feed.Feed(gtfs_path, chunksize=chunksize).close()
+    return peak_rss_mb()
+
+
+def memory_benchmark(n_stop_times: int = 10_500_000, chunksizes: tuple = (50_000, 200_000, 1_000_000)) -> pd.DataFrame:
+    """peak rss of building the database for a synthetic feed at different chunk sizes.
+    each build runs in a fresh process so the peaks don't carry over"""
+    results = []
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        gtfs_path = synthetic_feed(work_dir, n_stop_times)
+        db_path = os.path.join(work_dir, "databases", "gtfs_synthetic.db")
+
+        for chunksize in chunksizes:
+            if os.path.exists(db_path):
+                os.remove(db_path)
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+                peak = pool.submit(_ingest_peak_rss, gtfs_path, chunksize).result()
+            results.append({'stop_times_rows': n_stop_times, 'chunksize': chunksize, 'peak_rss_mb': peak})
+
+    return pd.DataFrame(results)
+
+
+def departure_info_loop(gtfs_feed) -> dict:
+    """the original per stop groupby loop version of Feed.departure_info, kept as the benchmark baseline"""
+    times = gtfs_feed.stop_times()
+    times['departure_time'] = pd.to_timedelta(times['departure_time'])
+
+    dept_info = {}
+    for stop_id, group in times.groupby(['stop_id']):
+        times = group['departure_time'].sort_values()
+        if len(times) < 2:
+            freq = "Infrequent"
+        else:
+            avg_freq = times.diff().dropna().mean()
+            freq = f"Every {int(avg_freq.total_seconds() // 60)} minutes"
+        first = str(times.min()).split(" ")[-1][:-3]
+        last = str(times.max()).split(" ")[-1][:-3]
+        dept_info[str(stop_id[0])] = f"{len(times)} daily departures: {freq} from {first} to {last}"
+    return dept_info
+
+
+def departure_benchmark(samples_dir: str = SAMPLE_DIR, feeds: tuple = ('gtfs_nyc', 'gtfs_wata', 'gtfs_slo', 'gtfs_charlottesville'),
+                        repeat: int = 3) -> pd.DataFrame:
+    """times the old loop and the vectorized departure_info (best of repeat) and checks they agree.
+    the loop counts every service so it is compared with departure_info('all')"""
+    results = []
+
+    for name in feeds:
+        with tempfile.TemporaryDirectory() as work_dir:
+            try:
+                gtfs_feed = feed.Feed(copy_feed(os.path.join(samples_dir, name), work_dir))
+            except FileNotFoundError as error:
+                print(f"skipping {name}: {error}")
+                continue
+
+            timings = {}
+            for label, run in [('loop', lambda: departure_info_loop(gtfs_feed)),
+                               ('vectorized', lambda: {stop: text for stop, text in gtfs_feed.departure_info('all').items()})]:
+                best = None
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    output = run()
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                timings[label] = (best, output)
+
+            results.append({
+                'feed': name,
+                'stops': len(timings['vectorized'][1]),
+                'loop_seconds': round(timings['loop'][0], 4),
+                'vectorized_seconds': round(timings['vectorized'][0], 4),
+                'speedup': round(timings['loop'][0] / timings['vectorized'][0], 1),
+                'matches': timings['loop'][1] == timings['vectorized'][1]
+            })
+            gtfs_feed.close()
+
+    return pd.DataFrame(results)
+
+
+def trips_shapes_routes_tuples(gtfs_feed) -> pd.DataFrame:
+    """the original trips_shapes_routes (every trip merged with its line, duplicates found with 
+    tuples of coordinates), kept as the benchmark baseline"""
+    sql = """SELECT trips.*, routes.route_long_name, routes.route_short_name,
+                CASE WHEN LOWER(routes.route_color) = 'ffffff' THEN '000000' ELSE routes.route_color END AS route_color
+            FROM trips JOIN routes USING (route_id)
+            WHERE shape_id IS NOT NULL AND routes.route_color IS NOT NULL;"""
+    trips_routes = pd.read_sql(sql, gtfs_feed.conn)
+    shapes = gtfs_feed.shape_pts().to_frame().reset_index()
+    merged = trips_routes.merge(shapes, on='shape_id', how='inner')
+
+    def normalize_linestring(ls):
+        coords = list(ls.coords)
+        return tuple(coords if coords[0] <= coords[-1] else coords[::-1])
+
+    merged['normalized'] = merged['shape_points'].apply(normalize_linestring)
+    return merged.drop_duplicates(subset=['route_id', 'normalized']).drop(columns='normalized')
+
+
+def _time_and_peak(run) -> tuple:
+    """seconds and peak traced python/numpy memory in MB of one call"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    output = run()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    tracemalloc.stop()
+    return elapsed, peak, output
+
+
+def dedup_benchmark(samples_dir: str = SAMPLE_DIR, feeds: tuple = ('gtfs_wata', 'gtfs_slo', 'gtfs_charlottesville'),
+                    n_stop_times: int = 1_000_000) -> pd.DataFrame:
+    """time and peak memory of trips_shapes_routes against the tuple version on the samples
+    and a synthetic feed with many trips on each shape"""
+    results = []
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        paths = [copy_feed(os.path.join(samples_dir, name), work_dir) for name in feeds]
+        paths.append(synthetic_feed(work_dir, n_stop_times))
+
+        for gtfs_path in paths:
+            gtfs_feed = feed.Feed(gtfs_path)
+            old_seconds, old_peak, old = _time_and_peak(lambda: trips_shapes_routes_tuples(gtfs_feed))
+            new_seconds, new_peak, new = _time_and_peak(gtfs_feed.trips_shapes_routes)
+            results.append({
+                'feed': gtfs_feed.name,
+                'trips': gtfs_feed.conn.execute("SELECT COUNT(*) FROM trips;").fetchone()[0],
+                'rows': len(new),
+                'tuple_seconds': round(old_seconds, 4),
+                'digest_seconds': round(new_seconds, 4),
+                'tuple_peak_mb': round(old_peak, 2),
+                'digest_peak_mb': round(new_peak, 2),
+                'same_rows': len(old) == len(new)
+            })
+            gtfs_feed.close()
+
+    return pd.DataFrame(results)
+
+
+@contextmanager
+def poster_workdir():
+    """runs the body in a scratch directory with the poster output folders and fonts, so
+    benchmark posters don't overwrite the ones in data/outputs"""
+    repo_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.makedirs(os.path.join(work_dir, "data", "outputs", "posters", "user_uploaded"))
+        os.symlink(os.path.join(repo_dir, "fonts"), os.path.join(work_dir, "fonts"))
+        os.chdir(work_dir)
+        try:
+            yield work_dir
+        finally:
+            os.chdir(repo_dir)
+
+
+def lod_benchmark(samples_dir: str = SAMPLE_DIR, feeds: tuple = ('gtfs_nyc', 'gtfs_wata', 'gtfs_slo', 'gtfs_charlottesville'),
+                  dpi: int = 200) -> pd.DataFrame:
+    """map html size, map render time and poster render time with full and simplified route lines"""
+    from src import interactive_maps, posters
+
+    results = []
+    samples_dir = os.path.abspath(samples_dir)
+
+    with poster_workdir() as work_dir:
+        for name in feeds:
+            try:
+                gtfs_feed = feed.Feed(copy_feed(os.path.join(samples_dir, name), work_dir))
+            except FileNotFoundError as error:
+                print(f"skipping {name}: {error}")
+                continue
+
+            row = {'feed': name}
+            for label, simplify in [('full', False), ('lod', True)]:
+                start = time.perf_counter()
+                map_html = interactive_maps.live_map(gtfs_feed, simplify=simplify).get_root().render()
+                row[f'{label}_map_seconds'] = round(time.perf_counter() - start, 3)
+                row[f'{label}_html_kb'] = round(len(map_html.encode()) / 1024)
+
+                start = time.perf_counter()
+                posters.map(gtfs_feed, Heatmap=False, dpi=dpi, simplify=simplify)
+                posters.plt.close('all')
+                row[f'{label}_poster_seconds'] = round(time.perf_counter() - start, 3)
+
+            row['html_reduction'] = f"{1 - row['lod_html_kb'] / row['full_html_kb']:.0%}"
+            results.append(row)
+            gtfs_feed.close()
+
+    return pd.DataFrame(results)
+
+
+#node script that compiles every inline <script> of a map page and prints the seconds it took,
+#used as a stand in for the browser's script parse time
+PARSE_JS = """
+const fs = require('fs');
+const vm = require('vm');
+const html = fs.readFileSync(process.argv[1], 'utf8');
+const scripts = [...html.matchAll(/<script>([\\s\\S]*?)<\\/script>/g)].map(match => match[1]);
+const start = process.hrtime.bigint();
+for (const source of scripts) { new vm.Script(source); }
+console.log(Number(process.hrtime.bigint() - start) / 1e9);
+"""
+
+
+def script_parse_seconds(html: str, work_dir: str) -> float:
+    """time for node to parse the inline scripts of a map page, None if node isn't installed"""
+    node = shutil.which('node')
+    if node is None:
+        return None
+    html_path = os.path.join(work_dir, "map.html")
+    with open(html_path, 'w') as html_file:
+        html_file.write(html)
+    output = subprocess.run([node, '-e', PARSE_JS, html_path], capture_output=True, text=True, check=True)
+    return round(float(output.stdout), 4)
+
+
+def batched_map_benchmark(samples_dir: str = SAMPLE_DIR, feeds: tuple = ('gtfs_nyc', 'gtfs_wata', 'gtfs_slo', 'gtfs_charlottesville')) -> pd.DataFrame:
+    """map html size, render time, number of leaflet objects and script parse time with one folium
+    object per stop and route compared to one GeoJSON layer for each"""
+    from src import interactive_maps
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name in feeds:
+            try:
+                gtfs_feed = feed.Feed(copy_feed(os.path.join(samples_dir, name), work_dir))
+            except FileNotFoundError as error:
+                print(f"skipping {name}: {error}")
+                continue
+
+            row = {'feed': name}
+            for label, batched in [('per_object', False), ('batched', True)]:
+                start = time.perf_counter()
+                map_html = interactive_maps.live_map(gtfs_feed, batched=batched).get_root().render()
+                row[f'{label}_map_seconds'] = round(time.perf_counter() - start, 3)
+                row[f'{label}_html_kb'] = round(len(map_html.encode()) / 1024)
+                row[f'{label}_layers'] = len(re.findall(r'L\.(?:circleMarker|polyline|geoJson)\(', map_html))
+                row[f'{label}_parse_seconds'] = script_parse_seconds(map_html, work_dir)
+
+            results.append(row)
+            gtfs_feed.close()
+
+    return pd.DataFrame(results)
+
+
+def render_cache_benchmark(samples_dir: str = SAMPLE_DIR, feeds: tuple = ('gtfs_wata', 'gtfs_slo', 'gtfs_charlottesville'),
+                           repeats: int = 5) -> pd.DataFrame:
+    """cold (rendered) and warm (read from disk) latency of the map html and heatmap render cache"""
+    from src import interactive_maps, heatmap
+    from src.cache import RenderCache
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        render_cache = RenderCache(os.path.join(work_dir, "render_cache"), 64 * 1024 * 1024)
+        for name in feeds:
+            try:
+                gtfs_feed = feed.Feed(copy_feed(os.path.join(samples_dir, name), work_dir))
+            except FileNotFoundError as error:
+                print(f"skipping {name}: {error}")
+                continue
+
+            map_key = render_cache.key(gtfs_feed.gtfs_path(), 'tiled')
+            heatmap_key = render_cache.key(gtfs_feed.gtfs_path())
+            for _ in range(repeats + 1):
+                render_cache.get(f'{name}_map', map_key,
+                                 lambda: interactive_maps.live_map(gtfs_feed, tiled=True).get_root().render())
+                render_cache.get(f'{name}_heatmap', heatmap_key, lambda: heatmap.heatmap(gtfs_feed).to_json())
+            gtfs_feed.close()
+
+            stats = render_cache.stats()
+            for kind in ('map', 'heatmap'):
+                cold = stats[f'{name}_{kind}_cold_mean_ms']
+                warm = stats[f'{name}_{kind}_warm_mean_ms']
+                results.append({'feed': name, 'output': kind, 'cold_ms': cold, 'warm_ms': warm,
+                                'speedup': round(cold / warm, 1)})
+
+    return pd.DataFrame(results)
+
+
+def image_rms(path_a: str, path_b: str) -> float:
+    """root mean square difference of two images on a 0-255 scale (inf if the sizes differ)"""
+    import matplotlib.image as mpimg
+
+    image_a, image_b = mpimg.imread(path_a), mpimg.imread(path_b)
+    if image_a.shape != image_b.shape:
+        return float('inf')
+    return float(np.sqrt(np.mean((image_a.astype(np.float64) - image_b) ** 2)) * 255)
+
+
+def poster_draw_benchmark(samples_dir: str = SAMPLE_DIR, feeds: tuple = ('gtfs_nyc', 'gtfs_wata', 'gtfs_slo', 'gtfs_charlottesville'),
+                          dpi: int = 500, max_rms: float = 1.0) -> pd.DataFrame:
+    """poster render time with one artist per route and stop compared to one LineCollection and
+    one scatter, and the pixel difference between the two posters (should be under max_rms)"""
+    from src import posters
+
+    results = []
+    samples_dir = os.path.abspath(samples_dir)
+
+    with poster_workdir() as work_dir:
+        for name in feeds:
+            try:
+                gtfs_feed = feed.Feed(copy_feed(os.path.join(samples_dir, name), work_dir))
+            except FileNotFoundError as error:
+                print(f"skipping {name}: {error}")
+                continue
+
+            row = {'feed': name}
+            images = {}
+            for label, vectorized in [('per_artist', False), ('vectorized', True)]:
+                start = time.perf_counter()
+                poster_file = posters.map(gtfs_feed, Heatmap=False, dpi=dpi, vectorized=vectorized)
+                posters.plt.close('all')
+                row[f'{label}_seconds'] = round(time.perf_counter() - start, 3)
+                images[label] = os.path.join(work_dir, f"{name}_{label}.png")
+                os.replace(poster_file, images[label])
+
+            row['image_rms'] = round(image_rms(images['per_artist'], images['vectorized']), 4)
+            row['same_image'] = row['image_rms'] <= max_rms
+            results.append(row)
+            gtfs_feed.close()
+
+    return pd.DataFrame(results)
+
+
+def _poster_peak_rss(gtfs_path: str, poster_file: str, dpi: int, file_format: str, strip_rows: int) -> tuple:
+    """renders one poster in this process, returns (seconds, peak rss in MB before saving, peak rss in MB)"""
+    import matplotlib.pyplot as plt
+    from src import posters
+
+    gtfs_feed = feed.Feed(gtfs_path)
+    #everything up to savefig, so the difference is what saving the poster costs
+    posters.map(gtfs_feed, Heatmap=True, dpi=dpi, output_file=os.devnull, file_format='svg')
+    plt.close('all')
+    before = peak_rss_mb()
+
+    start = time.perf_counter()
+    posters.map(gtfs_feed, Heatmap=True, dpi=dpi, output_file=poster_file, file_format=file_format, strip_rows=strip_rows)
+    seconds = time.perf_counter() - start
+    return seconds, before, peak_rss_mb()
+
+
+def poster_output_benchmark(samples_dir: str = SAMPLE_DIR, name: str = 'gtfs_wata', dpis: tuple = (150, 300, 500)) -> pd.DataFrame:
+    """peak rss, time and file size of saving a poster as one raster png, as a png drawn in strips
+    (one savefig below raster.STRIP_MIN_PIXELS), and as svg and pdf at each dpi. each mode runs in a
+    fresh process so the peaks don't carry over"""
+    from src.raster import DEFAULT_STRIP_ROWS
+
+    modes = [('png', 'png', None), ('png_strips', 'png', DEFAULT_STRIP_ROWS), ('svg', 'svg', None), ('pdf', 'pdf', None)]
+    results = []
+    samples_dir = os.path.abspath(samples_dir)
+
+    with poster_workdir() as work_dir:
+        gtfs_path = copy_feed(os.path.join(samples_dir, name), work_dir)
+        #database is built once up front so every mode starts from the same place
+        feed.Feed(gtfs_path).close()
+
+        for dpi in dpis:
+            files = {}
+            for mode, file_format, strip_rows in modes:
+                files[mode] = os.path.join(work_dir, f"{name}_{mode}_{dpi}.{file_format}")
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+                    seconds, before, peak = pool.submit(_poster_peak_rss, gtfs_path, files[mode], dpi,
+                                                        file_format, strip_rows).result()
+                results.append({'feed': name, 'mode': mode, 'dpi': dpi, 'seconds': round(seconds, 2),
+                                'peak_rss_mb': peak, 'save_rss_mb': peak - before,
+                                'file_kb': round(os.path.getsize(files[mode]) / 1024)})
+
+            rms = image_rms(files['png'], files['png_strips'])
+            print(f"png strips vs one raster at {dpi} dpi: rms difference {rms:.3f} (0-255)")
+
+    return pd.DataFrame(results)
+
+
+def edit_feed(gtfs_path: str, fraction: float = 0.01, seed: int = 0) -> None:
+    """a small weekly style change: moves the times of a fraction of stop_times rows by a minute,
+    drops as many rows and renames a few stops"""
+    rng = np.random.default_rng(seed)
+
+    stop_times = pd.read_csv(os.path.join(gtfs_path, "stop_times.txt"), dtype=str)
+    n = max(1, int(len(stop_times) * fraction))
+    moved = rng.choice(len(stop_times), n, replace=False)
+    secs = feed.gtfs_time_seconds(stop_times.loc[moved, 'departure_time']) + 60
+    stop_times.loc[moved, 'departure_time'] = [
+        f"{int(sec) // 3600:02d}:{int(sec) // 60 % 60:02d}:{int(sec) % 60:02d}" if sec == sec else None for sec in secs
+    ]
+    stop_times = stop_times.drop(index=stop_times.index[rng.choice(len(stop_times), n, replace=False)])
+    stop_times.to_csv(os.path.join(gtfs_path, "stop_times.txt"), index=False)
+
+    stops = pd.read_csv(os.path.join(gtfs_path, "stops.txt"), dtype=str)
+    stops.loc[:2, 'stop_name'] = stops.loc[:2, 'stop_name'] + ' (renamed)'
+    stops.to_csv(os.path.join(gtfs_path, "stops.txt"), index=False)
+    return None
+
+
+def update_benchmark(samples_dir: str = SAMPLE_DIR, feeds: tuple = ('gtfs_wata', 'gtfs_slo', 'gtfs_charlottesville'),
+                     n_stop_times: int = 1_000_000, fraction: float = 0.01) -> pd.DataFrame:
+    """time to apply a 1% change to stop_times (and a few renamed stops) as an incremental update
+    compared to building the database again from scratch"""
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        gtfs_paths = [os.path.join(samples_dir, name) for name in feeds]
+        gtfs_paths.append(synthetic_feed(os.path.join(work_dir, "synthetic"), n_stop_times))
+
+        for source_path in gtfs_paths:
+            try:
+                gtfs_path = copy_feed(source_path, work_dir)
+                feed.Feed(gtfs_path).close()
+            except FileNotFoundError as error:
+                print(f"skipping {os.path.basename(source_path)}: {error}")
+                continue
+            edit_feed(gtfs_path, fraction)
+
+            start = time.perf_counter()
+            gtfs_feed = feed.Feed(gtfs_path)
+            update_seconds = time.perf_counter() - start
+            changes = gtfs_feed.update_stats.get('stop_times', {})
+            gtfs_feed.close()
+
+            os.remove(gtfs_feed.db_path)
+            start = time.perf_counter()
+            feed.Feed(gtfs_path).close()
+            rebuild_seconds = time.perf_counter() - start
+
+            results.append({'feed': os.path.basename(gtfs_path),
+                            'stop_times_updated': changes.get('updated'),
+                            'stop_times_deleted': changes.get('deleted'),
+                            'update_seconds': round(update_seconds, 3),
+                            'rebuild_seconds': round(rebuild_seconds, 3),
+                            'speedup': round(rebuild_seconds / update_seconds, 1)})
+
+    return pd.DataFrame(results)
+
+
+def service_day_benchmark(samples_dir: str = SAMPLE_DIR, feeds: tuple = ('gtfs_wata', 'gtfs_slo', 'gtfs_charlottesville'),
+                          days: tuple = ('weekday', 'saturday', 'sunday', 'all')) -> pd.DataFrame:
+    """departures counted for each day type against every service pooled, and the time to get a day's
+    departure info and route frequencies the first time and when switching back to it"""
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name in feeds:
+            gtfs_feed = feed.Feed(copy_feed(os.path.join(samples_dir, name), work_dir))
+            for day in days:
+                start = time.perf_counter()
+                departures = gtfs_feed.departure_info(day).stats['departures'].sum()
+                trips = gtfs_feed.route_freq(day).to_numpy().sum()
+                first_seconds = time.perf_counter() - start
+
+                start = time.perf_counter()
+                gtfs_feed.departure_info(day)
+                gtfs_feed.route_freq(day)
+                cached_seconds = time.perf_counter() - start
+
+                services = gtfs_feed.service_day(day)
+                results.append({'feed': name, 'day': day,
+                                'services': 'all' if services is None else len(services),
+                                'departures': int(departures),
+                                'route_stop_times_8_to_20': int(trips),
+                                'first_ms': round(first_seconds * 1000, 2),
+                                'cached_ms': round(cached_seconds * 1000, 2)})
+            gtfs_feed.close()
+
+    return pd.DataFrame(results)
+
+
+def base64_upload(contents: str, filename: str, upload_dir: str) -> list:
+    """the old upload handling: decodes the whole dcc.Upload data url in memory, saves the zip
+    and extracts every member, returns the extracted files"""
+    content_string = contents.split(',')[1]
+    decoded = base64.b64decode(content_string)
+    zip_path = os.path.join(upload_dir, filename)
+    with open(zip_path, 'wb') as zip_file:
+        zip_file.write(decoded)
+    with zipfile.ZipFile(zip_path) as zip_file:
+        zip_file.extractall(os.path.join(upload_dir, "extracted"))
+        return zip_file.namelist()
+
+
+def upload_benchmark(samples_dir: str = SAMPLE_DIR, feeds: tuple = ('gtfs_wata', 'gtfs_slo', 'gtfs_charlottesville'),
+                     n_stop_times: int = 1_000_000) -> pd.DataFrame:
+    """time and peak python memory of receiving a zipped feed (with an unused file in it) the old
+    way, from a base64 data url, against streaming it from a file through uploads.py (database build not included)"""
+    from src import uploads
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        gtfs_paths = [os.path.join(samples_dir, name) for name in feeds]
+        gtfs_paths.append(synthetic_feed(os.path.join(work_dir, "synthetic"), n_stop_times))
+
+        for gtfs_path in gtfs_paths:
+            name = os.path.basename(gtfs_path)
+            zip_path = os.path.join(work_dir, f"{name}.zip")
+            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                for file_name in os.listdir(gtfs_path):
+                    zip_file.write(os.path.join(gtfs_path, file_name), file_name)
+                zip_file.writestr("unused_padding.txt", "padding\n" * 1_000_000)
+
+            old_dir = os.path.join(work_dir, "old", name)
+            os.makedirs(old_dir)
+            with open(zip_path, 'rb') as zip_file:
+                contents = "data:application/zip;base64," + base64.b64encode(zip_file.read()).decode()
+            old_seconds, old_peak, old_files = _time_and_peak(lambda: base64_upload(contents, f"{name}.zip", old_dir))
+            #the data url itself was also held in memory by the callback
+            old_peak += len(contents) / 1024 ** 2
+            del contents
+
+            def stream_upload():
+                new_zip = os.path.join(work_dir, "new", f"{name}.zip")
+                with open(zip_path, 'rb') as stream:
+                    uploads.save_upload(stream, new_zip, 2 ** 40)
+                members = uploads.validate_zip(new_zip, 2 ** 40)
+                return uploads.extract_feed_files(new_zip, os.path.join(work_dir, "new", name), members)
+            new_seconds, new_peak, new_files = _time_and_peak(stream_upload)
+
+            results.append({'feed': name,
+                            'zip_mb': round(os.path.getsize(zip_path) / 1024 ** 2, 1),
+                            'base64_seconds': round(old_seconds, 3),
+                            'stream_seconds': round(new_seconds, 3),
+                            'base64_peak_mb': round(old_peak, 1),
+                            'stream_peak_mb': round(new_peak, 1),
+                            'base64_files': len(old_files),
+                            'stream_files': len(new_files)})
+
+    return pd.DataFrame(results)
+
+
+def metrics_benchmark(samples_dir: str = SAMPLE_DIR, feeds: tuple = ('gtfs_wata', 'gtfs_slo'), calls: int = 2000) -> pd.DataFrame:
+    """cost of the @metrics.timed spans on the cheapest timed calls (cached departure info and route
+    frequencies), with and without the wrapper, and the time to render /metrics afterwards"""
+    from src import metrics
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name in feeds:
+            gtfs_feed = feed.Feed(copy_feed(os.path.join(samples_dir, name), work_dir))
+            for method in ('departure_info', 'route_freq'):
+                timed_call = getattr(gtfs_feed, method)
+                bare_call = getattr(feed.Feed, method).__wrapped__
+                timed_call()
+
+                start = time.perf_counter()
+                for _ in range(calls):
+                    bare_call(gtfs_feed)
+                bare_seconds = time.perf_counter() - start
+
+                start = time.perf_counter()
+                for _ in range(calls):
+                    timed_call()
+                timed_seconds = time.perf_counter() - start
+
+                results.append({'feed': name, 'stage': method,
+                                'bare_us': round(bare_seconds / calls * 1e6, 2),
+                                'timed_us': round(timed_seconds / calls * 1e6, 2),
+                                'overhead_us': round((timed_seconds - bare_seconds) / calls * 1e6, 2)})
+            gtfs_feed.close()
+
+    start = time.perf_counter()
+    exposition = metrics.registry.render()
+    results.append({'feed': '', 'stage': f"render /metrics ({len(exposition.splitlines())} lines)",
+                    'timed_us': round((time.perf_counter() - start) * 1e6, 2)})
+    return pd.DataFrame(results)
+
+
+def gtfs_time_seconds_regex(times: pd.Series) -> pd.Series:
+    """the original regular expression version of feed.gtfs_time_seconds, kept as the benchmark baseline"""
+    parts = times.astype(str).str.extract(r'^\s*(\d+):(\d{2}):(\d{2})').astype(float)
+    return parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+def time_parse_benchmark(n_times: int = 1_000_000, repeat: int = 3, seed: int = 0) -> pd.DataFrame:
+    """rows per second of parsing GTFS times with pd.to_timedelta (what departure_info used to do on
+    every call), the regular expression parser and the byte parser used at ingest, on times from 5am
+    to 1am (past 24:00:00) with some H:MM:SS and blank ones mixed in"""
+    from src import synthetic
+
+    rng = np.random.default_rng(seed)
+    times = pd.Series(synthetic.format_times(rng.integers(5 * 3600, 25 * 3600, n_times)), dtype=object)
+    short = rng.random(n_times) < 0.1
+    times[short & (times.str[0] == '0')] = times[short & (times.str[0] == '0')].str[1:]
+    times[rng.random(n_times) < 0.02] = np.nan
+    expected = gtfs_time_seconds_regex(times)
+
+    def timedelta_seconds(times):
+        return pd.to_timedelta(times, errors='coerce').dt.total_seconds()
+
+    results = []
+    for label, parse in [('to_timedelta', timedelta_seconds), ('regex', gtfs_time_seconds_regex),
+                         ('bytes', feed.gtfs_time_seconds)]:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            parsed = parse(times)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append({'parser': label, 'rows': n_times, 'seconds': round(best, 4),
+                        'rows_per_sec': round(n_times / best),
+                        'matches_regex': bool(np.allclose(parsed, expected, equal_nan=True))})
+
+    return pd.DataFrame(results)
+
+
+def columnar_benchmark(n_stop_times: int = 1_000_000, seed: int = 0,
+                       selections: tuple = (('stop_times', None), ('stop_times', ['trip_id', 'stop_id']),
+                                            ('trips', None), ('shapes', None), ('stops', ['stop_id', 'stop_lat', 'stop_lon']))) -> pd.DataFrame:
+    """milliseconds to get a table (or a few of its columns) on a synthetic feed that was built
+    earlier: parsing the csv like the accessors did before, against memory mapping the table's
+    columnar copy. the feed is reopened for each read so nothing is cached between them"""
+    from src import columnar
+
+    if not columnar.available():
+        print("skipping columnar benchmark: pyarrow isn't installed")
+        return pd.DataFrame()
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        gtfs_path = synthetic_feed(work_dir, n_stop_times, seed)
+        gtfs_feed = feed.Feed(gtfs_path)
+        gtfs_feed.close()
+
+        for table_name, columns in selections:
+            file_path = os.path.join(gtfs_path, f"{table_name}.txt")
+
+            start = time.perf_counter()
+            from_csv = pd.read_csv(file_path)
+            if columns is not None:
+                from_csv = from_csv[columns]
+            csv_seconds = time.perf_counter() - start
+
+            gtfs_feed = feed.Feed(gtfs_path)
+            start = time.perf_counter()
+            from_arrow = columnar.to_pandas(gtfs_feed.arrow_table(table_name, columns))
+            arrow_seconds = time.perf_counter() - start
+            gtfs_feed.close()
+
+            shared = [column for column in from_csv.columns if column in from_arrow.columns]
+            results.append({
+                'table': table_name,
+                'columns': ', '.join(columns) if columns else 'all',
+                'rows': len(from_arrow),
+                'csv_ms': round(csv_seconds * 1000, 1),
+                'arrow_ms': round(arrow_seconds * 1000, 1),
+                'speedup': round(csv_seconds / arrow_seconds, 1) if arrow_seconds else None,
+                'same_values': all(from_csv[column].astype(str).equals(from_arrow[column].astype(str)) for column in shared)
+            })
+
+    return pd.DataFrame(results)
+
+
+def stop_times_store_benchmark(n_stop_times: int = 1_000_000, seed: int = 0) -> pd.DataFrame:
+    """memory and seconds of stop_times as a dataframe read from the csv against its memory mapped
+    arrays (see stop_times_store.py) on a synthetic feed, and of building the per stop and per route
+    derived tables from the database against from the arrays"""
+    from src import my_sql
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        gtfs_path = synthetic_feed(work_dir, n_stop_times, seed)
+        gtfs_feed = feed.Feed(gtfs_path)
+
+        start = time.perf_counter()
+        times = pd.read_csv(os.path.join(gtfs_path, "stop_times.txt"))
+        csv_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        arrays = gtfs_feed.stop_times_arrays()
+        arrays_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        sql_stats = gtfs_feed._sql_departure_stats()
+        sql_stats_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        array_stats = gtfs_feed._array_departure_stats(arrays)
+        array_stats_seconds = time.perf_counter() - start
+
+        #both builders write into the open transaction, which is rolled back
+        start = time.perf_counter()
+        gtfs_feed.cursor.execute(my_sql.delete_rows_sql.format(table='route_hour_trips'))
+        gtfs_feed.cursor.execute(my_sql.route_hour_trips_sql)
+        sql_route_seconds = time.perf_counter() - start
+        sql_routes = pd.read_sql("SELECT * FROM route_hour_trips ORDER BY route_id, service_id, hour;", gtfs_feed.conn)
+        start = time.perf_counter()
+        gtfs_feed._build_route_hour_trips()
+        array_route_seconds = time.perf_counter() - start
+        array_routes = pd.read_sql("SELECT * FROM route_hour_trips ORDER BY route_id, service_id, hour;", gtfs_feed.conn)
+        gtfs_feed.conn.rollback()
+
+        #text columns as python strings (pandas before 3.0) and as pandas' own string dtype
+        results = [
+            {'measure': 'stop_times MB (object strings)',
+             'dataframe': times.astype(object).memory_usage(deep=True).sum() / 1024 ** 2,
+             'arrays': arrays.nbytes / 1024 ** 2, 'same': len(times) == len(arrays)},
+            {'measure': f'stop_times MB (pandas {pd.__version__} strings)', 'dataframe': times.memory_usage(deep=True).sum() / 1024 ** 2,
+             'arrays': arrays.nbytes / 1024 ** 2, 'same': len(times) == len(arrays)},
+            {'measure': 'open seconds', 'dataframe': csv_seconds, 'arrays': arrays_seconds, 'same': None},
+            {'measure': 'stop_departures seconds', 'dataframe': sql_stats_seconds, 'arrays': array_stats_seconds,
+             'same': sql_stats.astype(float).equals(array_stats.sort_index().astype(float))},
+            {'measure': 'route_hour_trips seconds', 'dataframe': sql_route_seconds, 'arrays': array_route_seconds,
+             'same': sql_routes.equals(array_routes)}
+        ]
+        gtfs_feed.close()
+
+    results = pd.DataFrame(results)
+    results['ratio'] = (results['dataframe'] / results['arrays']).round(1)
+    results[['dataframe', 'arrays']] = results[['dataframe', 'arrays']].round(4)
+    return results
+
+
+if __name__ == '__main__':
+    print(ingest_benchmark().to_string(index=False))
+    print(memory_benchmark().to_string(index=False))
+    print(departure_benchmark().to_string(index=False))
+    print(dedup_benchmark().to_string(index=False))
+    print(lod_benchmark().to_string(index=False))
+    print(batched_map_benchmark().to_string(index=False))
+    print(render_cache_benchmark().to_string(index=False))
+    print(poster_draw_benchmark().to_string(index=False))
+    print(poster_output_benchmark().to_string(index=False))
+    print(update_benchmark().to_string(index=False))
+    print(upload_benchmark().to_string(index=False))
+    print(service_day_benchmark().to_string(index=False))
+    print(metrics_benchmark().to_string(index=False))
+    print(time_parse_benchmark().to_string(index=False))
+    print(columnar_benchmark().to_string(index=False))
+    print(stop_times_store_benchmark().to_string(index=False))
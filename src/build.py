@@ -0,0 +1,151 @@
+import os
+import sys
+import time
+import shutil
+import zipfile
+import argparse
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+from src import feed
+from src import jobs
+
+#prebuilds the databases, maps, heatmaps and posters for a folder of feeds so the app starts warm,
+#run from the repo root with:
+#   python -m src.build [folder of gtfs folders or zips] [--workers N] [--dpi DPI] [--formats png pdf] [--no-posters]
+#zips are extracted next to themselves, anything built from the same feed files before is skipped.
+#folders without all of feed.REQUIRED_FILES are listed as skipped and don't fail the build
+
+DEFAULT_FEEDS_DIR = "data/samples/gtfs_files"
+
+
+def extract_zip(zip_path: str) -> str:
+    """extracts a zipped feed into a folder named after the zip (unless it was extracted already
+    since the zip last changed) and returns the folder"""
+    gtfs_path = os.path.splitext(zip_path)[0]
+    if os.path.isdir(gtfs_path) and os.path.getmtime(gtfs_path) >= os.path.getmtime(zip_path):
+        return gtfs_path
+
+    shutil.rmtree(gtfs_path, ignore_errors=True)
+    with zipfile.ZipFile(zip_path) as zip_file:
+        zip_file.extractall(gtfs_path)
+
+    #zips of a folder have the files one level down
+    contents = os.listdir(gtfs_path)
+    if len(contents) == 1 and os.path.isdir(os.path.join(gtfs_path, contents[0])):
+        inner = os.path.join(gtfs_path, contents[0])
+        for name in os.listdir(inner):
+            shutil.move(os.path.join(inner, name), gtfs_path)
+        os.rmdir(inner)
+    return gtfs_path
+
+
+def find_feeds(feeds_dir: str) -> list:
+    """every folder in feeds_dir, with any zips extracted first (incomplete ones are skipped by build_all)"""
+    for name in sorted(os.listdir(feeds_dir)):
+        if name.endswith('.zip'):
+            extract_zip(os.path.join(feeds_dir, name))
+
+    return [os.path.join(feeds_dir, name) for name in sorted(os.listdir(feeds_dir))
+            if os.path.isdir(os.path.join(feeds_dir, name)) and not name.startswith('.')]
+
+
+def build_feed(gtfs_path: str, dpi: int, formats: tuple, posters: bool) -> dict:
+    """builds everything for one feed (runs in a worker process), returns seconds per step and
+    which steps were built or already up to date"""
+    from src import interactive_maps, heatmap
+    from src.cache import render_cache
+
+    row = {'feed': os.path.basename(gtfs_path), 'built': [], 'error': ''}
+    start = time.perf_counter()
+    try:
+        #database and derived tables, built or brought up to date with changed files when opened
+        step = time.perf_counter()
+        gtfs_feed = feed.Feed(gtfs_path)
+        if gtfs_feed.ingest_stats:
+            row['built'].append('database')
+        elif gtfs_feed.update_stats:
+            row['built'].append(f"database update ({', '.join(gtfs_feed.update_stats)})")
+        row['database_s'] = round(time.perf_counter() - step, 2)
+
+        #map html and heatmap go through the app's render cache
+        step = time.perf_counter()
+        map_key = render_cache.key(gtfs_path, 'tiled', os.path.normpath(gtfs_path))
+        if not render_cache.contains('map', map_key):
+            row['built'].append('map')
+        interactive_maps.cached_map_html(gtfs_path)
+        if not render_cache.contains('heatmap', heatmap.heatmap_key(gtfs_feed)):
+            row['built'].append('heatmap')
+        heatmap.cached_heatmap(gtfs_feed)
+        gtfs_feed.close()
+        row['maps_s'] = round(time.perf_counter() - step, 2)
+
+        #posters with and without the frequency heatmap, into the poster jobs' cache
+        step = time.perf_counter()
+        if posters:
+            for with_heatmap in (True, False):
+                for file_format in formats:
+                    job_id = jobs.poster_job_id(gtfs_path, with_heatmap, dpi, file_format)
+                    poster_file = jobs.poster_cache_file(job_id)
+                    if not os.path.exists(poster_file):
+                        jobs.render_poster(gtfs_path, with_heatmap, dpi, file_format, poster_file)
+                        row['built'].append(os.path.basename(poster_file).split('_', 1)[1])
+        row['posters_s'] = round(time.perf_counter() - step, 2)
+
+    except Exception as error:
+        row['error'] = f"{type(error).__name__}: {error}"
+
+    row['total_s'] = round(time.perf_counter() - start, 2)
+    row['built'] = ', '.join(row['built']) or ('' if row['error'] else 'up to date')
+    return row
+
+
+def build_all(feeds_dir: str = DEFAULT_FEEDS_DIR, workers: int = None, dpi: int = jobs.POSTER_DPI,
+              formats: tuple = ('png',), posters: bool = True) -> pd.DataFrame:
+    """builds every feed in feeds_dir across a pool of worker processes, one feed per worker at a time.
+    feeds missing required files are skipped"""
+    gtfs_paths = []
+    results = []
+    for gtfs_path in find_feeds(feeds_dir):
+        missing = feed.missing_files(gtfs_path)
+        if missing:
+            results.append({'feed': os.path.basename(gtfs_path), 'built': '', 'error': '',
+                            'skipped': f"missing {', '.join(missing)}"})
+        else:
+            gtfs_paths.append(gtfs_path)
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+        futures = [pool.submit(build_feed, gtfs_path, dpi, tuple(formats), posters) for gtfs_path in gtfs_paths]
+        for future in as_completed(futures):
+            results.append({**future.result(), 'skipped': ''})
+
+    columns = ['feed', 'database_s', 'maps_s', 'posters_s', 'total_s', 'built', 'skipped', 'error']
+    return pd.DataFrame(results, columns=columns).sort_values('feed', ignore_index=True)
+
+
+def main(argv: list = None) -> int:
+    """command line entry point, returns 1 if any feed failed (skipped feeds don't count)"""
+    parser = argparse.ArgumentParser(description="prebuild databases, maps and posters for a folder of GTFS feeds")
+    parser.add_argument('feeds_dir', nargs='?', default=DEFAULT_FEEDS_DIR,
+                        help="folder of gtfs folders and/or zips")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: one per cpu)")
+    parser.add_argument('--dpi', type=int, default=jobs.POSTER_DPI, help="poster resolution")
+    parser.add_argument('--formats', nargs='+', default=['png'], choices=['png', 'svg', 'pdf'],
+                        help="poster file types to build")
+    parser.add_argument('--no-posters', action='store_true', help="only build databases, maps and heatmaps")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    results = build_all(args.feeds_dir, args.workers, args.dpi, args.formats, not args.no_posters)
+
+    with pd.option_context('display.max_colwidth', 80, 'display.width', 250):
+        print(results.to_string(index=False))
+    skipped = (results['skipped'] != '').sum()
+    print(f"\n{len(results) - skipped} feeds built, {skipped} skipped in {time.perf_counter() - start:.1f}s")
+
+    return 1 if (results['error'] != '').any() else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
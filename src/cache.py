@@ -0,0 +1,282 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import pandas as pd
+
+from src import metrics
+
+
+#memory budget for parsed GTFS tables, shared by every feed in the process
+#(can be changed with the GTFS_TABLE_CACHE_MB environment variable)
+DEFAULT_TABLE_CACHE_MB = 256
+
+#disk budget for rendered maps and heatmaps (GTFS_RENDER_CACHE_MB environment variable)
+DEFAULT_RENDER_CACHE_MB = 128
+RENDER_CACHE_DIR = "data/render_cache"
+
+#part of every render cache key (and poster job id), bump it when the map, heatmap or poster output changes
+RENDER_VERSION = 2
+
+#bytes read at a time when hashing feed files
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class TableCache:
+    """Least recently used cache of parsed GTFS tables shared across all feeds. Tables are keyed on
+    their file path and remembered along with the file's modification time, so a file that changes on
+    disk is read again. Once the cached tables go over max_bytes the least recently used are dropped"""
+    def __init__(
+    self,
+    max_bytes: int
+    ):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+
+        #counters for checking how well the cache is doing
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        #file path -> (mtime, size in bytes, dataframe), oldest first
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, file_path: str, loader) -> pd.DataFrame:
+        """returns the cached table for file_path, calling loader() to parse it on a miss"""
+        mtime = os.stat(file_path).st_mtime_ns
+
+        with self._lock:
+            entry = self._tables.get(file_path)
+            if entry is not None and entry[0] == mtime:
+                self._tables.move_to_end(file_path)
+                self.hits += 1
+                return entry[2].copy(deep=False)
+            self.misses += 1
+
+        data = loader()
+        size = int(data.memory_usage(deep=True).sum())
+
+        with self._lock:
+            #file changed on disk (or another thread loaded it first)
+            self._remove(file_path)
+
+            #tables bigger than the whole budget are never kept
+            if size <= self.max_bytes:
+                self._tables[file_path] = (mtime, size, data)
+                self.current_bytes += size
+                self._evict()
+
+        #callers get a shallow copy so adding columns doesn't change the cached table
+        return data.copy(deep=False)
+
+    def _remove(self, file_path: str) -> None:
+        """drops one entry, lock must be held"""
+        entry = self._tables.pop(file_path, None)
+        if entry is not None:
+            self.current_bytes -= entry[1]
+
+    def _evict(self) -> None:
+        """drops least recently used tables until under budget, lock must be held"""
+        while self.current_bytes > self.max_bytes and self._tables:
+            _, (_, size, _) = self._tables.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
+
+    def invalidate(self, prefix: str = "") -> None:
+        """drops every table whose path starts with prefix (everything by default)"""
+        with self._lock:
+            for file_path in [path for path in self._tables if path.startswith(prefix)]:
+                self._remove(file_path)
+
+    def stats(self) -> dict:
+        """hit/miss counters and current size of the cache"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'tables': len(self._tables),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes
+            }
+
+
+#file path -> (size and mtime, digest of its contents)
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+def file_hash(file_path: str) -> str:
+    """blake2b hex digest of one file's contents, remembered until its size or modification time
+    changes ('' for a file that doesn't exist)"""
+    if not os.path.isfile(file_path):
+        return ''
+    file_stat = os.stat(file_path)
+    signature = (file_stat.st_size, file_stat.st_mtime_ns)
+
+    with _file_hashes_lock:
+        entry = _file_hashes.get(file_path)
+    if entry is not None and entry[0] == signature:
+        return entry[1]
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as feed_file:
+        while block := feed_file.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+
+    with _file_hashes_lock:
+        _file_hashes[file_path] = (signature, digest.hexdigest())
+    return digest.hexdigest()
+
+
+#gtfs folder -> (name, size and mtime of each file, digest of their contents)
+_feed_hashes = {}
+_feed_hashes_lock = threading.Lock()
+
+
+def feed_hash(gtfs_path: str) -> str:
+    """blake2b hex digest of the names and contents of every file in a GTFS folder. the digest is
+    remembered per folder until a file's size or modification time changes, so the files are only
+    read again after they are replaced (an upload of the same feed gets the same digest)"""
+    names = sorted(os.listdir(gtfs_path))
+    file_stats = []
+    for name in names:
+        file_stat = os.stat(os.path.join(gtfs_path, name))
+        file_stats.append((name, file_stat.st_size, file_stat.st_mtime_ns))
+    file_stats = tuple(file_stats)
+
+    with _feed_hashes_lock:
+        entry = _feed_hashes.get(gtfs_path)
+    if entry is not None and entry[0] == file_stats:
+        return entry[1]
+
+    digest = hashlib.blake2b(digest_size=16)
+    for name in names:
+        file_path = os.path.join(gtfs_path, name)
+        if not os.path.isfile(file_path):
+            continue
+        digest.update(name.encode() + b'\0')
+        with open(file_path, 'rb') as feed_file:
+            while block := feed_file.read(HASH_BLOCK_SIZE):
+                digest.update(block)
+        digest.update(b'\0')
+
+    with _feed_hashes_lock:
+        _feed_hashes[gtfs_path] = (file_stats, digest.hexdigest())
+    return digest.hexdigest()
+
+
+class RenderCache:
+    """Disk cache of rendered output (map html, heatmap figure json) keyed on the content hash of the
+    feed it was made from. Entries are files in cache_dir, a hit updates the file's modification time
+    and once the folder goes over max_bytes the least recently used files are deleted. Render time on
+    a miss (cold) and read time on a hit (warm) are recorded for each kind of output"""
+    def __init__(
+    self,
+    cache_dir: str,
+    max_bytes: int
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        #kind -> {'cold'/'warm': [count, total seconds, max seconds]}
+        self.latency = {}
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def key(self, gtfs_path: str, *parts) -> str:
+        """cache key for output made from the feed in gtfs_path with the given settings"""
+        extra = '|'.join(str(part) for part in (RENDER_VERSION,) + parts)
+        return f"{feed_hash(gtfs_path)}-{hashlib.blake2b(extra.encode(), digest_size=8).hexdigest()}"
+
+    def contains(self, kind: str, key: str) -> bool:
+        """whether there is an entry for kind and key"""
+        return os.path.exists(os.path.join(self.cache_dir, f"{kind}-{key}"))
+
+    def get(self, kind: str, key: str, render) -> str:
+        """returns the cached text for kind and key, calling render() to make it on a miss"""
+        start = time.perf_counter()
+        entry_path = os.path.join(self.cache_dir, f"{kind}-{key}")
+
+        try:
+            with open(entry_path, encoding='utf-8') as entry_file:
+                text = entry_file.read()
+            os.utime(entry_path)
+            self._record(kind, 'warm', time.perf_counter() - start)
+            return text
+        except FileNotFoundError:
+            pass
+
+        text = render()
+
+        #written to a temporary name first so other workers never read half an entry
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as entry_file:
+            entry_file.write(text)
+        os.replace(temp_path, entry_path)
+        self._evict()
+
+        self._record(kind, 'cold', time.perf_counter() - start)
+        return text
+
+    def _record(self, kind: str, temperature: str, seconds: float) -> None:
+        """adds one request to the latency counters"""
+        with self._lock:
+            counter = self.latency.setdefault(kind, {}).setdefault(temperature, [0, 0.0, 0.0])
+            counter[0] += 1
+            counter[1] += seconds
+            counter[2] = max(counter[2], seconds)
+
+    def _evict(self) -> None:
+        """deletes least recently used entries until the folder is under budget"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.tmp'):
+                continue
+            try:
+                entry_stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((entry_stat.st_mtime_ns, entry_stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                with self._lock:
+                    self.evictions += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def invalidate(self) -> None:
+        """deletes every entry"""
+        if os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                os.remove(os.path.join(self.cache_dir, name))
+
+    def stats(self) -> dict:
+        """hit/miss counts and cold/warm latency in milliseconds for each kind of output"""
+        with self._lock:
+            stats = {'evictions': self.evictions, 'max_bytes': self.max_bytes}
+            for kind, temperatures in self.latency.items():
+                for temperature, (count, total, longest) in temperatures.items():
+                    stats[f'{kind}_{temperature}_count'] = count
+                    stats[f'{kind}_{temperature}_mean_ms'] = round(total / count * 1000, 2)
+                    stats[f'{kind}_{temperature}_max_ms'] = round(longest * 1000, 2)
+            return stats
+
+
+#one cache for the whole process
+table_cache = TableCache(int(os.environ.get("GTFS_TABLE_CACHE_MB", DEFAULT_TABLE_CACHE_MB)) * 1024 * 1024)
+
+#rendered output shared by every worker through the disk
+render_cache = RenderCache(RENDER_CACHE_DIR, int(os.environ.get("GTFS_RENDER_CACHE_MB", DEFAULT_RENDER_CACHE_MB)) * 1024 * 1024)
+
+metrics.registry.add_collector('table_cache', table_cache.stats)
+metrics.registry.add_collector('render_cache', render_cache.stats)
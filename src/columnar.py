@@ -0,0 +1,221 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+#pyarrow is a dependency, but installs without it still work: feeds don't get a columnar copy
+#and the table accessors read the csv files, which is logged once here
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+    logger.warning("pyarrow isn't installed, feed tables are read from their csv files instead of "
+                   "memory mapped columnar copies")
+
+#columnar copies of a feed's tables, written next to its database as
+#   data/*/databases/<feed>.columns/<table>.arrow
+#one uncompressed Arrow IPC file per table so it can be memory mapped: opening a table and picking
+#a few columns reads only those columns' pages instead of parsing the whole csv. text columns are
+#dictionary encoded, integer and float columns keep their sqlite types. each file records the hash
+#of the gtfs file its table was loaded from and is rewritten when that changes
+
+
+def available() -> bool:
+    """whether pyarrow is installed"""
+    return pa is not None
+
+
+def sidecar_dir(db_path: str) -> str:
+    """folder of a database's columnar tables"""
+    return f"{os.path.splitext(db_path)[0]}.columns"
+
+
+def table_path(db_path: str, table_name: str) -> str:
+    """arrow file of one table of a database"""
+    return os.path.join(sidecar_dir(db_path), f"{table_name}.arrow")
+
+
+def arrow_type(declared: str):
+    """arrow type for a column's declared sqlite type, following sqlite's affinity rules
+    (DATE columns hold YYYYMMDD numbers)"""
+    declared = declared.upper()
+    if 'INT' in declared or declared in ('DATE', 'NUMERIC'):
+        return pa.int64()
+    if any(name in declared for name in ('REAL', 'FLOA', 'DOUB')):
+        return pa.float64()
+    return pa.dictionary(pa.int32(), pa.string())
+
+
+def stored_hash(path: str) -> str:
+    """file hash recorded in an arrow table, None if it doesn't exist or can't be read"""
+    if pa is None or not os.path.exists(path):
+        return None
+    try:
+        with pa.memory_map(path, 'r') as source:
+            metadata = pa.ipc.open_file(source).schema.metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return None
+    value = metadata.get(b'file_hash')
+    return value.decode() if value is not None else None
+
+
+def extend_dictionary(index: pd.Index, values: pd.Series) -> tuple:
+    """int32 codes of values in a dictionary of the values seen so far (-1 for blanks), adding values
+    not seen before to its end. returns the dictionary and the codes"""
+    #each distinct value of the block is looked up once
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Index(uniques.astype(str), dtype=object)
+    positions = index.get_indexer(uniques)
+    unseen = positions < 0
+    if unseen.any():
+        positions[unseen] = np.arange(len(index), len(index) + unseen.sum())
+        index = index.append(uniques[unseen])
+    codes = np.where(codes < 0, -1, positions[codes] if len(positions) else -1).astype(np.int32)
+    return index, codes
+
+
+class TableWriter:
+    """Writes the rows of one table to an arrow file a block at a time as they are read from its csv,
+    and moves it into place when closed. columns maps the table's columns to their declared sqlite
+    types, the file gets the ones the csv has. text columns are dictionary encoded with the dictionary
+    growing as new values turn up (written as deltas). a block that doesn't fit its column types
+    (e.g. text in an integer column) drops the file, the table is then read from the csv"""
+    def __init__(
+    self,
+    path: str,
+    columns: dict,
+    file_hash: str
+    ):
+        self.path = path
+        self.columns = columns
+        self.file_hash = file_hash
+        self.rows = 0
+        self.failed = False
+        self._temp_path = f"{path}.{os.getpid()}.tmp"
+        self._sink = None
+        self._writer = None
+        self._schema = None
+        #text column -> (values seen so far in dictionary order, the same as an arrow array)
+        self._dictionaries = {}
+
+    def _open(self, chunk: pd.DataFrame) -> None:
+        """starts the file with the columns of the first block"""
+        self._schema = pa.schema(
+            [pa.field(name, arrow_type(declared)) for name, declared in self.columns.items() if name in chunk.columns],
+            metadata={'file_hash': self.file_hash or ''})
+        #dictionaries start with '' as arrow only takes additions to a non-empty dictionary as deltas
+        #(a column that's blank for the whole first block would otherwise fail on the next)
+        self._dictionaries = {field.name: (pd.Index([''], dtype=object), pa.array([''], type=pa.string()))
+                              for field in self._schema if pa.types.is_dictionary(field.type)}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._sink = pa.OSFile(self._temp_path, 'wb')
+        self._writer = pa.ipc.new_file(self._sink, self._schema,
+                                       options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+        return None
+
+    def _encode(self, name: str, values: pd.Series):
+        """dictionary array of a text column, adding values not seen before to the end of its dictionary"""
+        index, dictionary = self._dictionaries[name]
+        grown, codes = extend_dictionary(index, values)
+        if len(grown) > len(index):
+            dictionary = pa.array(grown.to_numpy(), type=pa.string())
+            self._dictionaries[name] = (grown, dictionary)
+        return pa.DictionaryArray.from_arrays(pa.array(codes, type=pa.int32(), mask=codes < 0), dictionary)
+
+    def write(self, chunk: pd.DataFrame) -> None:
+        """appends a block of rows read from the table's csv"""
+        if self.failed:
+            return None
+        try:
+            if self._writer is None:
+                self._open(chunk)
+            arrays = []
+            for field in self._schema:
+                if field.name in self._dictionaries:
+                    arrays.append(self._encode(field.name, chunk[field.name]))
+                else:
+                    values = chunk[field.name]
+                    if values.dtype == object:
+                        values = pd.to_numeric(values)
+                    arrays.append(pa.array(values, type=field.type, from_pandas=True))
+            self._writer.write_batch(pa.record_batch(arrays, schema=self._schema))
+            self.rows += len(chunk)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError):
+            self.abort()
+            self.failed = True
+            self.rows = 0
+        return None
+
+    def close(self) -> None:
+        """finishes the file and replaces the old one in one step"""
+        if self._writer is not None and not self.failed:
+            self._writer.close()
+            self._sink.close()
+            os.replace(self._temp_path, self.path)
+            self._writer = None
+        return None
+
+    def abort(self) -> None:
+        """drops the unfinished file"""
+        if self._writer is not None:
+            self._sink.close()
+            self._writer = None
+        if os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class NullWriter:
+    """Stands in for a TableWriter when there is no columnar copy to write"""
+    rows = 0
+
+    def write(self, chunk: pd.DataFrame) -> None:
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+def read_table(path: str, columns: list = None, file_hash: str = None):
+    """memory maps an arrow table (its buffers stay on disk until used) and returns the columns asked
+    for as a pyarrow Table, None if there is no file or it was written from a different file_hash"""
+    if pa is None or not os.path.exists(path):
+        return None
+    try:
+        source = pa.memory_map(path, 'r')
+        reader = pa.ipc.open_file(source)
+    except (OSError, pa.ArrowInvalid):
+        return None
+
+    metadata = reader.schema.metadata or {}
+    if file_hash is not None and metadata.get(b'file_hash', b'').decode() != file_hash:
+        return None
+    table = reader.read_all()
+    if columns is not None:
+        table = table.select([name for name in columns if name in table.column_names])
+    return table
+
+
+def to_pandas(table) -> pd.DataFrame:
+    """dataframe of an arrow table with dictionary columns turned back into plain strings, like the
+    csv reader gives (each distinct string is only made once)"""
+    df = table.to_pandas()
+    for name in df.columns:
+        if isinstance(df[name].dtype, pd.CategoricalDtype):
+            df[name] = df[name].astype(object)
+    return df
@@ -1,19 +1,80 @@
 import pandas as pd
 import matplotlib.pyplot as plt
 import os
+import json
+import time
+import datetime
+import hashlib
+import shutil
+import logging
+import atexit
+import threading
+from collections import Counter, OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
 from typing import Type
 from src import my_sql
+from src import metrics
+from src import columnar
+from src import stop_times_store
+from src.cache import table_cache, feed_hash, file_hash
 import sqlite3
+import numpy as np
+import shapely
 from shapely.geometry import LineString
 
 
+#rows per chunk when streaming GTFS text files into the database
+DEFAULT_CHUNKSIZE = 100_000
+
+#tolerances (in degrees) of the simplified shape geometries stored for each feed, finest first
+#(changing these needs my_sql.AGGREGATES_VERSION bumped so databases rebuild them)
+LOD_TOLERANCES = (0.00002, 0.00008, 0.0003, 0.001)
+
+#files a feed folder must have
+REQUIRED_FILES = [
+    "agency.txt",
+    "stops.txt",
+    "routes.txt",
+    "shapes.txt",
+    "trips.txt",
+    "stop_times.txt"
+]
+
+#every GTFS file the app reads (the required ones and those with a Feed method), others are ignored
+FEED_FILES = REQUIRED_FILES + ["calendar.txt", "calendar_dates.txt", "transfers.txt"]
+
+#calendar.txt's day columns, in numpy/python weekday order (monday is 0)
+WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+#day types frequency stats can be asked for, as weekday numbers. 'all' pools every service
+DAY_TYPES = {
+    'weekday': (0, 1, 2, 3, 4),
+    'saturday': (5,),
+    'sunday': (6,),
+    **{name: (number,) for number, name in enumerate(WEEKDAYS)}
+}
+DEFAULT_SERVICE_DAY = 'weekday'
+
+#most dates stored in service_days, counted from the calendar's first date (some feeds run their
+#last service period to 2099)
+MAX_SERVICE_DAYS = 3660
+
+#most feeds kept open at once by the feed registry
+#(can be changed with the GTFS_FEED_REGISTRY_SIZE environment variable)
+DEFAULT_REGISTRY_SIZE = 8
+
+logger = logging.getLogger(__name__)
+
 #creating a class for reading in the feed data
 
 class Feed:
     """This class holds the data for each GTFS feed uploaded/selected. It creates a database for the feed and includes methods for accessing each table, pre-processing geospatial data, and creating map features"""
+    @metrics.timed('feed_open')
     def __init__(
     self,
-    gtfs_path: str
+    gtfs_path: str,
+    chunksize: int = DEFAULT_CHUNKSIZE
     ):
         #defining file paths
         self._gtfs_path = gtfs_path
@@ -21,17 +82,65 @@ class Feed:
         self.parent_dir = os.path.dirname(os.path.dirname(gtfs_path))
         self.db_path = os.path.join(self.parent_dir, "databases", f"{self.name}.db")
 
+        #rows read from each text file at a time when building the database (bounds memory use)
+        self.chunksize = chunksize
+
          # Check for required files
         self._validate_required_files()
 
-        #connecting to database
-        self.conn = sqlite3.connect(self.db_path)
+        #connecting to database (the connection can be shared between dash's threads, 
+        #writes after the database is built should hold self.lock)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
         self.cursor = self.conn.cursor()
+        self.lock = threading.RLock()
+
+        #rows and seconds per table, filled in when the database is built
+        self.ingest_stats = {}
+        #rows inserted, updated and deleted per table, filled in when the database is updated
+        self.update_stats = {}
+
+        #frequency stats per (kind, services running) and the stored service calendar, read when first needed
+        self._day_cache = {}
+        self._service_calendar = None
 
         #creating database if it doesn't exist
-        if not self._database_exists():
+        built = not self._database_exists()
+        if built:
             self._create_tables()
             self._insert_data()
+        else:
+            #databases made before an index was added get it now (no-op when they all exist)
+            self._create_indexes()
+            #and the parsed time columns
+            self._add_seconds_columns()
+            #databases made before feed_meta existed get an empty one to record hashes in
+            with self.lock, self.conn:
+                self.cursor.execute(my_sql.feed_meta_sql)
+            #and feed tables that weren't loaded back then (e.g. calendar) are loaded
+            self._load_added_tables()
+
+            #files replaced since the database was built (e.g. a newer upload of the same feed)
+            #are applied as row changes. databases from before the hashes were recorded have
+            #every table compared with its file, so rows loaded by older versions (e.g. ids
+            #read as numbers and stored as '10.0') are brought in line with the files too
+            if self.source_hash() != feed_hash(self._gtfs_path):
+                self.update()
+
+        #stop_times' arrays are written as it is loaded, databases from before them get them here
+        #so the derived tables below can be built from them
+        self._write_stop_times_arrays()
+
+        #derived tables are built once and rebuilt if missing or made by an older version
+        if self._aggregates_version() != my_sql.AGGREGATES_VERSION:
+            self._build_aggregates()
+
+        #remembering which version of the files the database was built from
+        if built:
+            self._record_file_hashes()
+
+        #columnar copies of the tables for the accessors (if pyarrow is installed), rewritten
+        #for tables whose file changed
+        self._write_columns()
 
     #file overviews
     def gtfs_path(self):
@@ -45,63 +154,50 @@ class Feed:
     def _validate_required_files(self):
 
         """Checks if all required files are present in gtfs folder and raises an error if not"""
-        REQUIRED_FILES = [
-        "agency.txt",
-        "stops.txt",
-        "routes.txt",
-        "shapes.txt",
-        "trips.txt",
-        "stop_times.txt"
-        ]
-        missing_files = []
-        for filename in REQUIRED_FILES:
-            if filename not in self.get_files():
-                missing_files.append(filename)
-        if missing_files:
+        missing = missing_files(self._gtfs_path)
+        if missing:
             raise FileNotFoundError(
-                f"Missing required GTFS files in {self._gtfs_path}: {', '.join(missing_files)}"
+                f"Missing required GTFS files in {self._gtfs_path}: {', '.join(missing)}"
             )
         return None
     
     #methods to access each file
     
     #essential files present in MOST GTFS 
-    def stops(self):
-        return extract_file('stops.txt', self)
+    def stops(self, columns: list = None):
+        return extract_file('stops.txt', self, columns)
     
-    def routes(self):
-        return extract_file('routes.txt', self)
+    def routes(self, columns: list = None):
+        return extract_file('routes.txt', self, columns)
     
-    def trips(self):
-        return extract_file('trips.txt', self)
+    def trips(self, columns: list = None):
+        return extract_file('trips.txt', self, columns)
     
-    def agency(self):
-        return extract_file('agency.txt', self)
+    def agency(self, columns: list = None):
+        return extract_file('agency.txt', self, columns)
 
-    def calendar_dates(self):
-        return extract_file('calendar_dates.txt', self)
+    def calendar_dates(self, columns: list = None):
+        return extract_file('calendar_dates.txt', self, columns)
 
-    def stop_times(self):
-        return extract_file('stop_times.txt', self)
+    def stop_times(self, columns: list = None):
+        return extract_file('stop_times.txt', self, columns)
 
     #cond. required
-    def calendar(self):
-        return extract_file('calendar.txt', self)
+    def calendar(self, columns: list = None):
+        return extract_file('calendar.txt', self, columns)
     
    #cond. required
-    def shapes(self):
-        return extract_file('shapes.txt', self)
+    def shapes(self, columns: list = None):
+        return extract_file('shapes.txt', self, columns)
     
     #not required
-    def transfers(self):
-        return extract_file('transfers.txt', self)
+    def transfers(self, columns: list = None):
+        return extract_file('transfers.txt', self, columns)
     
     #Building the database
     def _database_exists(self) -> bool:
         """Checks if the example essential table 'agency' exists  """
-        self.cursor.execute("""
-            SELECT name FROM sqlite_master WHERE type='table' AND name='agency';
-        """)
+        self.cursor.execute(my_sql.table_exists_sql, ('agency',))
         return bool(self.cursor.fetchone())
 
 
@@ -113,37 +209,467 @@ class Feed:
         self.conn.commit()
         return None
     
+    def _create_indexes(self):
+        """builds the secondary indexes in my_sql.py"""
+        with self.lock, self.conn:
+            for statement in my_sql.build_indexes:
+                self.cursor.execute(statement)
+        return None
+
     def _get_table_columns(self, table_name: str)-> list:
         """Gets the columns of a table so that the dfs uploaded can be filtered (avoids errors)"""
-        self.cursor.execute(f"PRAGMA table_info({table_name})")
+        self.cursor.execute(my_sql.table_info_sql.format(table=table_name))
         return [row[1] for row in self.cursor.fetchall()]  
 
+    def _get_table_dtypes(self, table_name: str) -> dict:
+        """pandas dtypes for reading a table's columns from csv. numeric columns are read as 
+        floats so blanks become NaN (sqlite stores whole numbers back as integers), everything else as strings.
+        iter_file converts the numeric ones itself so a stray text value doesn't stop the load"""
+        self.cursor.execute(my_sql.table_info_sql.format(table=table_name))
+        return {
+            row[1]: 'float64' if row[2].upper() in ('INTEGER', 'INT', 'FLOAT') else str
+            for row in self.cursor.fetchall()
+        }
 
-    def insert_dataframe(self, df: pd.DataFrame, table_name: str):
-        """inserts data from a pandas dataframe for each table to the database"""
+    def _insert_rows(self, df: pd.DataFrame, table_name: str) -> int:
+        """inserts a dataframe with executemany without committing, returns number of rows"""
         #removes columns that don't go in the final database (optional columns, non-standard columns)
-        filtered_df = df[[col for col in df.columns if col in self._get_table_columns(table_name)]]
-        columns = filtered_df.columns.tolist()
+        table_columns = self._get_table_columns(table_name)
+        columns = [col for col in df.columns if col in table_columns]
         placeholders = ', '.join(['?'] * len(columns))
-        insert_sql = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})"
+        insert_sql = my_sql.insert_rows_sql.format(table=table_name, columns=', '.join(columns), placeholders=placeholders)
+
+        #building python values column by column (NaN -> None) instead of row by row
+        values = [
+            df[col].astype(object).where(df[col].notna(), None).tolist()
+            for col in columns
+        ]
+        self.cursor.executemany(insert_sql, zip(*values))
 
-        #insert data
-        for _, row in filtered_df.iterrows():
-            values = [None if pd.isna(val) else val for val in row]
-            self.cursor.execute(insert_sql, values)
+        return len(df)
 
-        self.conn.commit()
+    def insert_dataframe(self, df: pd.DataFrame, table_name: str) -> int:
+        """inserts data from a pandas dataframe for each table to the database in one batch, returns number of rows"""
+        #insert data as a single transaction
+        with self.conn:
+            rows = self._insert_rows(add_seconds_columns(df, table_name), table_name)
+        return rows
+
+    def insert_file(self, file: str, table_name: str) -> int:
+        """streams a GTFS text file into its table chunk by chunk so the whole file never has 
+        to be in memory, returns number of rows"""
+        #one transaction for the whole table
+        with self.conn:
+            rows = self._load_file(file, table_name)
+        return rows
+
+    @metrics.timed('load_table', rows=lambda rows: rows)
+    def _load_file(self, file: str, table_name: str, into: str = None) -> int:
+        """streams a GTFS text file, read with table_name's columns and types, into the table
+        into (table_name by default) without committing, returns number of rows"""
+        rows = 0
+        #the table's columnar copy (and stop_times' arrays) are written from the same chunks
+        with self._columns_writer(table_name) as columns, self._arrays_writer(table_name) as arrays:
+            for chunk in iter_file(file, self, dtype=self._get_table_dtypes(table_name),
+                                   usecols=self._get_table_columns(table_name)):
+                chunk = add_seconds_columns(chunk, table_name)
+                rows += self._insert_rows(chunk, into or table_name)
+                columns.write(chunk)
+                arrays.write(chunk)
+        return rows
+
+    def _columns_writer(self, table_name: str):
+        """columnar.TableWriter for a feed table's columnar copy (see columnar.py), a columnar.NullWriter
+        if pyarrow isn't installed or the table has no file"""
+        file_path = os.path.join(self._gtfs_path, f'{table_name}.txt')
+        if not columnar.available() or table_name not in my_sql.feed_tables or not os.path.isfile(file_path):
+            return columnar.NullWriter()
+        self.cursor.execute(my_sql.table_info_sql.format(table=table_name))
+        declared = {row[1]: row[2] for row in self.cursor.fetchall()}
+        return columnar.TableWriter(columnar.table_path(self.db_path, table_name), declared, file_hash(file_path))
+
+    def _arrays_writer(self, table_name: str):
+        """stop_times_store.StopTimesWriter for stop_times, a columnar.NullWriter for other tables"""
+        file_path = os.path.join(self._gtfs_path, 'stop_times.txt')
+        if table_name != 'stop_times' or not os.path.isfile(file_path):
+            return columnar.NullWriter()
+        return stop_times_store.StopTimesWriter(stop_times_store.store_dir(self.db_path), file_hash(file_path))
+
+    def _write_stop_times_arrays(self) -> None:
+        """writes stop_times' arrays (see stop_times_store.py) if they are missing or were made from a
+        different version of the file, e.g. databases built before the arrays existed"""
+        file_path = os.path.join(self._gtfs_path, 'stop_times.txt')
+        meta = stop_times_store.read_meta(stop_times_store.store_dir(self.db_path))
+        if 'stop_times.txt' not in self.get_files() or (meta is not None and meta['file_hash'] == file_hash(file_path)):
+            return None
+
+        start = time.perf_counter()
+        with self.lock, self._arrays_writer('stop_times') as arrays:
+            for chunk in iter_file('stop_times.txt', self, dtype=self._get_table_dtypes('stop_times'),
+                                   usecols=stop_times_store.COLUMNS):
+                arrays.write(add_seconds_columns(chunk, 'stop_times'))
+        if arrays.rows:
+            self.ingest_stats['arrays'] = {'rows': arrays.rows, 'seconds': time.perf_counter() - start}
+        return None
+
+    def stop_times_arrays(self) -> 'stop_times_store.StopTimesArrays':
+        """stop_times as memory mapped numpy arrays with trip and stop offsets (see stop_times_store.py),
+        None if the arrays don't match the current stop_times.txt or it couldn't be stored that way"""
+        return stop_times_store.read_store(stop_times_store.store_dir(self.db_path),
+                                           file_hash(os.path.join(self._gtfs_path, 'stop_times.txt')))
+
+    def _add_seconds_columns(self) -> None:
+        """adds the my_sql.seconds_columns that databases built before them are missing and fills
+        them from the stored times, a block of rows at a time"""
+        for table_name, columns in my_sql.seconds_columns.items():
+            missing = {text: secs for text, secs in columns.items()
+                       if secs not in self._get_table_columns(table_name)}
+            if not missing:
+                continue
+
+            with self.lock, self.conn:
+                for secs in missing.values():
+                    self.cursor.execute(my_sql.add_column_sql.format(table=table_name, column=secs))
+                sql = my_sql.select_rowid_columns_sql.format(table=table_name, columns=', '.join(missing))
+                for chunk in pd.read_sql(sql, self.conn, chunksize=self.chunksize):
+                    values = [gtfs_time_seconds(chunk[text]).astype(object).where(lambda secs: secs.notna(), None)
+                              for text in missing]
+                    assignments = ', '.join(f"{secs} = ?" for secs in missing.values())
+                    self.cursor.executemany(my_sql.update_rowid_sql.format(table=table_name, assignments=assignments),
+                                            zip(*values, chunk['rowid'].tolist()))
         return None
 
     def _insert_data(self):
-        """inserts data into database for all ESSENTIAL files"""
-        self.insert_dataframe(self.agency(), 'agency')
-        self.insert_dataframe(self.stops(), 'stops')
-        self.insert_dataframe(self.shapes(), 'shapes')
-        self.insert_dataframe(self.routes(), 'routes')
-        self.insert_dataframe(self.trips(), 'trips')
-        self.insert_dataframe(self.stop_times(), 'stop_times')
+        """inserts data into database for all ESSENTIAL files, recording rows and seconds per table in ingest_stats"""
+        tables = my_sql.feed_tables
+
+        for pragma in my_sql.load_pragmas:
+            self.cursor.execute(pragma)
+
+        for table_name in tables:
+            start = time.perf_counter()
+            rows = self.insert_file(f'{table_name}.txt', table_name)
+            self.ingest_stats[table_name] = {'rows': rows, 'seconds': time.perf_counter() - start}
+
+        #indexes are built once all the data is in
+        start = time.perf_counter()
+        self._create_indexes()
+        self.ingest_stats['indexes'] = {'rows': 0, 'seconds': time.perf_counter() - start}
+
+        for pragma in my_sql.restore_pragmas:
+            self.cursor.execute(pragma)
+
+        return None
+
+    def _aggregates_version(self) -> int:
+        """version of the derived tables stored in the database, None if they haven't been built"""
+        exists = self.conn.execute(my_sql.table_exists_sql, ('feed_meta',)).fetchone()
+        if not exists:
+            return None
+        version = self._meta('aggregates_version')
+        return int(version) if version else None
+
+    def _record_file_hashes(self) -> None:
+        """stores the hash of every feed table's file and of the whole feed folder in feed_meta"""
+        with self.lock, self.conn:
+            for table_name in my_sql.feed_tables:
+                self.cursor.execute(my_sql.set_feed_meta_sql,
+                                    (f'file_hash:{table_name}', file_hash(os.path.join(self._gtfs_path, f'{table_name}.txt'))))
+            self.cursor.execute(my_sql.set_feed_meta_sql, ('source_hash', feed_hash(self._gtfs_path)))
+        return None
+
+    def _write_columns(self) -> None:
+        """writes the columnar copy (see columnar.py) of every feed table whose copy is missing or was
+        made from a different version of its file, e.g. databases built before the copies existed or
+        without pyarrow installed. tables are written as they are loaded otherwise"""
+        if not columnar.available():
+            return None
+
+        start = time.perf_counter()
+        stored = self._file_hashes()
+        written = 0
+        for table_name in my_sql.feed_tables:
+            file = f'{table_name}.txt'
+            path = columnar.table_path(self.db_path, table_name)
+            if file not in self.get_files() or columnar.stored_hash(path) == stored.get(table_name):
+                continue
+
+            with self.lock, self._columns_writer(table_name) as columns:
+                for chunk in iter_file(file, self, dtype=self._get_table_dtypes(table_name),
+                                       usecols=self._get_table_columns(table_name)):
+                    columns.write(add_seconds_columns(chunk, table_name))
+            written += columns.rows
+
+        if written:
+            self.ingest_stats['columns'] = {'rows': written, 'seconds': time.perf_counter() - start}
+        return None
+
+    def _file_hashes(self) -> dict:
+        """hash of the file each feed table was last loaded from, by table name"""
+        rows = self.conn.execute(my_sql.file_hashes_sql).fetchall()
+        return {key[len('file_hash:'):]: value for key, value in rows}
+
+    def arrow_table(self, table_name: str, columns: list = None):
+        """memory mapped columnar copy of a feed table as a pyarrow Table (only columns if given), None
+        if pyarrow isn't installed or there is no up to date copy"""
+        if not columnar.available() or table_name not in my_sql.feed_tables:
+            return None
+        return columnar.read_table(columnar.table_path(self.db_path, table_name), columns,
+                                   self._file_hashes().get(table_name))
+
+    def _load_added_tables(self) -> None:
+        """loads feed tables added to my_sql.feed_tables after the database was built (no stored file hash
+        and no rows). the table is made again first in case its definition changed too"""
+        stored = self._file_hashes()
+        existing = {name for (name,) in self.conn.execute(my_sql.table_names_sql)}
+
+        for table_name in my_sql.feed_tables:
+            if table_name in stored:
+                continue
+            if table_name in existing and self.conn.execute(my_sql.table_has_rows_sql.format(table=table_name)).fetchone():
+                continue
+            with self.lock, self.conn:
+                self.cursor.execute(my_sql.drop_table_sql.format(table=table_name))
+                for statement in my_sql.build_tables:
+                    self.cursor.execute(statement)
+                self._load_file(f'{table_name}.txt', table_name)
+                self.cursor.execute(my_sql.set_feed_meta_sql,
+                                    (f'file_hash:{table_name}', file_hash(os.path.join(self._gtfs_path, f'{table_name}.txt'))))
+        return None
+
+    def _changed_tables(self) -> list:
+        """feed tables whose file doesn't match the hash stored when the database was last built or updated"""
+        stored = self._file_hashes()
+        return [
+            table_name for table_name in my_sql.feed_tables
+            if stored.get(table_name) != file_hash(os.path.join(self._gtfs_path, f'{table_name}.txt'))
+        ]
+
+    def _update_table(self, table_name: str) -> dict:
+        """applies the difference between a table and its (changed) file as row deletes, updates and
+        inserts, rows are matched on my_sql.table_keys. caller holds the lock and the transaction"""
+        keys = my_sql.table_keys[table_name]
+        #IS instead of = so rows with a blank key still match
+        match = ' AND '.join(f"{{a}}.{key} IS {{b}}.{key}" for key in keys)
+
+        #the new file goes into a temporary copy of the table
+        for statement in my_sql.drop_update_tables:
+            self.cursor.execute(statement)
+        self.cursor.execute(my_sql.create_incoming_sql.format(table=table_name))
+        self._load_file(f'{table_name}.txt', table_name, into='incoming')
+        self.cursor.execute(my_sql.index_incoming_sql.format(keys=', '.join(keys)))
+
+        #new and changed rows
+        self.cursor.execute(my_sql.create_changed_sql.format(table=table_name))
+
+        self.cursor.execute(my_sql.delete_gone_rows_sql.format(
+            table=table_name, match=match.format(a='incoming', b=table_name)))
+        deleted = self.cursor.rowcount
+
+        self.cursor.execute(my_sql.delete_changed_rows_sql.format(
+            table=table_name, match=match.format(a=table_name, b='changed')))
+        updated = self.cursor.rowcount
+        self.cursor.execute(my_sql.insert_changed_rows_sql.format(table=table_name))
+        inserted = self.cursor.rowcount - updated
+
+        for statement in my_sql.drop_update_tables:
+            self.cursor.execute(statement)
+        return {'inserted': inserted, 'updated': updated, 'deleted': deleted}
+
+    @metrics.timed('feed_update', rows=lambda stats: sum(
+        changes.get('inserted', 0) + changes.get('updated', 0) + changes.get('deleted', 0) for changes in stats.values()))
+    def update(self) -> dict:
+        """brings the database up to date with the feed's files without rebuilding it. only tables
+        whose file hash changed are diffed, and only the derived tables computed from those tables
+        are rebuilt. everything happens in one transaction. returns the row changes per table"""
+        changed_tables = self._changed_tables()
+
+        with self.lock, self.conn:
+            for table_name in changed_tables:
+                start = time.perf_counter()
+                changes = self._update_table(table_name)
+                self.update_stats[table_name] = {**changes, 'seconds': time.perf_counter() - start}
+
+            #derived tables of an older version are rebuilt in full by __init__ instead
+            if self._aggregates_version() == my_sql.AGGREGATES_VERSION:
+                for aggregate, sources in my_sql.aggregate_sources.items():
+                    if set(sources) & set(changed_tables):
+                        start = time.perf_counter()
+                        self._aggregate_builders()[aggregate]()
+                        self.update_stats[aggregate] = {'seconds': time.perf_counter() - start}
+        self._forget_service_days()
+
+        self._record_file_hashes()
+        return self.update_stats
+
+    def _set_meta(self, key: str, value: str) -> None:
+        """stores a value in the feed_meta table"""
+        with self.lock, self.conn:
+            self.cursor.execute(my_sql.set_feed_meta_sql, (key, value))
+        return None
+
+    def _meta(self, key: str) -> str:
+        """a value stored in the feed_meta table, None if it isn't there"""
+        #conn.execute uses its own cursor so this is safe to call from any thread
+        value = self.conn.execute(my_sql.feed_meta_value_sql, (key,)).fetchone()
+        return value[0] if value else None
+
+    def source_hash(self) -> str:
+        """cache.feed_hash of the files the database was built from, None for databases built
+        before it was recorded"""
+        return self._meta('source_hash')
+
+    @metrics.timed('build_aggregates')
+    def _build_aggregates(self):
+        """precomputes stop departure stats, route by hour counts and shape geometries so maps, heatmaps 
+        and posters can read them instead of going through stop_times and shapes every time"""
+        start = time.perf_counter()
+        with self.lock, self.conn:
+            for statement in my_sql.drop_aggregate_tables + my_sql.build_aggregate_tables:
+                self.cursor.execute(statement)
+
+            for build in self._aggregate_builders().values():
+                build()
+
+            self.cursor.execute(my_sql.set_feed_meta_sql, ('aggregates_version', str(my_sql.AGGREGATES_VERSION)))
+        self._forget_service_days()
+        rows = self.conn.execute(my_sql.stop_departures_count_sql).fetchone()[0]
+        self.ingest_stats['aggregates'] = {'rows': rows, 'seconds': time.perf_counter() - start}
+        return None
+
+    def _aggregate_builders(self) -> dict:
+        """method that (re)fills each derived table in my_sql.aggregate_sources"""
+        return {
+            'stop_departures': self._build_stop_departures,
+            'route_hour_trips': self._build_route_hour_trips,
+            'route_shapes': self._build_route_shapes,
+            'shape_geoms': self._build_shape_geoms,
+            'service_days': self._build_service_days,
+            'center': self._build_center
+        }
+
+    def _build_stop_departures(self):
+        """stores the departure stats of every stop and service in stop_departures"""
+        self.cursor.execute(my_sql.delete_rows_sql.format(table='stop_departures'))
+        self._insert_rows(self._departure_stats().reset_index(), 'stop_departures')
+        return None
+
+    def _build_route_hour_trips(self):
+        """stores the number of stop_times by route and hour in route_hour_trips, counted on stop_times'
+        arrays when there are any"""
+        self.cursor.execute(my_sql.delete_rows_sql.format(table='route_hour_trips'))
+        arrays = self.stop_times_arrays()
+        if arrays is None:
+            self.cursor.execute(my_sql.route_hour_trips_sql)
+        else:
+            self._insert_rows(self._array_route_hour_trips(arrays), 'route_hour_trips')
+        return None
+
+    def _build_route_shapes(self):
+        """stores the distinct route and shape pairs of trips in route_shapes"""
+        self.cursor.execute(my_sql.delete_rows_sql.format(table='route_shapes'))
+        self.cursor.execute(my_sql.route_shapes_sql)
+        return None
+
+    def _trip_groups(self, arrays: 'stop_times_store.StopTimesArrays', columns: list, dropna: bool = False) -> tuple:
+        """group of each of arrays.trip_ids by the trips table's columns and the columns' values for each
+        group. trips missing from the trips table (and with dropna, trips with a blank value) get -1"""
+        trips = pd.read_sql(my_sql.trip_groups_sql, self.conn).drop_duplicates('trip_id')
+        if dropna:
+            trips = trips.dropna(subset=columns)
+        groups, values = pd.factorize(pd.MultiIndex.from_frame(trips[columns]), use_na_sentinel=False)
+        trip_groups = pd.Series(groups, index=trips['trip_id']).reindex(arrays.trip_ids, fill_value=-1)
+        return trip_groups.to_numpy(), values.to_frame(index=False, name=columns)
+
+    def _array_route_hour_trips(self, arrays: 'stop_times_store.StopTimesArrays') -> pd.DataFrame:
+        """route_hour_trips rows counted on stop_times' arrays"""
+        trip_groups, groups = self._trip_groups(arrays, ['route_id', 'service_id'])
+        counts = stop_times_store.group_hour_counts(arrays, trip_groups)
+        rows = groups.iloc[counts['group']].reset_index(drop=True)
+        rows['hour'] = counts['hour']
+        rows['trip_count'] = counts['count']
+        return rows
+
+    def _build_service_days(self):
+        """stores every service id in services and a bitmap of the services running on each date
+        the calendar covers in service_days"""
+        self.cursor.execute(my_sql.delete_rows_sql.format(table='services'))
+        self.cursor.execute(my_sql.delete_rows_sql.format(table='service_days'))
+        calendar = pd.read_sql(my_sql.calendar_sql, self.conn)
+        calendar_dates = pd.read_sql(my_sql.calendar_dates_sql, self.conn)
+        service_trips = pd.read_sql(my_sql.service_trips_sql, self.conn)
+
+        service_ids = sorted(set(calendar['service_id'].dropna()) | set(calendar_dates['service_id'].dropna())
+                             | set(service_trips['service_id']))
+        self.cursor.executemany(my_sql.insert_services_sql, enumerate(service_ids))
+
+        dates, active = service_calendar(calendar, calendar_dates, service_ids)
+        trips = active @ service_trips.set_index('service_id')['trips'].reindex(service_ids, fill_value=0).to_numpy()
+        #monday is 0, 1970-01-01 was a thursday
+        weekdays = (dates.astype('int64') + 3) % 7
+
+        rows = [
+            (date.strftime('%Y%m%d'), int(weekday), int(day_trips), np.packbits(services).tobytes())
+            for date, weekday, day_trips, services in zip(dates.astype(datetime.date), weekdays, trips, active)
+        ]
+        self.cursor.executemany(my_sql.insert_service_days_sql, rows)
+        return None
+
+    def _build_shape_geoms(self):
+        """stores each shape's points, sorted by shape_pt_sequence, as one packed float64 blob in shape_geoms
+        along with a digest of the points for spotting duplicate lines"""
+        self.cursor.execute(my_sql.delete_rows_sql.format(table='shape_geoms'))
+        self.cursor.execute(my_sql.delete_rows_sql.format(table='shape_lods'))
+        points = pd.read_sql(my_sql.shape_points_sql, self.conn)
+
+        shape_ids = points['shape_id'].to_numpy()
+        coords = points[['shape_pt_lat', 'shape_pt_lon']].to_numpy(dtype='float64')
+
+        #rows are sorted by shape so each shape is one slice of coords
+        starts = np.flatnonzero(np.r_[True, shape_ids[1:] != shape_ids[:-1]]) if len(shape_ids) else np.array([], dtype=int)
+        ends = np.r_[starts[1:], len(shape_ids)].astype(int)
+
+        #a line needs at least two points
+        keep = (ends - starts) >= 2
+        coords = coords[np.repeat(keep, ends - starts)]
+        starts, ends = starts[keep], ends[keep]
+        n_points = ends - starts
+        ids = shape_ids[starts]
+        offsets = np.r_[0, np.cumsum(n_points)]
 
+        rows = [
+            (ids[i], int(n_points[i]), coords[offsets[i]:offsets[i + 1]].tobytes(), linestring_digest(coords[offsets[i]:offsets[i + 1]]))
+            for i in range(len(ids))
+        ]
+        self.cursor.executemany(my_sql.insert_shape_geoms_sql, rows)
+
+        #simplified versions for drawing at lower detail
+        lines = shapely.linestrings(coords, indices=np.repeat(np.arange(len(ids)), n_points))
+        self._build_shape_lods(ids, lines)
+        return None
+
+    def _build_shape_lods(self, shape_ids: np.ndarray, lines: np.ndarray):
+        """stores a topology preserving (Douglas-Peucker) simplification of every shape at each of LOD_TOLERANCES"""
+        for tolerance in LOD_TOLERANCES:
+            simplified = shapely.simplify(lines, tolerance, preserve_topology=True)
+            points, index = shapely.get_coordinates(simplified, return_index=True)
+            counts = np.bincount(index, minlength=len(shape_ids))
+            offsets = np.r_[0, np.cumsum(counts)]
+
+            rows = [
+                (tolerance, shape_ids[i], int(counts[i]), points[offsets[i]:offsets[i + 1]].tobytes())
+                for i in range(len(shape_ids))
+            ]
+            self.cursor.executemany(my_sql.insert_shape_lods_sql, rows)
+        return None
+
+    def _build_center(self):
+        """stores the center of the transit network (the average shape point, or stop for feeds
+        without shapes) in feed_meta as a JSON [lat, lon]"""
+        center = self.cursor.execute(my_sql.shapes_center_sql).fetchone()
+        if center[0] is None:
+            center = self.cursor.execute(my_sql.stops_center_sql).fetchone()
+        self.cursor.execute(my_sql.set_feed_meta_sql, ('center', json.dumps(list(center))))
         return None
 
     def close(self):
@@ -151,118 +677,454 @@ class Feed:
     
     #spatial features
     def center_pt(self) -> tuple[int, int]:
-        """Returns a lat/lon tuple of the center of the transit network"""
-        center = [self.shapes()['shape_pt_lat'].mean(), self.shapes()['shape_pt_lon'].mean()]
-        return center
+        """Returns a lat/lon tuple of the center of the transit network, stored when the database was built"""
+        return json.loads(self._meta('center'))
     
-    def shape_pts(self)-> pd.Series:
-        """returns series with the points on each route as a list of Linestring coordinate tuples
-        currently slow and doesn't access database"""
-        
-        shape_points = self.shapes().groupby("shape_id")[["shape_pt_lat", "shape_pt_lon"]].apply(
-            lambda g: LineString(g.values))
-        
+    def lod_tolerance(self, units_per_pixel: float) -> float:
+        """the coarsest stored simplification tolerance that is still smaller than one pixel
+        (units_per_pixel degrees), None if even the finest one would show"""
+        usable = [tolerance for tolerance in LOD_TOLERANCES if tolerance <= units_per_pixel]
+        return max(usable) if usable else None
+
+    @metrics.timed('shape_pts', rows=len)
+    def shape_pts(self, tolerance: float = None)-> pd.Series:
+        """returns series of (lat, lon) Linestrings for each shape id, read from the stored shape_geoms.
+        with a tolerance from LOD_TOLERANCES the stored simplified lines are returned instead"""
+        if tolerance is None:
+            geoms = self.conn.execute(my_sql.shape_geoms_sql).fetchall()
+        else:
+            geoms = self.conn.execute(my_sql.shape_lods_sql, (tolerance,)).fetchall()
+        shape_ids = [row[0] for row in geoms]
+        n_points = np.array([row[1] for row in geoms], dtype=np.int64)
+
+        #reads the packed points as one float array without converting them to python objects,
+        #then builds every line in one call
+        coords = np.frombuffer(b''.join(row[2] for row in geoms), dtype='float64').reshape(-1, 2)
+        lines = shapely.linestrings(coords, indices=np.repeat(np.arange(len(geoms)), n_points))
+
         #naming series for later joins
-        shape_points.name = 'shape_points'
+        shape_points = pd.Series(lines, index=pd.Index(shape_ids, name='shape_id'), name='shape_points')
     
         return shape_points
     
 
     
-    def trips_shapes_routes(self) -> pd.DataFrame:
-        """returns Dataframe with trip, route, and shape data for mapping. removes 
-        duplicate linesrtrings"""
-
-        sql = """
-                SELECT 
-                    trips.*, 
-                    routes.route_id,
-                    routes.route_long_name,
-                    routes.route_short_name,
-                    CASE 
-                        WHEN LOWER(routes.route_color) = 'ffffff' THEN '000000'
-                        ELSE routes.route_color
-                    END AS route_color
-                FROM trips
-                JOIN routes USING (route_id)
-                WHERE shape_id IS NOT NULL
-                AND routes.route_color IS NOT NULL;
-                """
-                
-        trips_routes = pd.read_sql(sql, self.conn)
-        shapes = self.shape_pts().to_frame().reset_index()
-
-        trips_routes['shape_id'] = trips_routes['shape_id'].astype(str)
-        shapes['shape_id'] = shapes['shape_id'].astype(str)
-        
-        trips_shapes_routes = trips_routes.merge(shapes, on='shape_id', how='left')
+    @metrics.timed('trips_shapes_routes', rows=len)
+    def trips_shapes_routes(self, tolerance: float = None) -> pd.DataFrame:
+        """returns Dataframe with route and shape data for mapping, one row per unique
+        linestring on each route. tolerance picks a simplified level of detail (see shape_pts)"""
 
+        #one row per route and shape rather than per trip
+        trips_routes = pd.read_sql(my_sql.trips_shapes_routes_sql, self.conn)
 
-        #removing duplicate linestrings for speed and clean-ness
-        def normalize_linestring(ls):
-            """organizes linestrings smallest to largest"""
-            coords = list(ls.coords)
-            return tuple(coords if coords[0] <= coords[-1] else coords[::-1])
+        #shapes trips use that have no line stored (not in shapes.txt or under one point) can't be drawn
+        missing = trips_routes['digest'].isna()
+        if missing.any():
+            logger.warning("%s: %d shape ids used by trips have no points in shapes.txt (e.g. %s), their routes aren't drawn",
+                           self.name, trips_routes.loc[missing, 'shape_id'].nunique(), trips_routes.loc[missing, 'shape_id'].iloc[0])
+            trips_routes = trips_routes[~missing]
 
-        trips_shapes_routes['normalized'] = trips_shapes_routes['shape_points'].apply(normalize_linestring)
-        trips_shapes_routes_unique = trips_shapes_routes.drop_duplicates(subset='normalized').copy()
-        trips_shapes_routes_unique.drop(columns='normalized', inplace=True)
+        #removing duplicate linestrings for speed and clean-ness. shapes with the same stored
+        #digest have the same points (in either direction) so lines are compared by hash
+        unique = trips_routes.drop_duplicates(subset=['route_id', 'digest']).drop(columns='digest')
+
+        shapes = self.shape_pts(tolerance).to_frame().reset_index()
+        trips_shapes_routes_unique = unique.merge(shapes, on='shape_id', how='left', validate='many_to_one')
 
-        
         return trips_shapes_routes_unique
     
     #other functions
     def agency_name(self) -> str:
         "Returns agency name as a string"
-        return self.agency()['agency_name'][0]
+        return self.agency(['agency_name'])['agency_name'][0]
     
     #other functions
     def agency_url(self) -> str:
         "Returns agency url as a string"
-        return self.agency()['agency_url'][0]
+        return self.agency(['agency_url'])['agency_url'][0]
         
 
-    def departure_info(self)-> dict:
-        """"returns a dictionary of departure info by stop id for pop ups"""
+    def _departure_stats(self) -> pd.DataFrame:
+        """departures, first and last departure and average headway (seconds) for every stop, 
+        computed from stop_times' arrays when there are any or else read from the database"""
+        arrays = self.stop_times_arrays()
+        if arrays is not None:
+            return self._array_departure_stats(arrays)
+        return self._sql_departure_stats()
 
-        times = self.stop_times()
+    def _sql_departure_stats(self) -> pd.DataFrame:
+        """_departure_stats from stop_times and trips read from the database"""
+        times = pd.read_sql(my_sql.stop_departures_sql, self.conn)
 
-        #converting departure time to a time format to get frequency
-        times['departure_time'] = pd.to_timedelta(times['departure_time'])
+        #one grouped pass per stop and service instead of a python loop over stops. the average gap
+        #between sorted departures is (last - first) / (departures - 1) so a day's headway can be
+        #worked out from these without going back to stop_times (see my_sql.stop_departures_table_sql)
+        stats = times.groupby(['stop_id', 'service_id']).agg(
+            departures=('departure_secs', 'size'),
+            timed=('departure_secs', 'count'),
+            first=('departure_secs', 'min'),
+            last=('departure_secs', 'max')
+        )
 
-        #info for each stop
-        grouped = times.groupby(['stop_id'])
-        
-        dept_info = {}
-
-        for stop_id, group in grouped:
-            times = group['departure_time'].sort_values()
-            #if there is only one departure, there is no frequency to measure
-            if len(times) < 2:
-                freq = "Infrequent"
-            else:
-                deltas = times.diff().dropna()
-                avg_freq = deltas.mean()
-                freq = f"Every {int(avg_freq.total_seconds() // 60)} minutes"
-
-            first = str(times.min()).split(" ")[-1][:-3]
-            last = str(times.max()).split(" ")[-1][:-3]
-            count = len(times)
-
-            dept_info[stop_id[0]] = f"{count} daily departures: {freq} from {first} to {last}"
-            
-        return dept_info
+        return stats
+
+    def _array_departure_stats(self, arrays: 'stop_times_store.StopTimesArrays') -> pd.DataFrame:
+        """_departure_stats counted on stop_times' arrays, stop_times rows whose trip or service is
+        missing are left out like the database's join and grouping do"""
+        trip_groups, services = self._trip_groups(arrays, ['service_id'], dropna=True)
+        stats = stop_times_store.stop_departure_stats(arrays, trip_groups)
+        stats.insert(0, 'stop_id', arrays.stop_ids[stats.pop('stop')].astype(object))
+        stats.insert(1, 'service_id', services['service_id'].to_numpy()[stats.pop('group')])
+        return stats.set_index(['stop_id', 'service_id'])
+
+    #service days
+    def service_dates(self) -> pd.DataFrame:
+        """every date the feed's calendar covers with its weekday (monday is 0) and number of trips"""
+        dates = self._service_days()[1][['date', 'weekday', 'trips']].copy()
+        dates['date'] = pd.to_datetime(dates['date'], format='%Y%m%d')
+        return dates
+
+    def service_day(self, day=None) -> tuple:
+        """service ids running on a day. day can be a date (datetime.date or 'YYYYMMDD') or one of DAY_TYPES
+        (DEFAULT_SERVICE_DAY if not given), a day type uses the set of services that runs on most dates of
+        that type. returns None, meaning every service, for 'all' and for feeds without a calendar"""
+        day = DEFAULT_SERVICE_DAY if day is None else day
+        key = ('service_day', day.lower() if isinstance(day, str) else pd.Timestamp(day).strftime('%Y%m%d'))
+        with self.lock:
+            if key not in self._day_cache:
+                self._day_cache[key] = self._find_service_day(day)
+            return self._day_cache[key]
+
+    def _find_service_day(self, day) -> tuple:
+        """service ids running on a day (see service_day), looked up in the stored service_days"""
+        service_ids, days = self._service_days()
+        if (isinstance(day, str) and day.lower() == 'all') or days.empty:
+            return None
+
+        if isinstance(day, str) and day.lower() in DAY_TYPES:
+            candidates = days[days['weekday'].isin(DAY_TYPES[day.lower()]) & (days['trips'] > 0)]
+            if candidates.empty:
+                return ()
+            #most common bitmap, ties go to the one with more trips
+            counts = candidates.groupby('services').agg(dates=('date', 'size'), trips=('trips', 'max'))
+            services = counts.sort_values(['dates', 'trips'], ascending=False).index[0]
+        else:
+            date = pd.Timestamp(day).strftime('%Y%m%d')
+            match = days.loc[days['date'] == date, 'services']
+            if match.empty:
+                return ()
+            services = match.iloc[0]
+
+        running = np.unpackbits(np.frombuffer(services, dtype=np.uint8), count=len(service_ids)).astype(bool)
+        return tuple(service_ids[running])
+
+    def _service_days(self) -> tuple:
+        """service ids (in bitmap order) and the service_days table, read once"""
+        with self.lock:
+            if self._service_calendar is None:
+                service_ids = np.array([row[0] for row in self.conn.execute(my_sql.services_sql)], dtype=object)
+                days = pd.read_sql(my_sql.service_days_sql, self.conn)
+                self._service_calendar = (service_ids, days)
+            return self._service_calendar
+
+    def _day_stats(self, kind: str, services: tuple, sql: str, **read_sql_args) -> pd.DataFrame:
+        """a frequency query for the services running on a day, kept per (kind, services) so
+        switching back to a day doesn't query again"""
+        key = (kind, services)
+        with self.lock:
+            if key not in self._day_cache:
+                params = {'services': None if services is None else json.dumps(list(services))}
+                self._day_cache[key] = pd.read_sql(sql, self.conn, params=params, **read_sql_args)
+            return self._day_cache[key]
+
+    def _forget_service_days(self) -> None:
+        """drops the stored calendar and per day stats after the derived tables are rebuilt"""
+        with self.lock:
+            self._day_cache = {}
+            self._service_calendar = None
+        return None
+
+    @metrics.timed('departure_info', rows=len)
+    def departure_info(self, day=None) -> 'DepartureInfo':
+        """returns departure info by stop id for pop ups from the precomputed stop_departures table,
+        counting the services running on day (see service_day). the pop up text is only built when
+        a stop is looked up"""
+        stats = self._day_stats('departures', self.service_day(day), my_sql.stop_departures_table_sql,
+                                index_col='stop_id')
+        return DepartureInfo(stats)
     
 
-    def route_freq(self):
-        """returns table of top 10 routes and hourly frequency"""
-        route_freq = pd.read_sql(my_sql.route_freq_sql, self.conn)
-        pivot = route_freq.pivot(index='route_id',  columns='hour', values='trip_count').fillna(0)
+    @metrics.timed('route_freq', rows=len)
+    def route_freq(self, day=None):
+        """returns table of top 10 routes and hourly frequency (8am to 8pm) on day (see service_day)"""
+        route_freq = self._day_stats('route_freq', self.service_day(day), my_sql.route_freq_sql)
+        pivot = route_freq.pivot(index='route_id',  columns='hour', values='trip_count')
+        #every hour gets a column, even ones without trips that day
+        pivot = pivot.reindex(columns=range(8, 21)).fillna(0)
         return pivot
     
     
-def extract_file(file: str, feed: Type['Feed'])-> pd.DataFrame:
-    """reads csv for individual table methods"""
+class DepartureInfo(Mapping):
+    """Read-only mapping of stop id -> pop up text built from a table of departure stats per stop
+    (departures, first and last departure and average headway in seconds after midnight)"""
+    def __init__(
+    self,
+    stats: pd.DataFrame
+    ):
+        self.stats = stats
+
+    def __getitem__(self, stop_id) -> str:
+        row = self.stats.loc[stop_id]
+        if pd.isna(row['headway']):
+            freq = "Infrequent"
+        else:
+            freq = f"Every {int(row['headway'] // 60)} minutes"
+        return f"{int(row['departures'])} daily departures: {freq} from {clock_time(row['first'])} to {clock_time(row['last'])}"
+
+    def __contains__(self, stop_id) -> bool:
+        return stop_id in self.stats.index
+
+    def __iter__(self):
+        return iter(self.stats.index)
+
+    def __len__(self):
+        return len(self.stats)
+
+
+class FeedRegistry:
+    """Process-wide pool of open feeds so the app shares one Feed (and one database connection) per 
+    GTFS folder instead of building a new one in every callback. Holds at most max_feeds feeds and 
+    closes the least recently used one when it runs over. Feeds that are still borrowed when they
+    are evicted are closed when they are given back"""
+    def __init__(
+    self,
+    max_feeds: int
+    ):
+        self.max_feeds = max_feeds
+
+        #absolute gtfs path -> Feed, least recently used first
+        self._feeds = OrderedDict()
+        #how many callers are currently using each feed
+        self._in_use = Counter()
+        #evicted feeds waiting for their last caller to finish
+        self._retired = set()
+
+        self._lock = threading.Lock()
+        #one lock per path so two requests for a new feed don't both build its database
+        self._path_locks = {}
+
+    def acquire(self, gtfs_path: str) -> Feed:
+        """returns the shared feed for gtfs_path, opening it if needed. must be paired with release()"""
+        key = os.path.abspath(gtfs_path)
+        with self._lock:
+            path_lock = self._path_locks.setdefault(key, threading.Lock())
+
+        with path_lock:
+            with self._lock:
+                gtfs_feed = self._feeds.get(key)
+                if gtfs_feed is not None:
+                    self._feeds.move_to_end(key)
+                    self._in_use[gtfs_feed] += 1
+                    return gtfs_feed
+
+            #building a new database can take a while so other feeds aren't blocked meanwhile
+            gtfs_feed = Feed(gtfs_path)
+
+            with self._lock:
+                self._feeds[key] = gtfs_feed
+                self._in_use[gtfs_feed] += 1
+                self._evict()
+            return gtfs_feed
+
+    def release(self, gtfs_feed: Feed) -> None:
+        """gives a feed back, closing it if it was evicted while in use"""
+        with self._lock:
+            self._in_use[gtfs_feed] -= 1
+            if self._in_use[gtfs_feed] <= 0:
+                del self._in_use[gtfs_feed]
+                if gtfs_feed in self._retired:
+                    self._retired.discard(gtfs_feed)
+                    gtfs_feed.close()
+
+    @contextmanager
+    def open(self, gtfs_path: str):
+        """borrows the shared feed for gtfs_path for the length of a with block"""
+        gtfs_feed = self.acquire(gtfs_path)
+        try:
+            yield gtfs_feed
+        finally:
+            self.release(gtfs_feed)
+
+    def _evict(self) -> None:
+        """closes least recently used feeds until under max_feeds, lock must be held"""
+        while len(self._feeds) > self.max_feeds:
+            _, old_feed = self._feeds.popitem(last=False)
+            self._close_or_retire(old_feed)
+
+    def _close_or_retire(self, gtfs_feed: Feed) -> None:
+        """closes a feed now if nobody is using it, otherwise once it is released, lock must be held"""
+        if self._in_use[gtfs_feed] > 0:
+            self._retired.add(gtfs_feed)
+        else:
+            self._in_use.pop(gtfs_feed, None)
+            gtfs_feed.close()
+
+    def discard(self, gtfs_path: str) -> None:
+        """removes a feed from the registry (eg when its files are replaced)"""
+        with self._lock:
+            gtfs_feed = self._feeds.pop(os.path.abspath(gtfs_path), None)
+            if gtfs_feed is not None:
+                self._close_or_retire(gtfs_feed)
+
+    def close_all(self) -> None:
+        """closes every feed in the registry"""
+        with self._lock:
+            while self._feeds:
+                _, gtfs_feed = self._feeds.popitem(last=False)
+                self._close_or_retire(gtfs_feed)
+
+    def __len__(self):
+        return len(self._feeds)
+
+
+#one registry per process (each gunicorn worker gets its own)
+feed_registry = FeedRegistry(int(os.environ.get("GTFS_FEED_REGISTRY_SIZE", DEFAULT_REGISTRY_SIZE)))
+atexit.register(feed_registry.close_all)
+metrics.registry.add_collector('feed_registry', lambda: {'open_feeds': len(feed_registry)})
+
+
+def open_feed(gtfs_path: str):
+    """borrows the shared feed for gtfs_path from the registry: with open_feed(path) as gtfs_feed: ..."""
+    return feed_registry.open(gtfs_path)
+
+
+def copy_feed(gtfs_path: str, work_dir: str) -> str:
+    """copies a gtfs folder into a scratch gtfs_files/databases layout so benchmarks and checks
+    always build a fresh database and never touch the repo data"""
+    gtfs_dir = os.path.join(work_dir, "gtfs_files")
+    os.makedirs(gtfs_dir, exist_ok=True)
+    os.makedirs(os.path.join(work_dir, "databases"), exist_ok=True)
+
+    feed_copy = os.path.join(gtfs_dir, os.path.basename(os.path.normpath(gtfs_path)))
+    shutil.copytree(gtfs_path, feed_copy)
+    return feed_copy
+
+
+def missing_files(gtfs_path: str) -> list:
+    """REQUIRED_FILES that aren't in a gtfs folder"""
+    return [name for name in REQUIRED_FILES if not os.path.isfile(os.path.join(gtfs_path, name))]
+
+
+def linestring_digest(coords: np.ndarray) -> bytes:
+    """16 byte hash of a line's points, ordered so the first point is the smaller one so 
+    the same line drawn in either direction gets the same digest"""
+    if len(coords) and tuple(coords[0]) > tuple(coords[-1]):
+        coords = coords[::-1]
+    return hashlib.blake2b(np.ascontiguousarray(coords).tobytes(), digest_size=16).digest()
+
+
+def gtfs_time_seconds(times: pd.Series) -> pd.Series:
+    """converts GTFS H:MM:SS times (which can go past 24:00:00) to seconds after midnight, blanks become NaN.
+    HH:MM:SS and H:MM:SS times are read straight from their characters, anything else (spaces, three
+    digit hours) goes through a regular expression"""
+    #times longer than 8 characters are cut short here and fail the checks below
+    raw = np.asarray(times.fillna('').to_numpy(), dtype='U9').view(np.uint32).reshape(-1, 9)
+    #'0'-'9' become 0-9, every other character ends up above 9
+    digits = raw - np.uint32(ord('0'))
+    colon = np.uint32(ord(':'))
+
+    long_hours = (raw[:, 2] == colon) & (raw[:, 5] == colon) & (raw[:, 8] == 0) & \
+        (digits[:, [0, 1, 3, 4, 6, 7]].max(axis=1) <= 9)
+    short_hours = (raw[:, 1] == colon) & (raw[:, 4] == colon) & (raw[:, 7] == 0) & \
+        (digits[:, [0, 2, 3, 5, 6]].max(axis=1) <= 9)
+
+    #both layouts are worked out for every row (cheaper than indexing) and the matching one kept
+    digits = digits.astype(np.int32)
+    long_seconds = ((digits[:, 0] * 10 + digits[:, 1]) * 3600 + (digits[:, 3] * 10 + digits[:, 4]) * 60
+                    + digits[:, 6] * 10 + digits[:, 7])
+    short_seconds = (digits[:, 0] * 3600 + (digits[:, 2] * 10 + digits[:, 3]) * 60
+                     + digits[:, 5] * 10 + digits[:, 6])
+    seconds = np.where(long_hours, long_seconds, np.where(short_hours, short_seconds, np.nan))
+
+    #blanks are left as NaN
+    other = ~(long_hours | short_hours) & (raw[:, 0] != 0)
+    if other.any():
+        parts = times[other].astype(str).str.extract(r'^\s*(\d+):(\d{2}):(\d{2})\s*$').astype(float)
+        seconds[other] = (parts[0] * 3600 + parts[1] * 60 + parts[2]).to_numpy()
+
+    return pd.Series(seconds, index=times.index)
+
+
+def add_seconds_columns(df: pd.DataFrame, table_name: str) -> pd.DataFrame:
+    """adds a table's my_sql.seconds_columns (GTFS times as seconds after midnight) to rows read from its file"""
+    for text, secs in my_sql.seconds_columns.get(table_name, {}).items():
+        if text in df.columns:
+            df[secs] = gtfs_time_seconds(df[text])
+    return df
+
+
+def clock_time(seconds: float) -> str:
+    """HH:MM clock time for seconds after midnight (times past midnight wrap around)"""
+    if pd.isna(seconds):
+        return ""
+    minutes = int(seconds) // 60
+    return f"{minutes // 60 % 24:02d}:{minutes % 60:02d}"
+
+
+def service_calendar(calendar: pd.DataFrame, calendar_dates: pd.DataFrame, service_ids: list) -> tuple:
+    """dates (numpy datetime64[D]) from the first to the last date in calendar and calendar_dates, and
+    a (dates, service_ids) boolean array of which services run on each date: calendar's weekly pattern
+    between each service's start and end date, with calendar_dates' added (1) and removed (2) dates"""
+    column = {service_id: i for i, service_id in enumerate(service_ids)}
+
+    def to_days(dates: pd.Series) -> np.ndarray:
+        return pd.to_datetime(dates.astype(str).str.strip(), format='%Y%m%d', errors='coerce').to_numpy(dtype='datetime64[D]')
+
+    calendar = calendar.dropna(subset=['service_id'])
+    calendar_dates = calendar_dates.dropna(subset=['service_id'])
+    starts, ends = to_days(calendar['start_date']), to_days(calendar['end_date'])
+    exception_days = to_days(calendar_dates['date'])
+
+    known = np.concatenate([starts, ends, exception_days])
+    known = known[~np.isnat(known)]
+    if not len(known):
+        return np.array([], dtype='datetime64[D]'), np.zeros((0, len(service_ids)), dtype=bool)
+    first = known.min()
+    last = min(known.max(), first + np.timedelta64(MAX_SERVICE_DAYS - 1, 'D'))
+    dates = np.arange(first, last + np.timedelta64(1, 'D'))
+    weekdays = (dates.astype('int64') + 3) % 7
+
+    active = np.zeros((len(dates), len(service_ids)), dtype=bool)
+
+    #weekly pattern: (dates, calendar rows) for every row at once
+    runs_on = calendar[list(WEEKDAYS)].fillna(0).astype(float).to_numpy().astype(bool)
+    in_range = (dates[:, None] >= starts[None, :]) & (dates[:, None] <= ends[None, :])
+    columns = calendar['service_id'].map(column).to_numpy(dtype=int)
+    for i, service_column in enumerate(columns):
+        active[:, service_column] |= in_range[:, i] & runs_on[i, weekdays]
+
+    #exceptions inside the date range
+    rows = (exception_days - first).astype('int64')
+    inside = ~np.isnat(exception_days) & (rows >= 0) & (rows < len(dates))
+    exception_columns = calendar_dates['service_id'].map(column).to_numpy(dtype=int)[inside]
+    exception_types = pd.to_numeric(calendar_dates['exception_type'], errors='coerce').to_numpy()[inside]
+    active[rows[inside], exception_columns] = np.where(exception_types == 1, True,
+                                                       np.where(exception_types == 2, False, active[rows[inside], exception_columns]))
+
+    return dates, active
+
+
+def service_day_key(services: tuple) -> str:
+    """short name for a set of running services (from Feed.service_day) for cache keys"""
+    if services is None:
+        return 'all'
+    return hashlib.blake2b('\n'.join(services).encode(), digest_size=8).hexdigest()
+
+
+def extract_file(file: str, feed: Type['Feed'], columns: list = None)-> pd.DataFrame:
+    """reads a table for individual table methods (only columns if given). tables with an up to date
+    columnar copy are memory mapped from it, others are read from the csv, parsed tables are kept in
+    the shared table cache so each file is only read once until it changes on disk"""
 
     files = feed.get_files()
     gtfs_path = feed.gtfs_path()
@@ -270,12 +1132,45 @@ def extract_file(file: str, feed: Type['Feed'])-> pd.DataFrame:
     file_path = f"{gtfs_path}/{file}"
 
     if file in files:
-        data = pd.read_csv(file_path)
+        table = feed.arrow_table(file[:-len('.txt')], columns)
+        if table is not None:
+            return columnar.to_pandas(table)
+
+        data = table_cache.get(file_path, lambda: pd.read_csv(file_path))
+        if columns is not None:
+            data = data[[column for column in columns if column in data.columns]]
         return data
     
     else:
         return None
-    
 
 
+def iter_file(file: str, feed: Type['Feed'], dtype: dict = None, usecols: list = None):
+    """reads csv in chunks of feed.chunksize rows, only keeping usecols if given"""
+
+    file_path = f"{feed.gtfs_path()}/{file}"
+
+    if file not in feed.get_files():
+        return
+
+    keep = (lambda col: col in usecols) if usecols else None
+
+    #float64 columns are read as text and converted a chunk at a time, values that aren't numbers
+    #(e.g. a route_type written as text) are loaded as blanks instead of failing the whole file
+    numeric = [col for col, kind in (dtype or {}).items() if kind == 'float64']
+    read_dtype = {col: str if col in numeric else kind for col, kind in dtype.items()} if dtype else None
+    not_numbers = Counter()
+
+    #utf-8-sig drops the byte order mark some agencies leave at the start of the header
+    with pd.read_csv(file_path, chunksize=feed.chunksize, dtype=read_dtype, usecols=keep,
+                     encoding='utf-8-sig') as reader:
+        for chunk in reader:
+            for col in [col for col in numeric if col in chunk.columns]:
+                values = pd.to_numeric(chunk[col], errors='coerce').astype('float64')
+                not_numbers[col] += int((values.isna() & chunk[col].notna()).sum())
+                chunk[col] = values
+            yield chunk
 
+    for col, count in not_numbers.items():
+        if count:
+            logger.warning("%s: %d values of %s aren't numbers and were loaded as blanks", file_path, count, col)
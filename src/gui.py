@@ -1,8 +1,6 @@
 
-from dash import Dash, html, dcc, Input, Output, callback, State
+from dash import Dash, html, dcc, Input, Output, callback, State, ctx, no_update
 import dash_bootstrap_components as dbc
-import base64
-import zipfile
 import importlib
 import os
 
@@ -10,6 +8,10 @@ from src import feed
 from src import interactive_maps
 from src import posters
 from src import heatmap
+from src import tiles
+from src import jobs
+from src import uploads
+from src import metrics
 importlib.reload(feed)
 importlib.reload(posters)
 
@@ -25,7 +27,7 @@ def run_app():
                 external_stylesheets=[dbc.themes.DARKLY])
     app.title = 'Mapping Your Transit'
 
-    server = app.server
+    register_routes(app.server)
 
     create_layout(app)
     register_callbacks(app)
@@ -33,6 +35,16 @@ def run_app():
     app.run(debug=False) 
 
 
+def register_routes(server) -> None:
+    """adds the app's own endpoints (map tiles, feed uploads, /metrics and the per request timing)
+    to the dash app's flask server, called by run_app and by app.py so the deployed app serves the
+    same routes"""
+    tiles.register_tile_routes(server)
+    uploads.register_upload_routes(server)
+    metrics.register_metrics_routes(server)
+    return None
+
+
 
 
 
@@ -68,7 +80,8 @@ def create_layout(app: Dash) -> None:
                                     'backgroundColor': 'white'
                                 }
                         ),
-                        dcc.Upload(
+                        # upload box, the zip is posted straight to the /upload endpoint (see uploads.py)
+                        html.Div(
                             id='upload-data',
                             children=html.Div(
                                 ['Drag and Drop Compressed GTFS Folder or ',
@@ -84,12 +97,13 @@ def create_layout(app: Dash) -> None:
                                 'borderRadius': '5px',
                                 'textAlign': 'center',
                                 'padding': '0 px',
-                                'lineHeight': '1.5' 
-                            },
-                            multiple=False
+                                'lineHeight': '1.5',
+                                'cursor': 'pointer'
+                            }
                         )
                     ]
             ),
+            html.Div(id='upload-status', style={'textAlign': 'right', 'marginTop': '5px'}),
 
             # Empty Map display panel
 
@@ -142,7 +156,14 @@ def create_layout(app: Dash) -> None:
             ),
 
             # Active Feed storage
-            dcc.Store(id='active-feed-string')
+            dcc.Store(id='active-feed-string'),
+
+            # Feed folder of the last upload
+            dcc.Store(id='upload-result'),
+
+            # Poster job being rendered and the timer that checks on it
+            dcc.Store(id='poster-job'),
+            dcc.Interval(id='poster-poll', interval=1000, disabled=True)
         ]
     )
 
@@ -153,14 +174,19 @@ def create_layout(app: Dash) -> None:
 
 def register_callbacks(app):
     """Tells Dash what to do when user interacts with app"""
+    app.clientside_callback(
+        uploads.UPLOAD_SCRIPT,
+        Output('upload-result', 'data'),
+        Input('upload-data', 'id')
+    )
+
     @app.callback(
         Output('map-container', 'children'),
         Output('active-feed-string', 'data'),
-        Input('upload-data', 'contents'),
-        Input('demo-dropdown', 'value'),
-        State('upload-data', 'filename')
+        Input('upload-result', 'data'),
+        Input('demo-dropdown', 'value')
     )
-    def update_map(contents, demo_choice, filename):
+    def update_map(upload, demo_choice):
         """Puts map in interactive window"""
         placeholder = html.Div(
             "Select a Transit Feed",
@@ -209,13 +235,44 @@ def register_callbacks(app):
                 }
             )
         def insert_heatmap(feed):
+            # dates the feed runs any trips on, for the date picker: the first and last of them bound
+            # the picker, only the dates without service in between are disabled
+            dates = feed.service_dates()
+            running = dates.loc[dates['trips'] > 0, 'date']
+            gaps = dates.loc[(dates['trips'] == 0) & dates['date'].between(running.min(), running.max()), 'date'] \
+                if len(running) else dates['date'].iloc[:0]
             return [html.H4("Frequency of Top 10 Routes",
                             style={"color": "white",
                                    "textAlign": "center"
                                    }),
+            # service day the frequencies are counted for: a day type or a date
+            html.Div(
+                style={'display': 'flex', 'gap': '20px', 'alignItems': 'center', 'justifyContent': 'center'},
+                children=[
+                    dcc.RadioItems(
+                        id='service-day-input',
+                        options=[
+                            {'label': 'Weekday', 'value': 'weekday'},
+                            {'label': 'Saturday', 'value': 'saturday'},
+                            {'label': 'Sunday', 'value': 'sunday'}
+                        ],
+                        value='weekday',
+                        labelStyle={'display': 'inline-block', 'margin-right': '15px'}
+                    ),
+                    dcc.DatePickerSingle(
+                        id='service-date-input',
+                        placeholder='or a date',
+                        min_date_allowed=running.min() if len(running) else None,
+                        max_date_allowed=running.max() if len(running) else None,
+                        disabled_days=list(gaps.dt.strftime('%Y-%m-%d')),
+                        disabled=not len(running),
+                        clearable=True
+                    )
+                ]
+            ),
             dcc.Graph(
                 id="heatmap-graph",
-                figure=heatmap.heatmap(feed),
+                figure=heatmap.cached_heatmap(feed),
                 config={"displayModeBar": False},  # optional
                 style={"height": "300px",
                        "width": "500px",
@@ -223,9 +280,15 @@ def register_callbacks(app):
             )]
 
         #If user uploads a file: read the feed and add in the label boxes
-        if contents is not None:
+        if upload is not None:
             # User uploaded a file
-            map_frame, feed_path = read_feed(contents, filename)
+            map_frame, feed_path = read_feed(upload['feed_path'])
+
+            #one shared feed for all the boxes
+            with feed.open_feed(feed_path) as gtfs_feed:
+                label = label_box(gtfs_feed)
+                website = website_box(gtfs_feed)
+                heatmap_box = insert_heatmap(gtfs_feed)
 
             return html.Div(style={
                             'display': 'flex',
@@ -235,7 +298,7 @@ def register_callbacks(app):
                             'margin': 'auto',
                             'marginTop': '20px',
                         }, children = [
-                label_box(feed.Feed(feed_path)),
+                label,
                 # Horizontal layout with map on left and heatmap + poster tools on right
                 html.Div(
                     style={
@@ -251,7 +314,7 @@ def register_callbacks(app):
 
                         # Left side: the map
                         html.Div(
-                            [map_frame, website_box(feed.Feed(feed_path))],
+                            [map_frame, website],
                             style={
                                 'marginTop': '20px',
                                 'width': '70%',
@@ -265,7 +328,7 @@ def register_callbacks(app):
                             style={"width": "30%"},
                             children=[
                                 html.Div(
-                                    children=insert_heatmap(feed.Feed(feed_path)),
+                                    children=heatmap_box,
                                     style={"marginBottom": "40px"}
                                 ),
                                 html.H3("Create a Poster Map"),
@@ -279,9 +342,21 @@ def register_callbacks(app):
                                     value=True,
                                     labelStyle={'display': 'inline-block', 'margin-right': '30px'}
                                 ),
+                                html.Label("File Type"),
+                                dcc.RadioItems(
+                                    id='poster-format-input',
+                                    options=[
+                                        {'label': 'PNG', 'value': 'png'},
+                                        {'label': 'PDF', 'value': 'pdf'},
+                                        {'label': 'SVG', 'value': 'svg'}
+                                    ],
+                                    value='png',
+                                    labelStyle={'display': 'inline-block', 'margin-right': '30px'}
+                                ),
                                 html.Br(),
                                 dbc.Button("Download Poster", id="btn_txt", color="secondary", className="me-1"),
-                                dcc.Download(id="download_text_index")
+                                dcc.Download(id="download_text_index"),
+                                html.Div(id="poster-status", style={"marginTop": "10px"})
                             ]
                         )
                     ]
@@ -292,6 +367,12 @@ def register_callbacks(app):
         elif demo_choice:
             # User picked a sample dataset
             map_frame, feed_path = load_sample_feed(demo_choice)
+
+            #one shared feed for all the boxes
+            with feed.open_feed(feed_path) as gtfs_feed:
+                label = label_box(gtfs_feed)
+                website = website_box(gtfs_feed)
+                heatmap_box = insert_heatmap(gtfs_feed)
             # Horizontal layout with map on left and heatmap + poster tools on right
             return html.Div(style={
                             'display': 'flex',
@@ -301,7 +382,7 @@ def register_callbacks(app):
                             'margin': 'auto',
                             'marginTop': '20px',
                         }, children = [
-                        label_box(feed.Feed(feed_path)),
+                        label,
                         html.Div(
                         style={
                             'display': 'flex',
@@ -316,7 +397,7 @@ def register_callbacks(app):
 
                             # Left side: the map
                             html.Div(
-                                [map_frame, website_box(feed.Feed(feed_path))],
+                                [map_frame, website],
                                 style={
                                     'marginTop': '20px',
                                     'width': '70%',
@@ -330,7 +411,7 @@ def register_callbacks(app):
                                 style={"width": "30%"},
                                 children=[
                                     html.Div(
-                                        children=insert_heatmap(feed.Feed(feed_path)),
+                                        children=heatmap_box,
                                         style={"marginBottom": "40px"}
                                     ),
                                     html.H3("Create a Poster Map"),
@@ -344,9 +425,21 @@ def register_callbacks(app):
                                         value=True,
                                         labelStyle={'display': 'inline-block', 'margin-right': '30px'}
                                     ),
+                                    html.Label("File Type"),
+                                    dcc.RadioItems(
+                                        id='poster-format-input',
+                                        options=[
+                                            {'label': 'PNG', 'value': 'png'},
+                                            {'label': 'PDF', 'value': 'pdf'},
+                                            {'label': 'SVG', 'value': 'svg'}
+                                        ],
+                                        value='png',
+                                        labelStyle={'display': 'inline-block', 'margin-right': '30px'}
+                                    ),
                                     html.Br(),
                                     dbc.Button("Download Poster", id="btn_txt", color="secondary", className="me-1"),
-                                    dcc.Download(id="download_text_index")
+                                    dcc.Download(id="download_text_index"),
+                                    html.Div(id="poster-status", style={"marginTop": "10px"})
                                 ]
                             )       
                         ]
@@ -359,53 +452,85 @@ def register_callbacks(app):
             # Neither uploaded nor selected
             return placeholder, None
         
-#callback for poster download
+#callback for switching the heatmap's service day, picking a date clears the day type and the other way round
+    @app.callback(
+    Output('heatmap-graph', 'figure'),
+    Output('service-day-input', 'value'),
+    Output('service-date-input', 'date'),
+    Input('service-day-input', 'value'),
+    Input('service-date-input', 'date'),
+    State('active-feed-string', 'data'),
+    prevent_initial_call=True
+    )
+    def update_service_day(day_type, date, filename):
+        "redraws the heatmap for the picked day type or date (each day's figure is cached)"
+        if not filename:
+            return no_update, no_update, no_update
+
+        if ctx.triggered_id == 'service-date-input' and date:
+            day, day_type = date, None
+        else:
+            day, date = day_type or 'weekday', None
+
+        with feed.open_feed(filename) as gtfs_feed:
+            figure = heatmap.cached_heatmap(gtfs_feed, day)
+        return figure, day_type, date
+
+#callback for poster download: starts a background render (or finds the cached poster)
     @app.callback(
     Output("download_text_index", "data"),
+    Output('poster-job', 'data'),
+    Output('poster-poll', 'disabled'),
+    Output('poster-status', 'children'),
     Input("btn_txt", "n_clicks"),
     State('active-feed-string', 'data'),  
     State('include-summary-input', 'value'),
+    State('poster-format-input', 'value'),
     prevent_initial_call=True
     )
-    def throw_poster(n_clicks, filename, heatmap_choice):
-        "generates poster and sends it to the button"
+    def throw_poster(n_clicks, filename, heatmap_choice, file_format):
+        "starts the poster render, sending the poster right away if it is already cached"
         if not filename:
-            return None  # no feed selected, nothing to generate
-        
-        if 'user_data' in filename.split(os.sep):
-            user_data = True
-        else: 
-            user_data = False
+            return None, None, True, ""  # no feed selected, nothing to generate
 
-        poster_file = posters.map(feed.Feed(filename), Heatmap = heatmap_choice, user_data = user_data)
-        return dcc.send_file(poster_file) 
-    
-
-def read_feed(contents, filename):
-    """reads feed from drag and drop box, decoding the uploaded zip file,
-    saves the zip and the extracted file, creates the feed object, and returns 
-    html iframe of map"""
+        job_id = jobs.poster_jobs.submit(filename, heatmap = heatmap_choice, file_format = file_format or 'png')
+        status = jobs.poster_jobs.status(job_id)
+        if status['state'] == 'done':
+            return dcc.send_file(status['file'], filename = jobs.poster_download_name(job_id)), None, True, ""
 
-    # Interpreting contents: upload -> filename for unzipped folder of gtfs data
-    #decoding contents
-    content_type, content_string = contents.split(',')
-    decoded = base64.b64decode(content_string)
+        return None, job_id, False, "Rendering poster..."
 
-    # Save uploaded zip
-    zip_path = os.path.join('data/user_data/gtfs_files/zipped_files', filename)
-    with open(zip_path, 'wb') as f:
-        f.write(decoded)
+#callback checking on the poster render every second
+    @app.callback(
+    Output("download_text_index", "data", allow_duplicate=True),
+    Output('poster-poll', 'disabled', allow_duplicate=True),
+    Output('poster-status', 'children', allow_duplicate=True),
+    Input('poster-poll', 'n_intervals'),
+    State('poster-job', 'data'),
+    prevent_initial_call=True
+    )
+    def poll_poster(n_intervals, job_id):
+        "sends the poster once its render is done"
+        if not job_id:
+            return None, True, ""
+
+        status = jobs.poster_jobs.status(job_id)
+        if status['state'] == 'done':
+            return dcc.send_file(status['file'], filename = jobs.poster_download_name(job_id)), True, ""
+        if status['state'] in ('failed', 'unknown'):
+            return None, True, f"Poster could not be made: {status['error'] or 'unknown job'}"
+        if status['state'] == 'queued':
+            return None, False, f"Waiting for a free renderer... ({status['seconds']:.0f}s)"
+        return None, False, f"Rendering poster... ({status['seconds']:.0f}s)"
+    
 
-    #unzipping into a folder in gtfs_files folder
-    gtfs_folder_name = filename.replace('.zip', '') #folder name
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall('data/user_data/gtfs_files') #extract to that folder
+def read_feed(feed_filename):
+    """creates the map of a feed uploaded through the drag and drop box (the /upload endpoint
+    already saved the zip, unpacked it and loaded the feed's database) and returns
+    html iframe of map"""
 
-    # Create the Feed and map
-    feed_filename = os.path.join('data/user_data/gtfs_files', gtfs_folder_name)
-    gtfs_feed = feed.Feed(feed_filename)
-    folium_map = interactive_maps.live_map(gtfs_feed)
-    map_html = folium_map.get_root().render()
+    # Create the map (routes and stops are loaded from the tile endpoint)
+    map_html = interactive_maps.cached_map_html(feed_filename)
 
     return html.Iframe(srcDoc=map_html,
                        width='100%',
@@ -428,10 +553,8 @@ def load_sample_feed(demo_choice):
     
     gtfs_folder_path = os.path.join(sample_feed_path, sample_paths.get(demo_choice))
 
-    # Create the Feed and map
-    gtfs_feed = feed.Feed(gtfs_folder_path)
-    folium_map = interactive_maps.live_map(gtfs_feed)
-    map_html = folium_map.get_root().render()
+    # Create the Feed and map (routes and stops are loaded from the tile endpoint)
+    map_html = interactive_maps.cached_map_html(gtfs_folder_path)
 
     return html.Iframe(srcDoc=map_html,
                        width='100%',
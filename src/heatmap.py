@@ -1,11 +1,17 @@
+import json
 from src import feed
+from src import cache
+from src import metrics
+from src.feed import service_day_key
 import plotly.graph_objects as go
 import numpy as np
 
-def heatmap(feed) -> go.Figure:
-    """creates interactive plotly figure of top route frequency by hour for user interface"""
+@metrics.timed('heatmap')
+def heatmap(feed, day=None) -> go.Figure:
+    """creates interactive plotly figure of top route frequency by hour for user interface,
+    on a date or day type (see Feed.service_day)"""
     # Get data
-    data = feed.route_freq()
+    data = feed.route_freq(day)
     value = data.values
     hour = list(range(8, 21))  # Hours from 8 to 20
     route = data.index.tolist()  # Route names
@@ -67,4 +73,13 @@ def heatmap(feed) -> go.Figure:
         namelength=-1  
     ))
 
-    return fig
\ No newline at end of file
+    return fig
+
+def heatmap_key(feed, day=None) -> str:
+    """render cache key of a feed's heatmap on a day, days with the same services running share one"""
+    return cache.render_cache.key(feed.gtfs_path(), service_day_key(feed.service_day(day)))
+
+@metrics.timed('heatmap_cached')
+def cached_heatmap(feed, day=None) -> dict:
+    """plotly figure (as a dict) of a feed's route frequency heatmap on a day, from the render cache if possible"""
+    return json.loads(cache.render_cache.get('heatmap', heatmap_key(feed, day), lambda: heatmap(feed, day).to_json()))
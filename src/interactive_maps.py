@@ -1,21 +1,60 @@
 from src.feed import *
+from src import my_sql
+from src import cache
+from src import metrics
+from src.tiles import GeoJsonTileLayer, tile_url, lonlat, route_features, stop_features, stop_popups
 import folium
+import numpy as np
 import warnings
 warnings.filterwarnings('ignore')
 
-def live_map(feed) -> folium.Map:
+#zoom level up to which simplified route lines look the same as the full ones
+MAP_DETAIL_ZOOM = 14
+
+
+def degrees_per_pixel(zoom: int, lat: float) -> float:
+    """size of one leaflet map pixel in degrees at a zoom level (the smaller of lat and lon)"""
+    return 360 / (256 * 2 ** zoom) * np.cos(np.radians(lat))
+
+
+@metrics.timed('live_map')
+def live_map(feed, simplify = True, tiled = False, batched = True) -> folium.Map:
 
     """takes a feed and creates an interactive map, returning the html map
-    to put into the dash app"""
+    to put into the dash app. with simplify the route lines use the stored
+    level of detail that can't be told apart from the full lines up to MAP_DETAIL_ZOOM.
+    with tiled the routes and stops aren't written into the html, the map loads
+    them from the tile endpoint in tiles.py as it is moved around. with batched all
+    routes are one GeoJSON layer and all stops another, instead of one folium object each"""
+
+    center = feed.center_pt()
 
     #initializing map
-    m = folium.Map(location= feed.center_pt(), zoom_start=12, tiles="Cartodb Positron")
+    m = folium.Map(location= center, zoom_start=12, tiles="Cartodb Positron")
+
+    #routes and stops come from the tile server
+    if tiled:
+        GeoJsonTileLayer(tile_url(feed)).add_to(m)
+        return m
 
-    #generating departure info (takes some time)
+    #level of detail for the route lines
+    tolerance = feed.lod_tolerance(degrees_per_pixel(MAP_DETAIL_ZOOM, center[0])) if simplify else None
+
+    #generating departure info for the stop pop ups
     departures = feed.departure_info()
 
+    routes = feed.trips_shapes_routes(tolerance)
+
+    #selecting only the stop info we need, removing null stops and the simple stop types
+    stops = pd.read_sql(my_sql.map_stops_sql, feed.conn)
+
+    if batched:
+        add_route_layer(m, routes)
+        add_stop_layer(m, stops, departures)
+        return m
+
     #ploting each route line
-    for index,row in feed.trips_shapes_routes().iterrows():
+    for index,row in routes.iterrows():
 
         folium.PolyLine(row.shape_points.coords,
                         color= f'#{row.route_color}',
@@ -23,14 +62,6 @@ def live_map(feed) -> folium.Map:
                         opacity=1,
                         popup = f'Route: {row.route_short_name} - {row.route_long_name}'
                        ).add_to(m)
-        
-    #selecting only the stop info we need, removing null stops and the simple stop types
-    stop_sql = """ SELECT stop_id, location_type, stop_lat, stop_lon, stop_name
-            FROM stops
-            WHERE location_type IS NULL OR location_type == 0 OR location_type == 1
-            AND stop_lat NOT NULL AND stop_lon NOT NULL;"""
-
-    stops = pd.read_sql(stop_sql, feed.conn)
 
     #plot each stop
     for index, row in stops.iterrows():
@@ -52,3 +83,51 @@ def live_map(feed) -> folium.Map:
 
     return m
 
+
+def add_route_layer(m: folium.Map, routes: pd.DataFrame) -> None:
+    """adds every route line as one GeoJSON layer, colours and pop ups come from feature properties.
+    feeds without any route lines to draw get no layer"""
+    if routes.empty:
+        return None
+    features = route_features(routes, lonlat(routes['shape_points'].to_numpy()))
+
+    folium.GeoJson(
+        {'type': 'FeatureCollection', 'features': features},
+        name='Routes',
+        style_function=lambda feature: {
+            'color': f"#{feature['properties']['route_color']}",
+            'weight': 2.5,
+            'opacity': 1
+        },
+        popup=folium.GeoJsonPopup(fields=['popup'], labels=False)
+    ).add_to(m)
+    return None
+
+
+def add_stop_layer(m: folium.Map, stops: pd.DataFrame, departures) -> None:
+    """adds every stop as one GeoJSON layer of circle markers with the pop up text as a tooltip"""
+    stops = stops.dropna(subset=['stop_lat', 'stop_lon']).copy()
+    if stops.empty:
+        return None
+    stops['popup'] = stop_popups(stops, departures)
+
+    folium.GeoJson(
+        {'type': 'FeatureCollection', 'features': stop_features(stops)},
+        name='Stops',
+        marker=folium.CircleMarker(radius=2, fill=True, fill_color='white', fill_opacity=1,
+                                   color='black', weight=1),
+        tooltip=folium.GeoJsonTooltip(fields=['popup'], labels=False)
+    ).add_to(m)
+    return None
+
+
+@metrics.timed('map_html', size=len)
+def cached_map_html(gtfs_path: str) -> str:
+    """html of a feed's tiled map, from the render cache if the same feed files were mapped before"""
+    def render():
+        with open_feed(gtfs_path) as gtfs_feed:
+            return live_map(gtfs_feed, tiled=True).get_root().render()
+
+    #the tile urls in the page depend on where the feed is, not just what is in it
+    key = cache.render_cache.key(gtfs_path, 'tiled', os.path.normpath(gtfs_path))
+    return cache.render_cache.get('map', key, render)
@@ -0,0 +1,210 @@
+import os
+import re
+import glob
+import time
+import hashlib
+import atexit
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+
+from src import feed
+from src import metrics
+from src.cache import feed_hash, RENDER_VERSION
+
+#posters take seconds to minutes at full resolution, so they are rendered in worker processes
+#and the dash callback only gets back a job id to poll. finished posters are kept in
+#   data/outputs/posters/cache/<feed name>/<poster hash>_<map or frequency>_<dpi>.<png, svg or pdf>
+#so asking for the same poster again is answered straight from disk
+
+POSTER_CACHE_DIR = "data/outputs/posters/cache"
+POSTER_DPI = 500
+
+#worker processes rendering posters at once (GTFS_POSTER_WORKERS environment variable)
+DEFAULT_POSTER_WORKERS = 2
+
+#job ids are <feed name>/<poster hash>_<map or frequency>_<dpi>.<format>, the poster hash covers the
+#feed's files and cache.RENDER_VERSION
+JOB_ID_PATTERN = r'[\w-][\w.-]*/[0-9a-f]+_(map|frequency)_\d+\.(png|svg|pdf)'
+
+#finished jobs are forgotten after this many seconds (their posters stay cached on disk)
+JOB_TTL = 3600
+
+#a poster another server process is rendering whose temporary file hasn't been written to for this
+#many seconds is taken to have died with its worker
+STALE_RENDER_SECONDS = 1800
+
+
+def poster_job_id(gtfs_path: str, heatmap: bool, dpi: int, file_format: str = 'png') -> str:
+    """job id for the poster of a feed's current files with a heatmap choice, dpi and file format"""
+    name = os.path.basename(os.path.normpath(gtfs_path))
+    kind = 'frequency' if heatmap else 'map'
+    poster_hash = hashlib.blake2b(f"{feed_hash(gtfs_path)}|{RENDER_VERSION}".encode(), digest_size=16).hexdigest()
+    return f"{name}/{poster_hash}_{kind}_{dpi}.{file_format}"
+
+
+def poster_cache_file(job_id: str) -> str:
+    """where a job's poster is cached"""
+    return os.path.join(POSTER_CACHE_DIR, *job_id.split('/'))
+
+
+def poster_download_name(job_id: str) -> str:
+    """file name the poster is downloaded as (same names posters.map uses)"""
+    name, poster = job_id.split('/')
+    file_format = poster.rsplit('.', 1)[1]
+    return f"{name}_Frequency.{file_format}" if '_frequency_' in poster else f"{name}.{file_format}"
+
+
+def render_poster(gtfs_path: str, heatmap: bool, dpi: int, file_format: str, poster_file: str) -> str:
+    """renders one poster into poster_file, runs in a worker process. large pngs are drawn in strips
+    so several workers at full dpi don't each hold a whole page raster (see raster.py)"""
+    from src import posters
+    from src.raster import DEFAULT_STRIP_ROWS
+
+    #written to a temporary name first so a half written poster is never served. the file is made
+    #straight away so other server processes can see the poster is being rendered
+    temp_file = f"{poster_file}.{os.getpid()}.tmp"
+    os.makedirs(os.path.dirname(poster_file), exist_ok=True)
+    open(temp_file, 'wb').close()
+    try:
+        with feed.open_feed(gtfs_path) as gtfs_feed:
+            posters.map(gtfs_feed, Heatmap=heatmap, dpi=dpi, output_file=temp_file,
+                        file_format=file_format, strip_rows=DEFAULT_STRIP_ROWS)
+    except Exception:
+        try:
+            os.remove(temp_file)
+        except FileNotFoundError:
+            pass
+        raise
+    finally:
+        posters.plt.close('all')
+    os.replace(temp_file, poster_file)
+
+    #posters made from older versions of the feed's files are dropped
+    kind_dpi = os.path.basename(poster_file).split('_', 1)[1]
+    for old_file in os.listdir(os.path.dirname(poster_file)):
+        if old_file.endswith(kind_dpi) and old_file != os.path.basename(poster_file):
+            try:
+                os.remove(os.path.join(os.path.dirname(poster_file), old_file))
+            except FileNotFoundError:
+                pass
+
+    return poster_file
+
+
+def render_poster_job(gtfs_path: str, heatmap: bool, dpi: int, file_format: str, poster_file: str) -> tuple:
+    """render_poster for a worker process, also returns the spans timed in the worker so the
+    server's /metrics include them"""
+    return render_poster(gtfs_path, heatmap, dpi, file_format, poster_file), metrics.registry.drain()
+
+
+class PosterJobs:
+    """Queue of poster renders run in a pool of worker processes. submit returns a job id straight
+    away and status reports whether the poster is queued, rendering, done or failed. The job id is
+    the poster's path in the poster cache, so a poster that is already cached is done immediately,
+    asking for one that is being rendered joins the running job, and a job started by another
+    server process shows up as done once its file is written"""
+    def __init__(
+    self,
+    max_workers: int
+    ):
+        self.max_workers = max_workers
+
+        #started on the first render so importing this module stays cheap
+        self._pool = None
+
+        #job id -> (future of the render, time it was submitted)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, gtfs_path: str, heatmap: bool = True, dpi: int = POSTER_DPI, file_format: str = 'png') -> str:
+        """starts the render of a poster unless it is cached or already running, returns the job id"""
+        job_id = poster_job_id(gtfs_path, heatmap, dpi, file_format)
+        poster_file = poster_cache_file(job_id)
+
+        with self._lock:
+            self._forget_old_jobs()
+
+            job = self._jobs.get(job_id)
+            running = job is not None and not job[0].done()
+            if not running and not os.path.exists(poster_file):
+                try:
+                    future = self._worker_pool().submit(render_poster_job, gtfs_path, heatmap, dpi, file_format, poster_file)
+                except BrokenProcessPool:
+                    #a worker died (e.g. out of memory), the pool is started again
+                    self._pool = None
+                    future = self._worker_pool().submit(render_poster_job, gtfs_path, heatmap, dpi, file_format, poster_file)
+                future.add_done_callback(_merge_worker_metrics)
+                self._jobs[job_id] = (future, time.monotonic())
+        return job_id
+
+    def _worker_pool(self) -> ProcessPoolExecutor:
+        """the pool of worker processes, started if needed, lock must be held"""
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=get_context('spawn'))
+        return self._pool
+
+    def status(self, job_id: str) -> dict:
+        """state ('queued', 'rendering', 'done', 'failed' or 'unknown'), seconds since the render
+        was submitted, and the poster file or error message once the job is over"""
+        if not re.fullmatch(JOB_ID_PATTERN, job_id or ''):
+            return {'state': 'unknown', 'seconds': 0, 'file': None, 'error': None}
+        poster_file = poster_cache_file(job_id)
+
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            #cached, or being rendered by another server process (it has a temporary file that is
+            #still being written to), otherwise nothing is making it
+            if os.path.exists(poster_file):
+                return {'state': 'done', 'seconds': 0, 'file': poster_file, 'error': None}
+            state = 'rendering' if _rendering_elsewhere(poster_file) else 'unknown'
+            return {'state': state, 'seconds': 0, 'file': None, 'error': None}
+
+        future, submitted = job
+        seconds = round(time.monotonic() - submitted, 1)
+        if not future.done():
+            state = 'rendering' if future.running() else 'queued'
+            return {'state': state, 'seconds': seconds, 'file': None, 'error': None}
+        if future.exception() is not None:
+            return {'state': 'failed', 'seconds': seconds, 'file': None, 'error': str(future.exception())}
+        return {'state': 'done', 'seconds': seconds, 'file': future.result()[0], 'error': None}
+
+    def _forget_old_jobs(self) -> None:
+        """drops jobs that finished more than JOB_TTL seconds ago, lock must be held"""
+        now = time.monotonic()
+        for job_id in [job_id for job_id, (future, submitted) in self._jobs.items()
+                       if future.done() and now - submitted > JOB_TTL]:
+            del self._jobs[job_id]
+
+    def shutdown(self) -> None:
+        """stops the worker processes, waiting for renders in progress"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _rendering_elsewhere(poster_file: str) -> bool:
+    """whether some process has a recently written temporary file for the poster (see render_poster)"""
+    now = time.time()
+    for temp_file in glob.glob(f"{glob.escape(poster_file)}.*.tmp"):
+        try:
+            if now - os.path.getmtime(temp_file) < STALE_RENDER_SECONDS:
+                return True
+        except FileNotFoundError:
+            pass
+    return False
+
+
+def _merge_worker_metrics(future) -> None:
+    """adds a finished render's worker spans to this process's metrics"""
+    if not future.cancelled() and future.exception() is None:
+        metrics.registry.merge(future.result()[1])
+    return None
+
+
+#one queue for the whole process
+poster_jobs = PosterJobs(int(os.environ.get("GTFS_POSTER_WORKERS", DEFAULT_POSTER_WORKERS)))
+atexit.register(poster_jobs.shutdown)
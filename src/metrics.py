@@ -0,0 +1,262 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+
+#timing spans and row/byte counters for each stage of the feed pipeline, tagged by feed name.
+#functions are wrapped with @metrics.timed('stage'), other code can time a block with
+#   with metrics.span('stage', feed_name) as span:
+#       ...
+#       span.rows += n
+#totals are served in the prometheus text format at /metrics on the app's flask server, and with
+#GTFS_REQUEST_LOG=1 every request also logs one JSON line listing the spans it ran
+
+#upper bounds (seconds) of the span duration histogram buckets
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300)
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """One timed run of a stage, rows and bytes can be added to while it runs"""
+    def __init__(
+    self,
+    stage: str,
+    feed: str = ''
+    ):
+        self.stage = stage
+        self.feed = feed
+        self.rows = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.error = False
+
+    def as_dict(self) -> dict:
+        return {'stage': self.stage, 'feed': self.feed, 'seconds': round(self.seconds, 4),
+                'rows': self.rows, 'bytes': self.bytes, 'error': self.error}
+
+
+class Metrics:
+    """Process-wide totals of every finished span by (stage, feed): count, seconds (with histogram
+    buckets), rows, bytes and errors. Other modules can add gauges (e.g. cache stats) with add_collector"""
+    def __init__(
+    self
+    ):
+        #(stage, feed) -> {'count', 'seconds', 'rows', 'bytes', 'errors', 'buckets'}
+        self._totals = {}
+        #name -> function returning a dict of numbers
+        self._collectors = {}
+        self._lock = threading.Lock()
+        #spans finished by the request running in each thread
+        self._request = threading.local()
+
+    @contextmanager
+    def span(self, stage: str, feed: str = ''):
+        """times the body of a with block as one span of stage"""
+        span = Span(stage, feed)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException:
+            span.error = True
+            raise
+        finally:
+            span.seconds = time.perf_counter() - start
+            self.record(span)
+
+    def record(self, span: Span) -> None:
+        """adds a finished span to the totals (and to the current request's spans)"""
+        with self._lock:
+            total = self._totals.setdefault((span.stage, span.feed), _empty_total())
+            _add(total, 1, span.seconds, span.rows, span.bytes, int(span.error),
+                 [int(span.seconds <= bound) for bound in SECONDS_BUCKETS])
+        spans = getattr(self._request, 'spans', None)
+        if spans is not None:
+            spans.append(span)
+        return None
+
+    def start_request(self) -> None:
+        """starts collecting the spans finished in this thread"""
+        self._request.spans = []
+        return None
+
+    def finish_request(self) -> list:
+        """stops collecting and returns the spans finished in this thread since start_request"""
+        spans = getattr(self._request, 'spans', None) or []
+        self._request.spans = None
+        return spans
+
+    def drain(self) -> dict:
+        """returns the totals and starts them over, for sending a worker process's spans to the server"""
+        with self._lock:
+            totals, self._totals = self._totals, {}
+        return totals
+
+    def merge(self, totals: dict) -> None:
+        """adds totals from drain() (e.g. from a worker process) to this process's totals"""
+        with self._lock:
+            for key, other in totals.items():
+                total = self._totals.setdefault(key, _empty_total())
+                _add(total, other['count'], other['seconds'], other['rows'], other['bytes'],
+                     other['errors'], other['buckets'])
+        return None
+
+    def add_collector(self, name: str, collect) -> None:
+        """exports the numbers in the dict collect() returns as gtfs_<name>_<key> gauges"""
+        with self._lock:
+            self._collectors[name] = collect
+        return None
+
+    def snapshot(self) -> dict:
+        """copy of the span totals"""
+        with self._lock:
+            return {key: {**total, 'buckets': list(total['buckets'])} for key, total in self._totals.items()}
+
+    def render(self) -> str:
+        """every total and collected gauge in the prometheus text exposition format"""
+        totals = sorted(self.snapshot().items())
+        lines = [
+            "# HELP gtfs_stage_seconds Time spent in each stage of the feed pipeline",
+            "# TYPE gtfs_stage_seconds histogram"
+        ]
+        for (stage, feed), total in totals:
+            labels = _labels(stage=stage, feed=feed)
+            for bound, count in zip(SECONDS_BUCKETS, total['buckets']):
+                lines.append(f'gtfs_stage_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'gtfs_stage_seconds_bucket{{{labels},le="+Inf"}} {total["count"]}')
+            lines.append(f'gtfs_stage_seconds_sum{{{labels}}} {total["seconds"]:.6f}')
+            lines.append(f'gtfs_stage_seconds_count{{{labels}}} {total["count"]}')
+
+        for name, key, help_text in [('rows', 'rows', "Rows handled by each stage"),
+                                     ('bytes', 'bytes', "Bytes read or written by each stage"),
+                                     ('errors', 'errors', "Runs of each stage that raised an error")]:
+            lines.append(f"# HELP gtfs_stage_{name}_total {help_text}")
+            lines.append(f"# TYPE gtfs_stage_{name}_total counter")
+            for (stage, feed), total in totals:
+                lines.append(f'gtfs_stage_{name}_total{{{_labels(stage=stage, feed=feed)}}} {total[key]}')
+
+        with self._lock:
+            collectors = sorted(self._collectors.items())
+        for name, collect in collectors:
+            for key, value in sorted(collect().items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    metric = re.sub(r'[^a-zA-Z0-9_]', '_', f"gtfs_{name}_{key}")
+                    lines.append(f"# TYPE {metric} gauge")
+                    lines.append(f"{metric} {value}")
+
+        return '\n'.join(lines) + '\n'
+
+
+def _empty_total() -> dict:
+    return {'count': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0, 'errors': 0, 'buckets': [0] * len(SECONDS_BUCKETS)}
+
+
+def _add(total: dict, count: int, seconds: float, rows: int, size: int, errors: int, buckets: list) -> None:
+    """adds counts to one (stage, feed) total, lock must be held"""
+    total['count'] += count
+    total['seconds'] += seconds
+    total['rows'] += int(rows)
+    total['bytes'] += int(size)
+    total['errors'] += errors
+    total['buckets'] = [a + b for a, b in zip(total['buckets'], buckets)]
+    return None
+
+
+def _labels(**labels) -> str:
+    """prometheus label list with backslashes, quotes and newlines escaped"""
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{name}="{escape(value)}"' for name, value in labels.items())
+
+
+def feed_label(source) -> str:
+    """feed name for a span: a Feed's name, or the folder name of a gtfs path"""
+    name = getattr(source, 'name', None)
+    if isinstance(name, str):
+        return name
+    if isinstance(source, str):
+        return os.path.basename(os.path.normpath(source))
+    return ''
+
+
+#one set of totals per process
+registry = Metrics()
+
+
+def span(stage: str, feed: str = ''):
+    """times a with block as a span of stage in the process's registry"""
+    return registry.span(stage, feed)
+
+
+def timed(stage: str, rows=None, size=None):
+    """decorator recording a span of stage around every call. the feed label comes from the first
+    argument (a Feed, or a gtfs path), rows and size are optional functions of the return value"""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with registry.span(stage) as run:
+                try:
+                    result = function(*args, **kwargs)
+                    if rows is not None:
+                        run.rows = rows(result)
+                    if size is not None:
+                        run.bytes = size(result)
+                    return result
+                finally:
+                    #read afterwards so Feed.__init__ is labelled with the name it just set
+                    run.feed = feed_label(args[0]) if args else ''
+        return wrapper
+    return decorate
+
+
+def register_metrics_routes(server) -> None:
+    """adds /metrics to the dash app's flask server, times every request as a span of its url
+    rule (with the response size), and logs one JSON line per request if GTFS_REQUEST_LOG is set"""
+    from flask import Response, request, g
+
+    log_requests = os.environ.get("GTFS_REQUEST_LOG", "").lower() not in ("", "0", "false", "no")
+    if log_requests and not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+
+    @server.before_request
+    def start_request_timer():
+        g.metrics_start = time.perf_counter()
+        registry.start_request()
+
+    @server.after_request
+    def record_request(response):
+        spans = registry.finish_request()
+        if request.path == '/metrics' or 'metrics_start' not in g:
+            return response
+
+        #tiles and other routes with the feed in the url are labelled with it
+        rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        run = Span(f"http {rule}", (request.view_args or {}).get('feed_name', ''))
+        run.seconds = time.perf_counter() - g.metrics_start
+        run.bytes = response.calculate_content_length() or 0
+        run.error = response.status_code >= 500
+        registry.record(run)
+
+        if log_requests:
+            logger.info(json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'seconds': round(run.seconds, 4),
+                'bytes': run.bytes,
+                'spans': [finished.as_dict() for finished in spans]
+            }))
+        return response
+
+    @server.route("/metrics")
+    def serve_metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    return None
@@ -86,6 +86,8 @@ build_tables = [
                 trip_id TEXT,
                 arrival_time TEXT,
                 departure_time TEXT,
+                arrival_secs INTEGER,
+                departure_secs INTEGER,
                 stop_id TEXT,
                 location_id TEXT,
                 stop_sequence INTEGER,
@@ -106,9 +108,10 @@ build_tables = [
         );""",
     
         """CREATE TABLE IF NOT EXISTS calendar_dates (
-                service_id TEXT PRIMARY KEY, 
+                service_id TEXT, 
                 date DATE,
                 exception_type INTEGER, 
+                PRIMARY KEY (service_id, date),
                 FOREIGN KEY (service_id) REFERENCES calendar (service_id)
 
         );""" ,
@@ -144,24 +147,378 @@ build_tables = [
 
 ]
 
-#SQL statement to get hourly frequency by route
-route_freq_sql = """SELECT 
+#feed tables loaded from the GTFS text files, in load order
+feed_tables = ['agency', 'stops', 'shapes', 'routes', 'calendar', 'calendar_dates', 'trips', 'stop_times']
+
+#columns that identify a row of each feed table, used to match old and new rows when a feed is updated
+table_keys = {
+    'agency': ('agency_id',),
+    'stops': ('stop_id',),
+    'shapes': ('shape_id', 'shape_pt_sequence'),
+    'routes': ('route_id',),
+    'calendar': ('service_id',),
+    'calendar_dates': ('service_id', 'date'),
+    'trips': ('trip_id',),
+    'stop_times': ('trip_id', 'stop_sequence')
+}
+
+#columns filled in while loading a file instead of read from it: GTFS times (H:MM:SS, past 24:00:00
+#for trips after midnight) parsed once into seconds after midnight, keyed by the text column
+seconds_columns = {
+    'stop_times': {'arrival_time': 'arrival_secs', 'departure_time': 'departure_secs'}
+}
+
+#indexes are built after the data is loaded so inserts don't have to maintain them.
+#every join/filter column on a large table used in feed.py, posters.py and interactive_maps.py
+#should be covered here, python -m src.query_plan checks the queries below against them
+build_indexes = [
+    #stop_times -> trips join and lookups by stop
+    "CREATE INDEX IF NOT EXISTS idx_stop_times_trip_id ON stop_times (trip_id, stop_sequence);",
+    "CREATE INDEX IF NOT EXISTS idx_stop_times_stop_id ON stop_times (stop_id);",
+    #shape points in order for each shape
+    "CREATE INDEX IF NOT EXISTS idx_shapes_shape_id ON shapes (shape_id, shape_pt_sequence);",
+    #trips by route, covers the distinct route/shape pairs stored in route_shapes
+    "CREATE INDEX IF NOT EXISTS idx_trips_route_shape ON trips (route_id, shape_id);",
+    "CREATE INDEX IF NOT EXISTS idx_trips_shape_id ON trips (shape_id);"
+]
+
+#PRAGMAs for bulk loading a new database (no rollback journal or fsync while inserting)
+load_pragmas = [
+    "PRAGMA journal_mode = MEMORY;",
+    "PRAGMA synchronous = OFF;",
+    "PRAGMA cache_size = -65536;"
+]
+
+#PRAGMAs to go back to the sqlite defaults once the load is finished
+restore_pragmas = [
+    "PRAGMA journal_mode = DELETE;",
+    "PRAGMA synchronous = FULL;",
+    "PRAGMA cache_size = -2000;"
+]
+
+#tables in the database, and whether one exists
+table_names_sql = """SELECT name FROM sqlite_master WHERE type='table';"""
+
+table_exists_sql = """SELECT name FROM sqlite_master WHERE type='table' AND name = ?;"""
+
+#statements run on any feed table, filled in with str.format (table names can't be bound as parameters)
+table_info_sql = """PRAGMA table_info({table});"""
+
+insert_rows_sql = """INSERT INTO {table} ({columns}) VALUES ({placeholders});"""
+
+table_has_rows_sql = """SELECT 1 FROM {table} LIMIT 1;"""
+
+drop_table_sql = """DROP TABLE IF EXISTS {table};"""
+
+delete_rows_sql = """DELETE FROM {table};"""
+
+#filling in the seconds columns of databases built before them
+add_column_sql = """ALTER TABLE {table} ADD COLUMN {column} INTEGER;"""
+
+select_rowid_columns_sql = """SELECT rowid, {columns} FROM {table};"""
+
+update_rowid_sql = """UPDATE {table} SET {assignments} WHERE rowid = ?;"""
+
+#applying a changed file to its table as row changes: the file is loaded into temp.incoming, rows
+#that aren't in the table go into temp.changed and {match} pairs up rows of two tables on table_keys
+drop_update_tables = [
+    "DROP TABLE IF EXISTS temp.incoming;",
+    "DROP TABLE IF EXISTS temp.changed;"
+]
+
+create_incoming_sql = """CREATE TEMP TABLE incoming AS SELECT * FROM {table} WHERE 0;"""
+
+index_incoming_sql = """CREATE INDEX temp.idx_incoming ON incoming ({keys});"""
+
+create_changed_sql = """CREATE TEMP TABLE changed AS SELECT * FROM incoming EXCEPT SELECT * FROM {table};"""
+
+#rows whose key is gone from the file
+delete_gone_rows_sql = """DELETE FROM {table} WHERE rowid IN (
+        SELECT {table}.rowid FROM {table} LEFT JOIN incoming ON {match}
+        WHERE incoming.rowid IS NULL);"""
+
+#old versions of changed rows, then the new versions
+delete_changed_rows_sql = """DELETE FROM {table} WHERE rowid IN (
+        SELECT {table}.rowid FROM changed JOIN {table} ON {match});"""
+
+insert_changed_rows_sql = """INSERT INTO {table} SELECT * FROM changed;"""
+
+#version of the derived tables below, bump it whenever they change so older databases rebuild them
+AGGREGATES_VERSION = 6
+
+#versions and file hashes the database was built from
+feed_meta_sql = """CREATE TABLE IF NOT EXISTS feed_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );"""
+
+#a value in feed_meta: file_hash:<table>, source_hash, aggregates_version or center (a JSON [lat, lon])
+feed_meta_value_sql = """SELECT value FROM feed_meta WHERE key = ?;"""
+
+set_feed_meta_sql = """INSERT OR REPLACE INTO feed_meta (key, value) VALUES (?, ?);"""
+
+#hash of the file each feed table was last loaded from
+file_hashes_sql = """SELECT key, value FROM feed_meta WHERE key LIKE 'file_hash:%';"""
+
+#derived tables built once from stop_times when the database is created
+build_aggregate_tables = [
+    feed_meta_sql,
+
+    #departures at each stop per service, timed counts the ones with a departure time.
+    #a day's stats add up the rows of the services running that day
+    """CREATE TABLE IF NOT EXISTS stop_departures (
+            stop_id TEXT,
+            service_id TEXT,
+            departures INTEGER,
+            timed INTEGER,
+            first INTEGER,
+            last INTEGER,
+            PRIMARY KEY (stop_id, service_id)
+        );""",
+
+    """CREATE TABLE IF NOT EXISTS route_hour_trips (
+            route_id TEXT,
+            service_id TEXT,
+            hour INTEGER,
+            trip_count INTEGER,
+            PRIMARY KEY (route_id, service_id, hour)
+        );""",
+
+    #the distinct route and shape pairs of trips, so maps don't go through trips for them
+    """CREATE TABLE IF NOT EXISTS route_shapes (
+            route_id TEXT,
+            shape_id TEXT,
+            PRIMARY KEY (route_id, shape_id)
+        );""",
+
+    #every service id in the feed, service_index is its bit in service_days.services
+    """CREATE TABLE IF NOT EXISTS services (
+            service_index INTEGER PRIMARY KEY,
+            service_id TEXT
+        );""",
+
+    #the services running on each date (YYYYMMDD) covered by calendar and calendar_dates, as a
+    #bitmap packed with numpy.packbits. weekday is 0 for monday, trips is the trips run that day
+    """CREATE TABLE IF NOT EXISTS service_days (
+            date TEXT PRIMARY KEY,
+            weekday INTEGER,
+            trips INTEGER,
+            services BLOB
+        );""",
+
+    #coords holds the shape's (lat, lon) points in sequence order packed as float64,
+    #digest is a hash of the points that is the same whichever direction the line is drawn in
+    """CREATE TABLE IF NOT EXISTS shape_geoms (
+            shape_id TEXT PRIMARY KEY,
+            n_points INTEGER,
+            coords BLOB,
+            digest BLOB
+        );""",
+
+    #simplified copies of shape_geoms at each tolerance in feed.LOD_TOLERANCES, keyed by
+    #tolerance first since they are read one tolerance at a time
+    """CREATE TABLE IF NOT EXISTS shape_lods (
+            tolerance FLOAT,
+            shape_id TEXT,
+            n_points INTEGER,
+            coords BLOB,
+            PRIMARY KEY (tolerance, shape_id)
+        );"""
+]
+
+drop_aggregate_tables = [
+    "DROP TABLE IF EXISTS stop_departures;",
+    "DROP TABLE IF EXISTS route_hour_trips;",
+    "DROP TABLE IF EXISTS route_shapes;",
+    "DROP TABLE IF EXISTS services;",
+    "DROP TABLE IF EXISTS service_days;",
+    "DROP TABLE IF EXISTS shape_geoms;",
+    "DROP TABLE IF EXISTS shape_lods;"
+]
+
+#feed tables each derived table is computed from, an update only rebuilds the derived
+#tables whose sources changed (shape_geoms also covers shape_lods, center is the center
+#stored in feed_meta)
+aggregate_sources = {
+    'stop_departures': ('stop_times', 'trips'),
+    'route_hour_trips': ('stop_times', 'trips'),
+    'route_shapes': ('trips',),
+    'shape_geoms': ('shapes',),
+    'service_days': ('calendar', 'calendar_dates', 'trips'),
+    'center': ('shapes', 'stops')
+}
+
+#number of rows in stop_departures, for ingest_stats
+stop_departures_count_sql = """SELECT COUNT(*) FROM stop_departures;"""
+
+#SQL statement to store the route and shape pairs of trips
+route_shapes_sql = """INSERT INTO route_shapes (route_id, shape_id)
+    SELECT DISTINCT route_id, shape_id
+    FROM trips
+    WHERE route_id IS NOT NULL AND shape_id IS NOT NULL;"""
+
+#SQL statement to count stop_times by route, service and hour of arrival
+route_hour_trips_sql = """INSERT INTO route_hour_trips (route_id, service_id, hour, trip_count)
+    SELECT 
         trips.route_id,
-        CAST(SUBSTR(arrival_time, 1, 2) AS INTEGER) AS hour,
+        trips.service_id,
+        arrival_secs / 3600 AS hour,
         COUNT(*) AS trip_count
     FROM stop_times
     JOIN trips ON stop_times.trip_id = trips.trip_id
-    WHERE arrival_time IS NOT NULL
-      AND CAST(SUBSTR(arrival_time, 1, 2) AS INTEGER) BETWEEN 8 AND 20
-      AND trips.route_id IN (
+    WHERE arrival_secs IS NOT NULL
+    GROUP BY trips.route_id, trips.service_id, hour;"""
+
+#queries that take a service day take :services, a JSON list of the service ids running
+#that day, or NULL to count every service
+
+#SQL statement to get hourly frequency for the top 10 routes from 8am to 8pm on a service day
+route_freq_sql = """WITH day_trips AS (
+        SELECT route_id, hour, SUM(trip_count) AS trip_count
+        FROM route_hour_trips
+        WHERE hour BETWEEN 8 AND 20
+          AND (:services IS NULL OR service_id IN (SELECT value FROM json_each(:services)))
+        GROUP BY route_id, hour
+    )
+    SELECT 
+        route_id,
+        hour,
+        trip_count
+    FROM day_trips
+    WHERE route_id IN (
           SELECT route_id
-          FROM stop_times
-          JOIN trips ON stop_times.trip_id = trips.trip_id
-          WHERE arrival_time IS NOT NULL
-            AND CAST(SUBSTR(arrival_time, 1, 2) AS INTEGER) BETWEEN 8 AND 20
+          FROM day_trips
           GROUP BY route_id
-          ORDER BY COUNT(*) DESC
+          ORDER BY SUM(trip_count) DESC
           LIMIT 10
       )
-    GROUP BY trips.route_id, hour
-    ORDER BY trips.route_id, hour;"""
\ No newline at end of file
+    ORDER BY route_id, hour;"""
+
+#calendar rows and exceptions for building service_days
+calendar_sql = """SELECT service_id, monday, tuesday, wednesday, thursday, friday, saturday, sunday,
+        start_date, end_date
+    FROM calendar;"""
+
+calendar_dates_sql = """SELECT service_id, date, exception_type FROM calendar_dates;"""
+
+#trips run by each service
+service_trips_sql = """SELECT service_id, COUNT(*) AS trips FROM trips WHERE service_id IS NOT NULL GROUP BY service_id;"""
+
+#stored service ids and bitmaps of the services running on each date
+services_sql = """SELECT service_id FROM services ORDER BY service_index;"""
+
+service_days_sql = """SELECT date, weekday, trips, services FROM service_days ORDER BY date;"""
+
+insert_services_sql = """INSERT INTO services (service_index, service_id) VALUES (?, ?);"""
+
+insert_service_days_sql = """INSERT INTO service_days (date, weekday, trips, services) VALUES (?, ?, ?, ?);"""
+
+#shape points in drawing order (shape_pt_sequence isn't always sorted in shapes.txt)
+shape_points_sql = """SELECT shape_id, shape_pt_lat, shape_pt_lon
+    FROM shapes
+    WHERE shape_pt_lat IS NOT NULL AND shape_pt_lon IS NOT NULL
+    ORDER BY shape_id, shape_pt_sequence;"""
+
+insert_shape_geoms_sql = """INSERT INTO shape_geoms (shape_id, n_points, coords, digest) VALUES (?, ?, ?, ?);"""
+
+insert_shape_lods_sql = """INSERT INTO shape_lods (tolerance, shape_id, n_points, coords) VALUES (?, ?, ?, ?);"""
+
+#center of the transit network stored in feed_meta: the average shape point, or the average stop
+#for feeds without shapes
+shapes_center_sql = """SELECT AVG(shape_pt_lat), AVG(shape_pt_lon) FROM shapes;"""
+
+stops_center_sql = """SELECT AVG(stop_lat), AVG(stop_lon) FROM stops;"""
+
+#stored shape geometries
+shape_geoms_sql = """SELECT shape_id, n_points, coords FROM shape_geoms ORDER BY shape_id;"""
+
+#stored shape geometries simplified to one tolerance
+shape_lods_sql = """SELECT shape_id, n_points, coords FROM shape_lods WHERE tolerance = ? ORDER BY shape_id;"""
+
+#departure stats for every stop on a service day, adding up the stored stats of the services running
+#that day. the average gap between sorted departures is (last - first) / (departures - 1)
+stop_departures_table_sql = """SELECT 
+        stop_id,
+        SUM(departures) AS departures,
+        MIN(first) AS first,
+        MAX(last) AS last,
+        CASE WHEN SUM(timed) < 2 THEN NULL ELSE (MAX(last) - MIN(first)) * 1.0 / (SUM(timed) - 1) END AS headway
+    FROM stop_departures
+    WHERE :services IS NULL OR service_id IN (SELECT value FROM json_each(:services))
+    GROUP BY stop_id;"""
+
+#departure times and service at every stop for departure_info
+stop_departures_sql = """SELECT stop_times.stop_id, trips.service_id, stop_times.departure_secs
+    FROM stop_times
+    JOIN trips ON stop_times.trip_id = trips.trip_id;"""
+
+#route and service of every trip, for grouping stop_times' arrays
+trip_groups_sql = """SELECT trip_id, route_id, service_id FROM trips;"""
+
+#each route and shape pair with the route's display info (white routes drawn in black) 
+#and the shape's geometry digest for removing duplicate lines (NULL for shapes without stored points)
+trips_shapes_routes_sql = """SELECT
+        route_shapes.route_id,
+        route_shapes.shape_id,
+        routes.route_long_name,
+        routes.route_short_name,
+        CASE 
+            WHEN LOWER(routes.route_color) = 'ffffff' THEN '000000'
+            ELSE routes.route_color
+        END AS route_color,
+        shape_geoms.digest
+    FROM routes
+    JOIN route_shapes ON route_shapes.route_id = routes.route_id
+    LEFT JOIN shape_geoms ON shape_geoms.shape_id = route_shapes.shape_id
+    WHERE routes.route_color IS NOT NULL;"""
+
+#stops for the interactive map: removing null stops and only the simple stop types
+map_stops_sql = """SELECT stop_id, location_type, stop_lat, stop_lon, stop_name
+    FROM stops
+    WHERE location_type IS NULL OR location_type == 0 OR location_type == 1
+    AND stop_lat NOT NULL AND stop_lon NOT NULL;"""
+
+#stops for the poster: only the simple stop types
+poster_stops_sql = """SELECT stop_id, location_type, stop_lat, stop_lon
+    FROM stops
+    WHERE location_type IS NULL OR location_type == 0 OR location_type == 1;"""
+
+#poster legend: route names that are not duplicated and have color
+legend_routes_sql = """SELECT route_long_name, 
+        MIN(route_short_name) AS route_short_name, 
+        MIN(
+            CASE 
+                WHEN LOWER(route_color) = 'ffffff' THEN '000000'
+                ELSE route_color
+            END
+        ) AS route_color
+    FROM routes 
+    WHERE route_color IS NOT NULL
+    GROUP BY route_long_name;"""
+
+#queries run when serving a map, heatmap or poster. these shouldn't scan a large table
+request_queries = {
+    'trips_shapes_routes': trips_shapes_routes_sql,
+    'map_stops': map_stops_sql,
+    'poster_stops': poster_stops_sql,
+    'legend_routes': legend_routes_sql,
+    'route_freq': route_freq_sql,
+    'stop_departures': stop_departures_table_sql,
+    'shape_geoms': shape_geoms_sql,
+    'shape_lods': shape_lods_sql,
+    'service_days': service_days_sql,
+    'feed_meta_value': feed_meta_value_sql,
+    'file_hashes': file_hashes_sql
+}
+
+#queries only run once while building the database, where reading all of stop_times is expected
+build_queries = {
+    'departure_stats': stop_departures_sql,
+    'trip_groups': trip_groups_sql,
+    'route_hour_trips': route_hour_trips_sql,
+    'route_shapes': route_shapes_sql,
+    'shape_points': shape_points_sql,
+    'service_trips': service_trips_sql,
+    'shapes_center': shapes_center_sql,
+    'stops_center': stops_center_sql
+}
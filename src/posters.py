@@ -3,7 +3,11 @@ import importlib
 import numpy as np
 from matplotlib.patches import Rectangle
 from matplotlib.gridspec import GridSpec
+from matplotlib.collections import LineCollection
 from src.feed import *
+from src import my_sql
+from src import raster
+from src import metrics
 importlib.reload(feed)
 import numpy as np
 from shapely.ops import unary_union
@@ -19,13 +23,26 @@ warnings.filterwarnings('ignore')
 
 from pathlib import Path
 
+#file types a poster can be saved as, svg and pdf keep the map as vectors
+POSTER_FORMATS = ('png', 'svg', 'pdf')
 
-def map(feed, Heatmap = True, user_data = False)-> str:
+
+@metrics.timed('poster', size=lambda poster_file: Path(poster_file).stat().st_size)
+def map(feed, Heatmap = True, user_data = False, dpi = 500, simplify = True, vectorized = True, output_file = None,
+        file_format = 'png', strip_rows = None)-> str:
 
     fontpath = Path('fonts/Helvetica.ttf')  # Adjust path as needed
     
     """Makes 11x17 poster with map, route legend, and an optional heatmap. 
-    saves poster in outputs folder and returns the name of the file"""
+    saves poster in outputs folder and returns the name of the file. with simplify
+    the route lines use the stored level of detail that is smaller than a pixel at dpi.
+    with vectorized all routes are drawn as one LineCollection and all stops as one scatter
+    instead of one matplotlib artist each. output_file saves the poster there instead
+    of the outputs folder. file_format is one of POSTER_FORMATS, with strip_rows a png is
+    drawn and written that many pixel rows at a time instead of as one raster"""
+
+    if file_format not in POSTER_FORMATS:
+        raise ValueError(f"poster format must be one of {', '.join(POSTER_FORMATS)}, not {file_format!r}")
 
     # Set up the plot
     fig = plt.figure(figsize=(11, 17))
@@ -35,8 +52,20 @@ def map(feed, Heatmap = True, user_data = False)-> str:
     ax = fig.add_subplot(gs[0])   #Map
     # ax2 = fig.add_subplot(gs[1]) #Heat Map
     
-    #setting extent of axis
-    minx, miny, maxx, maxy = unary_union(feed.trips_shapes_routes()['shape_points']).bounds
+    #route shapes are used for the extent and the route lines
+    shapes_routes = feed.trips_shapes_routes()
+
+    #selecting only the stop info we need and the simple stop types
+    stops = pd.read_sql(my_sql.poster_stops_sql, feed.conn)
+
+    #setting extent of axis, from the stops for feeds without any route lines to draw
+    if len(shapes_routes):
+        minx, miny, maxx, maxy = unary_union(shapes_routes['shape_points']).bounds
+    elif len(stops):
+        minx, maxx = stops['stop_lat'].min(), stops['stop_lat'].max()
+        miny, maxy = stops['stop_lon'].min(), stops['stop_lon'].max()
+    else:
+        raise ValueError(f"{feed.name} has no route shapes or stops to draw")
     extent = [minx - 0.001, maxx + 0.001, miny - 0.001, maxy + 0.001]
     ax.axis(extent)
     
@@ -56,9 +85,19 @@ def map(feed, Heatmap = True, user_data = False)-> str:
     
     #map position relative to figure (adding margin)
     ax.set_position([0.01, 0.01, .99, .99])  # Left, bottom, width, height
+
+    #swapping in simplified lines when the detail lost is smaller than a pixel on the saved poster
+    if simplify:
+        bbox = ax.get_position()
+        width_px = bbox.width * fig.get_figwidth() * dpi
+        height_px = bbox.height * fig.get_figheight() * dpi
+        units_per_pixel = min((extent[1] - extent[0]) / width_px, (extent[3] - extent[2]) / height_px)
+        tolerance = feed.lod_tolerance(units_per_pixel)
+        if tolerance is not None:
+            shapes_routes = feed.trips_shapes_routes(tolerance)
     
     #set linewidth and stop size based on number of routes
-    n_routes = len(feed.routes())
+    n_routes = len(feed.routes(['route_id']))
 
     if  n_routes <= 20:
         linewidth = 2.5
@@ -74,29 +113,25 @@ def map(feed, Heatmap = True, user_data = False)-> str:
         edge = 1
 
 
-    for index, row in feed.trips_shapes_routes().iterrows():
-        line = row['shape_points']
-        x, y = line.xy  
-        ax.plot(x, y,
-                linewidth=linewidth,
-                color=f"#{row['route_color']}")
-
-    #plot each stop 
-    
-    #selecting only the stop info we need and the simple stop types
-    stop_sql = """ SELECT stop_id, location_type, stop_lat, stop_lon
-            FROM stops
-            WHERE location_type IS NULL OR location_type == 0 OR location_type == 1;"""
-
-    stops = pd.read_sql(stop_sql, feed.conn)
-
-    for index,row in stops.iterrows():
-        x, y = row.stop_lat, row.stop_lon
-        ax.plot(x, y, marker="o", color="black", 
-            markerfacecolor="white",
-            markeredgecolor="black",
-            markeredgewidth = edge,
-            markersize = stop_size)
+    if vectorized:
+        draw_routes(ax, shapes_routes, linewidth)
+        draw_stops(ax, stops, stop_size, edge)
+    else:
+        for index, row in shapes_routes.iterrows():
+            line = row['shape_points']
+            x, y = line.xy  
+            ax.plot(x, y,
+                    linewidth=linewidth,
+                    color=f"#{row['route_color']}")
+
+        #plot each stop 
+        for index,row in stops.iterrows():
+            x, y = row.stop_lat, row.stop_lon
+            ax.plot(x, y, marker="o", color="black", 
+                markerfacecolor="white",
+                markeredgecolor="black",
+                markeredgewidth = edge,
+                markersize = stop_size)
 
     #Creating Legend
     
@@ -117,19 +152,7 @@ def map(feed, Heatmap = True, user_data = False)-> str:
    
     #Making Legend Entries
         #Route Names that are not duplicated and have color
-    route_sql = """ SELECT route_long_name, 
-                            MIN(route_short_name) AS route_short_name, 
-                            MIN(
-                                CASE 
-                                    WHEN LOWER(route_color) = 'ffffff' THEN '000000'
-                                    ELSE route_color
-                                END
-                            ) AS route_color
-                        FROM routes 
-                        WHERE route_color IS NOT NULL
-                        GROUP BY route_long_name;"""
-    
-    legend_entries = pd.read_sql(route_sql, feed.conn)
+    legend_entries = pd.read_sql(my_sql.legend_routes_sql, feed.conn)
 
     #limiting the number of entries in the legend 
     if len(legend_entries) > 25:
@@ -204,8 +227,9 @@ def map(feed, Heatmap = True, user_data = False)-> str:
             poster_file = f'data/outputs/posters/user_uploaded/{feed.name}_Frequency.png'
 
         ax2 = fig.add_subplot(gs[1])
+        route_freq = feed.route_freq()
         
-        cax = ax2.imshow(feed.route_freq().values,  cmap='Reds')
+        cax = ax2.imshow(route_freq.values,  cmap='Reds')
         ax2.set_aspect(.8) 
 
         hours = list(range(8, 21))
@@ -213,8 +237,8 @@ def map(feed, Heatmap = True, user_data = False)-> str:
         # Set axis ticks
         ax2.set_xticks(np.arange(len(hours)))
         ax2.set_xticklabels(hours)
-        ax2.set_yticks(np.arange(len(feed.route_freq().index)))
-        ax2.set_yticklabels(feed.route_freq().index)
+        ax2.set_yticks(np.arange(len(route_freq.index)))
+        ax2.set_yticklabels(route_freq.index)
 
         # axis labels
         ax2.set_xlabel("Hour (8am - 8pm)", fontsize=12, font = fontpath)
@@ -222,7 +246,7 @@ def map(feed, Heatmap = True, user_data = False)-> str:
 
         # Remove gridlines
         ax2.set_xticks(np.arange(len(hours) + 1) - 0.5, minor=True)
-        ax2.set_yticks(np.arange(len(feed.route_freq().index) + 1) - 0.5, minor=True)
+        ax2.set_yticks(np.arange(len(route_freq.index) + 1) - 0.5, minor=True)
 
         # Whitespace between cells
         ax2.grid(which='minor', color= '#f0f0f0', linestyle='-', linewidth=1)
@@ -262,6 +286,42 @@ def map(feed, Heatmap = True, user_data = False)-> str:
         
         
 
-    plt.savefig(poster_file, dpi = 500, bbox_inches='tight', pad_inches=0.25)
+    if output_file is not None:
+        poster_file = output_file
+    elif file_format != 'png':
+        poster_file = poster_file.replace('.png', f'.{file_format}')
+
+    if file_format == 'png' and strip_rows:
+        raster.save_in_strips(fig, poster_file, dpi, pad_inches=0.25, strip_rows=strip_rows)
+    else:
+        plt.savefig(poster_file, format = file_format, dpi = dpi, bbox_inches='tight', pad_inches=0.25)
     
-    return poster_file
\ No newline at end of file
+    return poster_file
+
+def draw_routes(ax, shapes_routes: pd.DataFrame, linewidth: float) -> None:
+    """draws every route line as one LineCollection, styled like ax.plot lines"""
+    segments = [np.asarray(line.coords) for line in shapes_routes['shape_points']]
+    colors = ('#' + shapes_routes['route_color']).tolist()
+
+    #caps, joins and zorder match the Line2D defaults so the poster looks the same
+    ax.add_collection(LineCollection(segments,
+                                     colors=colors,
+                                     linewidths=linewidth,
+                                     capstyle=matplotlib.rcParams['lines.solid_capstyle'],
+                                     joinstyle=matplotlib.rcParams['lines.solid_joinstyle'],
+                                     zorder=2),
+                      autolim=False)
+    return None
+
+
+def draw_stops(ax, stops: pd.DataFrame, stop_size: float, edge: float) -> None:
+    """draws every stop as one scatter of white circles with a black edge"""
+    #scatter sizes are areas in points^2, plot marker sizes are diameters in points
+    ax.scatter(stops['stop_lat'], stops['stop_lon'],
+               s=stop_size ** 2,
+               marker='o',
+               facecolors='white',
+               edgecolors='black',
+               linewidths=edge,
+               zorder=2)
+    return None
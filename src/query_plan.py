@@ -0,0 +1,78 @@
+import os
+import re
+import sys
+import sqlite3
+import tempfile
+import pandas as pd
+
+from src import feed
+from src import my_sql
+
+#checks the query plan of every shipped query, run from the repo root with:
+#   python -m src.query_plan [gtfs folder]
+#exits with an error if a request time query does a full scan of a large table
+
+#tables that grow with the size of the feed, shape_lods holds every shape once per tolerance
+#and is read one tolerance at a time
+LARGE_TABLES = ('stop_times', 'shapes', 'trips', 'shape_lods')
+
+DEFAULT_FEED = "data/samples/gtfs_files/gtfs_wata"
+
+
+def query_plan(conn: sqlite3.Connection, sql: str) -> list:
+    """EXPLAIN QUERY PLAN steps for a query as a list of strings"""
+    #parameters are bound as NULL, the plan doesn't depend on their values
+    names = re.findall(r':(\w+)', sql)
+    params = {name: None for name in names} if names else (None,) * sql.count('?')
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+
+
+def full_scans(plan: list) -> list:
+    """large tables read from start to end. an index only changes the order the rows are read in
+    ('SCAN t USING INDEX i') or reads a copy of them ('SCAN t USING COVERING INDEX i'), so any
+    SCAN counts and only SEARCH steps look up some of the rows"""
+    scans = []
+    for step in plan:
+        match = re.match(r'SCAN (\w+)', step)
+        if match and match.group(1) in LARGE_TABLES:
+            scans.append(match.group(1))
+    return scans
+
+
+def audit(conn: sqlite3.Connection) -> pd.DataFrame:
+    """plan and full scans for every query in my_sql.request_queries and my_sql.build_queries"""
+    results = []
+    for kind, queries in [('request', my_sql.request_queries), ('build', my_sql.build_queries)]:
+        for name, sql in queries.items():
+            plan = query_plan(conn, sql)
+            scans = full_scans(plan)
+            results.append({
+                'query': name,
+                'kind': kind,
+                'full_scans': ', '.join(scans),
+                #build queries read all of stop_times on purpose
+                'ok': kind == 'build' or not scans,
+                'plan': ' | '.join(plan)
+            })
+    return pd.DataFrame(results)
+
+
+def main(gtfs_path: str = DEFAULT_FEED) -> int:
+    """builds a fresh database for gtfs_path, prints the audit and returns 1 if any query fails"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        gtfs_feed = feed.Feed(feed.copy_feed(gtfs_path, work_dir))
+        results = audit(gtfs_feed.conn)
+        gtfs_feed.close()
+
+    with pd.option_context('display.max_colwidth', None, 'display.width', 250):
+        print(results.to_string(index=False))
+
+    failed = results[~results['ok']]
+    if len(failed):
+        print(f"\nfull scans of large tables in: {', '.join(failed['query'])}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:]))
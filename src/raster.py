@@ -0,0 +1,116 @@
+import io
+import zlib
+import struct
+import numpy as np
+from matplotlib.transforms import Bbox
+from matplotlib.backends.backend_agg import RendererAgg
+
+#saving a high dpi poster with savefig draws the whole page into one raster (about 5500x8500
+#pixels for 11x17 at 500 dpi) before it is compressed. save_in_strips draws the page a band of
+#rows at a time and streams each band into the PNG file, so only one band is in memory at once.
+#every band draws the whole figure again, so small pages are saved with one savefig instead.
+#WATA at 500 dpi (python -m src.benchmark, poster_output_benchmark): one raster 10.0-10.7s and
+#379 MB over the drawing, 512 row strips 11.6s and 25 MB, 1024 row strips 6.4-8.7s and 66 MB
+
+#pixel rows drawn at a time
+DEFAULT_STRIP_ROWS = 1024
+
+#pages with fewer pixels than this (32 MB as RGBA, the posters below about 200 dpi) are drawn in one go
+STRIP_MIN_PIXELS = 8_000_000
+
+
+class PngWriter:
+    """Writes an RGBA PNG file a block of rows at a time. rows are filtered and deflated as they
+    arrive, so the whole image never has to be held in memory"""
+    def __init__(
+    self,
+    file,
+    width: int,
+    height: int,
+    dpi: float = None
+    ):
+        self.file = file
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self._compressor = zlib.compressobj(6)
+
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        #8 bit RGBA, no interlacing
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+        if dpi is not None:
+            pixels_per_metre = round(dpi / 0.0254)
+            self._chunk(b'pHYs', struct.pack('>IIB', pixels_per_metre, pixels_per_metre, 1))
+
+    def _chunk(self, kind: bytes, data: bytes) -> None:
+        """writes one PNG chunk (length, type, data, crc)"""
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(kind)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind))))
+
+    def write_rows(self, rows: np.ndarray) -> None:
+        """adds a (rows, width, 4) uint8 block below the rows already written"""
+        if rows.shape[1:] != (self.width, 4):
+            raise ValueError(f"expected rows of shape (n, {self.width}, 4), got {rows.shape}")
+        if self.rows_written + len(rows) > self.height:
+            raise ValueError("more rows than the image height")
+
+        #every row starts with filter type 0 (none)
+        filtered = np.zeros((len(rows), self.width * 4 + 1), dtype=np.uint8)
+        filtered[:, 1:] = rows.reshape(len(rows), -1)
+        data = self._compressor.compress(filtered.tobytes())
+        if data:
+            self._chunk(b'IDAT', data)
+        self.rows_written += len(rows)
+
+    def close(self) -> None:
+        """finishes the image, every row must have been written"""
+        if self.rows_written != self.height:
+            raise ValueError(f"{self.rows_written} of {self.height} rows written")
+        self._chunk(b'IDAT', self._compressor.flush())
+        self._chunk(b'IEND', b'')
+
+
+def tight_bbox(fig, dpi: float, pad_inches: float) -> Bbox:
+    """what savefig(bbox_inches='tight', pad_inches=pad_inches) would keep of the figure, in inches.
+    text is measured with a 1x1 pixel renderer at dpi so no page sized raster is made"""
+    fig_dpi = fig.dpi
+    fig.set_dpi(dpi)
+    try:
+        bbox = fig.get_tightbbox(RendererAgg(1, 1, dpi)).padded(pad_inches)
+    finally:
+        fig.set_dpi(fig_dpi)
+    return bbox
+
+
+def save_in_strips(fig, file_path: str, dpi: float, pad_inches: float = 0.1,
+                   strip_rows: int = DEFAULT_STRIP_ROWS, min_pixels: int = STRIP_MIN_PIXELS) -> str:
+    """saves fig as a PNG like savefig(file_path, dpi=dpi, bbox_inches='tight', pad_inches=pad_inches)
+    but draws it strip_rows pixel rows at a time, pages under min_pixels are saved with savefig"""
+    bbox = tight_bbox(fig, dpi, pad_inches)
+    #whole pixels, truncated the same way savefig sizes its canvas
+    width = int(bbox.width * dpi)
+    height = int(bbox.height * dpi)
+
+    if width * height < min_pixels:
+        fig.savefig(file_path, format='png', dpi=dpi, bbox_inches='tight', pad_inches=pad_inches)
+        return file_path
+
+    #a quarter pixel is added to each strip's size because agg truncates the canvas size to whole pixels
+    strip_width = (width + 0.25) / dpi
+
+    with open(file_path, 'wb') as png_file:
+        writer = PngWriter(png_file, width, height, dpi)
+        for first_row in range(0, height, strip_rows):
+            rows = min(strip_rows, height - first_row)
+            #measured up from the bottom edge like savefig does (it drops the part of a pixel left at the top)
+            bottom = bbox.y0 + (height - first_row - rows) / dpi
+            strip = Bbox.from_bounds(bbox.x0, bottom, strip_width, (rows + 0.25) / dpi)
+
+            buffer = io.BytesIO()
+            fig.savefig(buffer, format='rgba', dpi=dpi, bbox_inches=strip, pad_inches=0)
+            writer.write_rows(np.frombuffer(buffer.getbuffer(), dtype=np.uint8).reshape(rows, width, 4))
+        writer.close()
+
+    return file_path
@@ -0,0 +1,196 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from src import feed
+from src import synthetic
+from src.benchmark import peak_rss_mb
+
+#times the feed pipeline on synthetic feeds of growing size and writes the seconds and peak memory
+#of every stage to a JSON report named after the current commit, run from the repo root with:
+#   python -m src.scaling [--sizes 10k 100k 1M 10M] [--report PATH] [--compare OLD_REPORT] [--dpi DPI]
+#each stage runs in a fresh process so its peak memory isn't left over from an earlier one
+
+DEFAULT_SIZES = ('10k', '100k', '1M', '10M')
+
+#stages in the order they run, everything after ingest opens the database ingest built
+STAGES = ('ingest', 'departure_info', 'route_freq', 'live_map', 'poster')
+
+REPORT_DIR = "data/outputs/benchmarks"
+
+#posters are rendered small, the drawing work grows with the feed and not the resolution
+DEFAULT_DPI = 100
+
+
+def rss_mb() -> int:
+    """current resident memory of this process in MB, None where /proc isn't available"""
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) // 1024
+    return None
+
+
+def run_stage(gtfs_path: str, stage: str, dpi: int, work_dir: str) -> dict:
+    """runs one stage on a feed (in a worker process) and returns its seconds, the process memory
+    before it and the peak, and the size of what it made (rows or bytes)"""
+    from src import interactive_maps, posters
+
+    if stage == 'ingest':
+        start_rss = rss_mb()
+        start = time.perf_counter()
+        gtfs_feed = feed.Feed(gtfs_path)
+        seconds = time.perf_counter() - start
+        output = gtfs_feed.ingest_stats['stop_times']['rows']
+    else:
+        gtfs_feed = feed.Feed(gtfs_path)
+        start_rss = rss_mb()
+        start = time.perf_counter()
+        if stage == 'departure_info':
+            output = len(gtfs_feed.departure_info().stats)
+        elif stage == 'route_freq':
+            output = len(gtfs_feed.route_freq())
+        elif stage == 'live_map':
+            output = len(interactive_maps.live_map(gtfs_feed).get_root().render().encode())
+        elif stage == 'poster':
+            poster_file = posters.map(gtfs_feed, Heatmap=True, dpi=dpi,
+                                      output_file=os.path.join(work_dir, f"{gtfs_feed.name}.png"))
+            posters.plt.close('all')
+            output = os.path.getsize(poster_file)
+        else:
+            raise ValueError(f"unknown stage {stage!r}, expected one of {', '.join(STAGES)}")
+        seconds = time.perf_counter() - start
+
+    gtfs_feed.close()
+    return {'seconds': round(seconds, 4), 'start_rss_mb': start_rss, 'peak_rss_mb': peak_rss_mb(), 'output': output}
+
+
+def scaling_benchmark(sizes: tuple = DEFAULT_SIZES, stages: tuple = STAGES, dpi: int = DEFAULT_DPI,
+                      seed: int = 0) -> list:
+    """generates a synthetic feed for each size (stop_times rows) and runs every stage on it, returns
+    one result per size and stage. a failed stage is recorded with its error and, if it was
+    ingest, the feed's other stages are skipped"""
+    results = []
+    for size in sizes:
+        n_stop_times = synthetic.parse_size(size) if isinstance(size, str) else int(size)
+        parameters = synthetic.feed_parameters(n_stop_times)
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            gtfs_path = os.path.join(work_dir, "gtfs_files", f"gtfs_synthetic_{n_stop_times}")
+            os.makedirs(os.path.join(work_dir, "databases"))
+            start = time.perf_counter()
+            synthetic.generate_feed(gtfs_path, seed=seed, **parameters)
+            generate_seconds = time.perf_counter() - start
+
+            feed_row = {'stop_times': n_stop_times, **parameters,
+                        'feed_mb': round(sum(os.path.getsize(os.path.join(gtfs_path, name))
+                                             for name in os.listdir(gtfs_path)) / 1024 ** 2, 1)}
+            results.append({**feed_row, 'stage': 'generate', 'seconds': round(generate_seconds, 4),
+                            'start_rss_mb': None, 'peak_rss_mb': None, 'output': None, 'error': ''})
+
+            for stage in stages:
+                row = {**feed_row, 'stage': stage, 'seconds': None, 'start_rss_mb': None,
+                       'peak_rss_mb': None, 'output': None, 'error': ''}
+                try:
+                    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+                        row.update(pool.submit(run_stage, gtfs_path, stage, dpi, work_dir).result())
+                except Exception as error:
+                    row['error'] = f"{type(error).__name__}: {error}"
+                results.append(row)
+                print(f"{n_stop_times:>10} {stage:<15} {row['seconds']}s peak {row['peak_rss_mb']} MB {row['error']}",
+                      file=sys.stderr)
+                if stage == 'ingest' and row['error']:
+                    break
+
+            db_path = os.path.join(work_dir, "databases", f"{os.path.basename(gtfs_path)}.db")
+            if os.path.exists(db_path):
+                for row in results:
+                    if row['stop_times'] == n_stop_times:
+                        row['db_mb'] = round(os.path.getsize(db_path) / 1024 ** 2, 1)
+
+    return results
+
+
+def git_commit() -> str:
+    """short hash of the checked out commit, with -dirty if tracked files have changed, '' outside git"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        changed = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                 capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+    return f"{commit}-dirty" if changed else commit
+
+
+def write_report(results: list, report_path: str = None, dpi: int = DEFAULT_DPI) -> str:
+    """writes the results with the commit and machine they came from as JSON, returns the path"""
+    commit = git_commit()
+    report_path = report_path or os.path.join(REPORT_DIR, f"scaling_{commit or 'unknown'}.json")
+    os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+
+    report = {
+        'commit': commit,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'poster_dpi': dpi,
+        'results': results
+    }
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    return report_path
+
+
+def compare_reports(old_path: str, new_path: str) -> pd.DataFrame:
+    """seconds and peak memory of every stage in two reports side by side, with new / old ratios"""
+    frames = []
+    for label, path in (('old', old_path), ('new', new_path)):
+        with open(path) as report_file:
+            results = pd.DataFrame(json.load(report_file)['results'])
+        frames.append(results[['stop_times', 'stage', 'seconds', 'peak_rss_mb']]
+                      .rename(columns={'seconds': f'{label}_s', 'peak_rss_mb': f'{label}_peak_mb'}))
+
+    compared = frames[0].merge(frames[1], on=['stop_times', 'stage'], how='outer')
+    compared['time_ratio'] = (compared['new_s'] / compared['old_s']).round(2)
+    compared['memory_ratio'] = (compared['new_peak_mb'] / compared['old_peak_mb']).round(2)
+    return compared
+
+
+def main(argv: list = None) -> int:
+    """command line entry point, returns 1 if any stage failed"""
+    parser = argparse.ArgumentParser(description="time the feed pipeline on synthetic feeds of growing size")
+    parser.add_argument('--sizes', nargs='+', default=list(DEFAULT_SIZES), help="stop_times rows per feed, e.g. 10k 1M")
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES)
+    parser.add_argument('--dpi', type=int, default=DEFAULT_DPI, help="poster resolution")
+    parser.add_argument('--seed', type=int, default=0, help="synthetic feed seed")
+    parser.add_argument('--report', help=f"JSON report path (default {REPORT_DIR}/scaling_<commit>.json)")
+    parser.add_argument('--compare', help="earlier report to compare this run against")
+    args = parser.parse_args(argv)
+
+    #ingest has to run for the other stages to have a database
+    stages = ['ingest'] + [stage for stage in STAGES if stage in args.stages and stage != 'ingest']
+    results = scaling_benchmark(args.sizes, stages, args.dpi, args.seed)
+    report_path = write_report(results, args.report, args.dpi)
+
+    columns = ['stop_times', 'stage', 'seconds', 'start_rss_mb', 'peak_rss_mb', 'output', 'error']
+    table = pd.DataFrame(results)[columns].astype({'start_rss_mb': 'Int64', 'peak_rss_mb': 'Int64', 'output': 'Int64'})
+    print(table.to_string(index=False))
+    print(f"\nreport written to {report_path}")
+    if args.compare:
+        print(compare_reports(args.compare, report_path).to_string(index=False))
+
+    return 1 if any(row['error'] for row in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,249 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+from src import columnar
+
+#a feed's stop_times as numpy arrays, written at ingest next to its database as
+#   data/*/databases/<feed>.columns/stop_times/<array>.npy
+#and memory mapped when read, so the rows stay on disk until used and aren't copied. trip and stop
+#ids are dictionary encoded (trip_ids.npy and stop_ids.npy hold the ids, rows hold int32 positions
+#in them), times are int32 seconds after midnight (MISSING where blank) and stop_sequence is int16
+#(int32 for feeds whose sequences don't fit). rows are sorted by trip and stop_sequence so trip t's
+#stop times are rows trip_offsets[t]:trip_offsets[t + 1], and stop_rows lists the rows again sorted
+#by stop and departure with stop s's rows at stop_rows[stop_offsets[s]:stop_offsets[s + 1]]
+#(compressed sparse row layout). meta.json records the hash of the stop_times.txt they were made from,
+#a file that couldn't be stored gets a meta.json without rows so it isn't tried again until it changes
+
+STORE_VERSION = 1
+
+#blank arrival or departure time
+MISSING = -1
+
+#arrays with one value per stop_times row, in trip order
+ROW_ARRAYS = ('trip', 'stop', 'stop_sequence', 'arrival_secs', 'departure_secs')
+ARRAYS = ROW_ARRAYS + ('trip_offsets', 'stop_rows', 'stop_offsets', 'trip_ids', 'stop_ids')
+
+#columns of stop_times.txt (and the seconds columns added to them) the arrays are made from
+COLUMNS = ['trip_id', 'stop_id', 'stop_sequence', 'arrival_time', 'departure_time']
+
+
+def store_dir(db_path: str) -> str:
+    """folder of a database's stop_times arrays"""
+    return os.path.join(columnar.sidecar_dir(db_path), "stop_times")
+
+
+class StopTimesArrays:
+    """A feed's stop_times as read only memory mapped arrays (see the layout above)"""
+    def __init__(
+    self,
+    path: str,
+    arrays: dict
+    ):
+        self.path = path
+        self.trip = arrays['trip']
+        self.stop = arrays['stop']
+        self.stop_sequence = arrays['stop_sequence']
+        self.arrival_secs = arrays['arrival_secs']
+        self.departure_secs = arrays['departure_secs']
+        self.trip_offsets = arrays['trip_offsets']
+        self.stop_rows = arrays['stop_rows']
+        self.stop_offsets = arrays['stop_offsets']
+        self.trip_ids = arrays['trip_ids']
+        self.stop_ids = arrays['stop_ids']
+
+    def __len__(self):
+        return len(self.trip)
+
+    @property
+    def nbytes(self) -> int:
+        """bytes of all the arrays"""
+        return sum(getattr(self, name).nbytes for name in ARRAYS)
+
+    def trip_rows(self, trip_id: str) -> slice:
+        """rows of a trip's stop times in stop_sequence order (an empty slice for unknown trips)"""
+        match = np.flatnonzero(self.trip_ids == trip_id)
+        if not len(match):
+            return slice(0, 0)
+        return slice(int(self.trip_offsets[match[0]]), int(self.trip_offsets[match[0] + 1]))
+
+    def stop_rows_of(self, stop_id: str) -> np.ndarray:
+        """rows of the stop times at a stop in departure order (empty for unknown stops)"""
+        match = np.flatnonzero(self.stop_ids == stop_id)
+        if not len(match):
+            return self.stop_rows[:0]
+        return self.stop_rows[self.stop_offsets[match[0]]:self.stop_offsets[match[0] + 1]]
+
+
+def read_meta(path: str) -> dict:
+    """meta.json of the arrays in path, None if there isn't one or it's from another version"""
+    try:
+        with open(os.path.join(path, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('version') == STORE_VERSION else None
+
+
+def read_store(path: str, file_hash: str = None) -> StopTimesArrays:
+    """memory maps the arrays in path, None if they don't exist, were written by another version
+    or from a different file_hash"""
+    meta = read_meta(path)
+    if meta is None or meta.get('rows') is None or (file_hash is not None and meta.get('file_hash') != file_hash):
+        return None
+    try:
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in ARRAYS}
+    except (OSError, ValueError):
+        return None
+    return StopTimesArrays(path, arrays)
+
+
+class StopTimesWriter:
+    """Encodes stop_times a block of rows at a time as they are read from the csv and writes the
+    sorted arrays when closed (the encoded rows, 18 to 20 bytes each, are held until then). a block
+    without a trip, stop or whole stop_sequence leaves the store without rows and stop_times is read
+    from the database instead. same interface as columnar.TableWriter"""
+    def __init__(
+    self,
+    path: str,
+    file_hash: str
+    ):
+        self.path = path
+        self.file_hash = file_hash
+        self.rows = 0
+        self.failed = False
+        self._trip_ids = pd.Index([], dtype=object)
+        self._stop_ids = pd.Index([], dtype=object)
+        self._blocks = []
+
+    def write(self, chunk: pd.DataFrame) -> None:
+        """encodes a block of rows read from stop_times.txt (with its seconds columns)"""
+        if self.failed:
+            return None
+        try:
+            if chunk[['trip_id', 'stop_id', 'stop_sequence']].isna().any().any():
+                raise ValueError("stop_times rows without a trip, stop or stop_sequence")
+            self._trip_ids, trip = columnar.extend_dictionary(self._trip_ids, chunk['trip_id'])
+            self._stop_ids, stop = columnar.extend_dictionary(self._stop_ids, chunk['stop_id'])
+            sequence = pd.to_numeric(chunk['stop_sequence']).to_numpy(dtype=np.float64)
+            if (sequence != np.floor(sequence)).any() or (np.abs(sequence) > np.iinfo(np.int32).max).any():
+                raise ValueError("stop_sequence that isn't a 32 bit integer")
+            times = [
+                np.nan_to_num(chunk[column].to_numpy(dtype=np.float64), nan=MISSING).astype(np.int32)
+                if column in chunk.columns else np.full(len(chunk), MISSING, dtype=np.int32)
+                for column in ('arrival_secs', 'departure_secs')
+            ]
+            self._blocks.append((trip, stop, sequence.astype(np.int32), *times))
+            self.rows += len(chunk)
+        except (KeyError, ValueError, TypeError):
+            self.failed = True
+            self.rows = 0
+            self._blocks = []
+        return None
+
+    def _arrays(self) -> dict:
+        """the encoded rows sorted into the store's layout"""
+        trip, stop, sequence, arrival, departure = (
+            np.concatenate([block[i] for block in self._blocks]) if self._blocks else np.zeros(0, dtype=np.int32)
+            for i in range(len(ROW_ARRAYS))
+        )
+        self._blocks = []
+
+        order = np.lexsort((sequence, trip))
+        trip, stop, sequence, arrival, departure = (values[order] for values in (trip, stop, sequence, arrival, departure))
+        if len(sequence) and sequence.min() >= np.iinfo(np.int16).min and sequence.max() <= np.iinfo(np.int16).max:
+            sequence = sequence.astype(np.int16)
+
+        def offsets(codes: np.ndarray, n: int) -> np.ndarray:
+            return np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=n))]).astype(np.int64)
+
+        return {
+            'trip': trip,
+            'stop': stop,
+            'stop_sequence': sequence,
+            'arrival_secs': arrival,
+            'departure_secs': departure,
+            'trip_offsets': offsets(trip, len(self._trip_ids)),
+            'stop_rows': np.lexsort((departure, stop)).astype(np.int32),
+            'stop_offsets': offsets(stop, len(self._stop_ids)),
+            'trip_ids': self._trip_ids.to_numpy(dtype=str),
+            'stop_ids': self._stop_ids.to_numpy(dtype=str)
+        }
+
+    def close(self) -> None:
+        """writes the arrays (or a meta.json without rows if the file couldn't be stored) to a new folder
+        and swaps it in, arrays already memory mapped from the old folder stay readable"""
+        arrays = {} if self.failed else self._arrays()
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        old_path = f"{self.path}.{os.getpid()}.old"
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+        for name, values in arrays.items():
+            np.save(os.path.join(temp_path, f"{name}.npy"), values)
+        with open(os.path.join(temp_path, "meta.json"), 'w') as meta_file:
+            json.dump({'version': STORE_VERSION, 'file_hash': self.file_hash,
+                       'rows': len(arrays['trip']) if arrays else None}, meta_file)
+
+        if os.path.exists(self.path):
+            os.replace(self.path, old_path)
+        os.replace(temp_path, self.path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        return False
+
+
+def _group_rows(keys: np.ndarray) -> tuple:
+    """distinct keys and the position of each row's key among them"""
+    positions, distinct = pd.factorize(keys, sort=True)
+    return distinct, positions
+
+
+def stop_departure_stats(arrays: StopTimesArrays, trip_groups: np.ndarray) -> pd.DataFrame:
+    """departures, timed departures and first and last departure (seconds, NaN if none are timed)
+    for every stop and group of trips (e.g. services), trip_groups holds the group of each of
+    arrays.trip_ids with -1 for trips left out. returns stop and group positions with the stats"""
+    groups = np.asarray(trip_groups)[arrays.trip]
+    kept = np.flatnonzero(groups >= 0)
+    n_groups = int(groups.max()) + 1 if len(groups) else 1
+    distinct, positions = _group_rows(arrays.stop[kept].astype(np.int64) * n_groups + groups[kept])
+
+    departure = arrays.departure_secs[kept]
+    timed = departure != MISSING
+    first = np.full(len(distinct), np.iinfo(np.int32).max, dtype=np.int32)
+    last = np.full(len(distinct), MISSING, dtype=np.int32)
+    np.minimum.at(first, positions[timed], departure[timed])
+    np.maximum.at(last, positions[timed], departure[timed])
+
+    timed_count = np.bincount(positions[timed], minlength=len(distinct))
+    return pd.DataFrame({
+        'stop': distinct // n_groups,
+        'group': distinct % n_groups,
+        'departures': np.bincount(positions, minlength=len(distinct)),
+        'timed': timed_count,
+        'first': np.where(timed_count > 0, first, np.nan),
+        'last': np.where(timed_count > 0, last, np.nan)
+    })
+
+
+def group_hour_counts(arrays: StopTimesArrays, trip_groups: np.ndarray) -> pd.DataFrame:
+    """stop times by group of trips (e.g. route and service) and hour of arrival, leaving out blank
+    arrivals and trips whose group is -1. returns group positions, hours and counts"""
+    groups = np.asarray(trip_groups)[arrays.trip]
+    kept = np.flatnonzero((groups >= 0) & (arrays.arrival_secs != MISSING))
+    hours = arrays.arrival_secs[kept] // 3600
+    n_hours = int(hours.max()) + 1 if len(hours) else 1
+    distinct, positions = _group_rows(groups[kept].astype(np.int64) * n_hours + hours)
+    return pd.DataFrame({
+        'group': distinct // n_hours,
+        'hour': distinct % n_hours,
+        'count': np.bincount(positions, minlength=len(distinct))
+    })
@@ -0,0 +1,238 @@
+import os
+import sys
+import zipfile
+import argparse
+import numpy as np
+import pandas as pd
+
+#deterministic synthetic GTFS feeds for testing and benchmarking at sizes the samples don't reach,
+#run from the repo root with:
+#   python -m src.synthetic [output folder] [--stop-times N | --routes R --stops S --trips-per-route T]
+#       [--stops-per-trip K] [--shape-density D] [--seed N] [--zip]
+#the same parameters and seed always write the same files
+
+#feeds are laid out around this point (Williamsburg, VA, like the WATA sample)
+CENTER_LAT = 37.27
+CENTER_LON = -76.71
+
+#average distance between neighbouring stops in degrees (about 300 m)
+STOP_SPACING = 0.003
+
+#service runs from 5am to 1am the next morning, so late trips have times past 24:00:00
+FIRST_DEPARTURE = 5 * 3600
+LAST_DEPARTURE = 25 * 3600
+
+#seconds between stops and how long a bus waits at each one
+SECONDS_PER_STOP = 90
+DWELL_SECONDS = 20
+
+#trips are written to stop_times.txt this many at a time
+CHUNK_TRIPS = 5_000
+
+#one year of service, with the weekday service swapped for the sunday one on two holidays
+START_DATE = "20260101"
+END_DATE = "20261231"
+HOLIDAYS = ("20260525", "20260907")
+
+#share of each route's trips run by each service
+SERVICE_SHARES = {'weekday': 0.6, 'saturday': 0.25, 'sunday': 0.15}
+
+
+def parse_size(size: str) -> int:
+    """number of stop_times rows for sizes like 10k, 1.5M or 2000000"""
+    multipliers = {'k': 1_000, 'm': 1_000_000, 'g': 1_000_000_000}
+    size = size.strip().lower().replace('_', '')
+    if size and size[-1] in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1]])
+    return int(size)
+
+
+def feed_parameters(n_stop_times: int, stops_per_trip: int = 40) -> dict:
+    """routes, stops and trips per route for a feed with about n_stop_times rows in stop_times.txt,
+    growing the number of routes and the trips on each with the square root of the size"""
+    trips = max(1, round(n_stop_times / stops_per_trip))
+    routes = max(1, round(np.sqrt(trips / 4)))
+    return {
+        'routes': routes,
+        'stops': max(stops_per_trip, routes * stops_per_trip // 2),
+        'trips_per_route': max(1, round(trips / routes)),
+        'stops_per_trip': stops_per_trip
+    }
+
+
+def format_times(seconds: np.ndarray) -> np.ndarray:
+    """HH:MM:SS strings for seconds after midnight (hours go past 24 for trips after midnight)"""
+    seconds = np.asarray(seconds, dtype=np.int64)
+    hours = pd.Series(seconds // 3600).astype(str).str.zfill(2)
+    minutes = pd.Series(seconds // 60 % 60).astype(str).str.zfill(2)
+    secs = pd.Series(seconds % 60).astype(str).str.zfill(2)
+    return (hours + ':' + minutes + ':' + secs).to_numpy()
+
+
+def route_stops(rng: np.random.Generator, stop_lat: np.ndarray, stop_lon: np.ndarray, routes: int,
+                stops_per_trip: int) -> np.ndarray:
+    """(routes, stops_per_trip) stop indexes of each route: a random set of stops ordered along a
+    random heading so each route crosses the area in a line and routes share stops"""
+    stops_per_trip = min(stops_per_trip, len(stop_lat))
+    patterns = np.empty((routes, stops_per_trip), dtype=np.int64)
+    for route in range(routes):
+        heading = rng.uniform(0, np.pi)
+        #stops near a line through a random point, in order along it
+        anchor = rng.integers(len(stop_lat))
+        along = (stop_lon - stop_lon[anchor]) * np.cos(heading) + (stop_lat - stop_lat[anchor]) * np.sin(heading)
+        across = np.abs((stop_lat - stop_lat[anchor]) * np.cos(heading) - (stop_lon - stop_lon[anchor]) * np.sin(heading))
+        nearest = np.argsort(across, kind='stable')[:stops_per_trip]
+        patterns[route] = nearest[np.argsort(along[nearest], kind='stable')]
+    return patterns
+
+
+def shape_points(stop_lat: np.ndarray, stop_lon: np.ndarray, pattern: np.ndarray, density: int,
+                 rng: np.random.Generator) -> tuple:
+    """lat, lon and distance travelled of a route's line through its stops, with density points
+    between each pair of stops (jittered a little so simplifying the line has work to do)"""
+    lat, lon = stop_lat[pattern], stop_lon[pattern]
+    steps = np.arange(density + 1) / (density + 1)
+    shape_lat = (lat[:-1, None] + (lat[1:] - lat[:-1])[:, None] * steps).ravel()
+    shape_lon = (lon[:-1, None] + (lon[1:] - lon[:-1])[:, None] * steps).ravel()
+    shape_lat = np.append(shape_lat, lat[-1])
+    shape_lon = np.append(shape_lon, lon[-1])
+
+    jitter = np.zeros(len(shape_lat), dtype=bool)
+    jitter[:-1] = np.tile(steps > 0, len(pattern) - 1)
+    shape_lat[jitter] += rng.normal(0, STOP_SPACING / 50, jitter.sum())
+    shape_lon[jitter] += rng.normal(0, STOP_SPACING / 50, jitter.sum())
+
+    #metres, with a degree taken as 111 km
+    distance = np.concatenate([[0], np.cumsum(np.hypot(np.diff(shape_lat), np.diff(shape_lon)) * 111_000)])
+    return shape_lat, shape_lon, np.round(distance, 1)
+
+
+def generate_feed(gtfs_path: str, routes: int = 10, stops: int = 200, trips_per_route: int = 50,
+                  stops_per_trip: int = 40, shape_density: int = 5, seed: int = 0) -> str:
+    """writes a valid gtfs folder (agency, stops, routes, trips, stop_times, shapes, calendar and
+    calendar_dates) to gtfs_path and returns it. every route runs its stops in both directions
+    over one shape each, trips are spread evenly over the service day and split between
+    weekday, saturday and sunday services. stop_times.txt has routes * trips_per_route * stops_per_trip
+    rows and is written a block of trips at a time"""
+    rng = np.random.default_rng(seed)
+    os.makedirs(gtfs_path, exist_ok=True)
+    stops_per_trip = min(stops_per_trip, stops)
+
+    pd.DataFrame({'agency_id': ['1'], 'agency_name': ['Synthetic Transit'], 'agency_url': ['https://example.com'],
+                  'agency_timezone': ['America/New_York'], 'agency_lang': ['en']}
+                 ).to_csv(os.path.join(gtfs_path, "agency.txt"), index=False)
+
+    #stops scattered over a square that grows with the number of stops
+    half_width = STOP_SPACING * np.sqrt(stops) / 2
+    stop_lat = np.round(CENTER_LAT + rng.uniform(-half_width, half_width, stops), 6)
+    stop_lon = np.round(CENTER_LON + rng.uniform(-half_width, half_width, stops), 6)
+    stop_ids = np.char.add('s', np.arange(stops).astype(str))
+    pd.DataFrame({'stop_id': stop_ids, 'stop_name': [f"Stop {i}" for i in range(stops)],
+                  'stop_lat': stop_lat, 'stop_lon': stop_lon, 'location_type': 0}
+                 ).to_csv(os.path.join(gtfs_path, "stops.txt"), index=False)
+
+    route_ids = np.char.add('r', np.arange(routes).astype(str))
+    colors = [f"{value:06X}" for value in rng.integers(0, 0xCCCCCC, routes)]
+    pd.DataFrame({'route_id': route_ids, 'agency_id': '1', 'route_short_name': np.arange(1, routes + 1).astype(str),
+                  'route_long_name': [f"Route {i + 1}" for i in range(routes)], 'route_type': 3,
+                  'route_color': colors, 'route_text_color': 'FFFFFF'}
+                 ).to_csv(os.path.join(gtfs_path, "routes.txt"), index=False)
+
+    #one shape per route and direction, the second running the first backwards
+    patterns = route_stops(rng, stop_lat, stop_lon, routes, stops_per_trip)
+    with open(os.path.join(gtfs_path, "shapes.txt"), "w") as shapes_file:
+        shapes_file.write("shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence,shape_dist_traveled\n")
+        for route in range(routes):
+            lat, lon, distance = shape_points(stop_lat, stop_lon, patterns[route], shape_density, rng)
+            for direction, order in ((0, slice(None)), (1, slice(None, None, -1))):
+                pd.DataFrame({'shape_id': f"{route_ids[route]}_{direction}", 'shape_pt_lat': np.round(lat[order], 6),
+                              'shape_pt_lon': np.round(lon[order], 6), 'shape_pt_sequence': np.arange(len(lat)),
+                              'shape_dist_traveled': distance[-1] - distance[order] if direction else distance}
+                             ).to_csv(shapes_file, header=False, index=False)
+
+    pd.DataFrame({'service_id': list(SERVICE_SHARES),
+                  'monday': [1, 0, 0], 'tuesday': [1, 0, 0], 'wednesday': [1, 0, 0], 'thursday': [1, 0, 0],
+                  'friday': [1, 0, 0], 'saturday': [0, 1, 0], 'sunday': [0, 0, 1],
+                  'start_date': START_DATE, 'end_date': END_DATE}
+                 ).to_csv(os.path.join(gtfs_path, "calendar.txt"), index=False)
+    pd.DataFrame({'service_id': ['weekday', 'sunday'] * len(HOLIDAYS),
+                  'date': np.repeat(HOLIDAYS, 2), 'exception_type': [2, 1] * len(HOLIDAYS)}
+                 ).to_csv(os.path.join(gtfs_path, "calendar_dates.txt"), index=False)
+
+    #trips of each route alternate direction and start evenly over the day, services are picked
+    #with a golden ratio sequence so each one runs all day at its share of the trips
+    trip_route = np.repeat(np.arange(routes), trips_per_route)
+    trip_number = np.tile(np.arange(trips_per_route), routes)
+    direction = trip_number % 2
+    headway = (LAST_DEPARTURE - FIRST_DEPARTURE) // max(trips_per_route, 1)
+    trip_start = FIRST_DEPARTURE + trip_number * headway + rng.integers(0, max(headway // 4, 1), len(trip_number))
+    shares = np.cumsum(list(SERVICE_SHARES.values()))
+    service = np.searchsorted(shares, (trip_number * 0.6180339887 + 0.5) % 1 * shares[-1], side='right')
+    trip_ids = np.char.add(np.char.add(route_ids[trip_route], '_t'), trip_number.astype(str))
+
+    pd.DataFrame({'route_id': route_ids[trip_route], 'service_id': np.array(list(SERVICE_SHARES))[service],
+                  'trip_id': trip_ids, 'trip_headsign': [f"Route {route + 1}" for route in trip_route],
+                  'direction_id': direction,
+                  'shape_id': np.char.add(np.char.add(route_ids[trip_route], '_'), direction.astype(str))}
+                 ).to_csv(os.path.join(gtfs_path, "trips.txt"), index=False)
+
+    sequence = np.arange(stops_per_trip)
+    offsets = sequence * (SECONDS_PER_STOP + DWELL_SECONDS)
+    with open(os.path.join(gtfs_path, "stop_times.txt"), "w") as stop_times:
+        stop_times.write("trip_id,arrival_time,departure_time,stop_id,stop_sequence\n")
+        for first_trip in range(0, len(trip_ids), CHUNK_TRIPS):
+            trips = np.arange(first_trip, min(first_trip + CHUNK_TRIPS, len(trip_ids)))
+            #direction 1 visits the route's stops backwards
+            trip_patterns = patterns[trip_route[trips]]
+            trip_patterns = np.where(direction[trips, None] == 1, trip_patterns[:, ::-1], trip_patterns)
+            arrival = (trip_start[trips, None] + offsets).ravel()
+            pd.DataFrame({'trip_id': np.repeat(trip_ids[trips], stops_per_trip),
+                          'arrival_time': format_times(arrival),
+                          'departure_time': format_times(arrival + DWELL_SECONDS),
+                          'stop_id': stop_ids[trip_patterns.ravel()],
+                          'stop_sequence': np.tile(sequence, len(trips))}
+                         ).to_csv(stop_times, header=False, index=False)
+
+    return gtfs_path
+
+
+def zip_feed(gtfs_path: str, zip_path: str = None) -> str:
+    """zips a gtfs folder's files (at the top of the zip, like most published feeds) next to it, returns the zip"""
+    zip_path = zip_path or f"{os.path.normpath(gtfs_path)}.zip"
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+        for name in sorted(os.listdir(gtfs_path)):
+            if name.endswith('.txt'):
+                zip_file.write(os.path.join(gtfs_path, name), name)
+    return zip_path
+
+
+def main(argv: list = None) -> int:
+    """command line entry point"""
+    parser = argparse.ArgumentParser(description="write a deterministic synthetic GTFS feed")
+    parser.add_argument('gtfs_path', help="folder to write the feed to")
+    parser.add_argument('--stop-times', type=parse_size, help="pick routes, stops and trips for about this many stop_times rows")
+    parser.add_argument('--routes', type=int, default=10)
+    parser.add_argument('--stops', type=int, default=200)
+    parser.add_argument('--trips-per-route', type=int, default=50)
+    parser.add_argument('--stops-per-trip', type=int, default=40)
+    parser.add_argument('--shape-density', type=int, default=5, help="shape points between each pair of stops")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--zip', action='store_true', help="also write <gtfs_path>.zip")
+    args = parser.parse_args(argv)
+
+    if args.stop_times:
+        sizes = feed_parameters(args.stop_times, args.stops_per_trip)
+    else:
+        sizes = {'routes': args.routes, 'stops': args.stops, 'trips_per_route': args.trips_per_route,
+                 'stops_per_trip': args.stops_per_trip}
+
+    generate_feed(args.gtfs_path, shape_density=args.shape_density, seed=args.seed, **sizes)
+    print(f"wrote {args.gtfs_path}: {sizes['routes']} routes, {sizes['stops']} stops, "
+          f"{sizes['routes'] * sizes['trips_per_route'] * min(sizes['stops_per_trip'], sizes['stops'])} stop_times")
+    if args.zip:
+        print(f"wrote {zip_feed(args.gtfs_path)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,311 @@
+import os
+import json
+import shutil
+import math
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import shapely
+from flask import Flask, Response, abort
+from branca.element import MacroElement
+from jinja2 import Template
+
+from src import feed
+from src import my_sql
+from src import metrics
+from src.cache import feed_hash
+
+#GeoJSON tiles of each feed's routes and stops, served from the flask server at
+#   /tiles/<source>/<feed name>/<z>/<x>/<y>.geojson?v=<cache.feed_hash of the feed's files>
+#so the interactive map only downloads the part of the network that is on screen. v changes whenever
+#the files do so browsers can cache tiles, the server ignores it.
+#built tiles are saved under data/<source>/tiles/ and reused until the feed database changes
+
+#folders under data/ that feeds can be served from
+TILE_SOURCES = ('samples', 'user_data')
+
+#tiles are only built for these zooms, the map asks for the closest one
+MIN_TILE_ZOOM = 10
+MAX_TILE_ZOOM = 16
+
+TILE_SIZE = 256
+
+#most TileLayers (one per feed and level of detail) kept in memory at once
+#(can be changed with the GTFS_TILE_LAYERS environment variable)
+DEFAULT_MAX_TILE_LAYERS = 16
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple:
+    """(min lon, min lat, max lon, max lat) of a web mercator tile"""
+    n = 2 ** z
+
+    def lat(tile_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+    return (x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y))
+
+
+def tile_source(gtfs_feed) -> str:
+    """which data folder a feed was loaded from"""
+    return 'user_data' if 'user_data' in os.path.normpath(gtfs_feed.gtfs_path()).split(os.sep) else 'samples'
+
+
+def tile_url(gtfs_feed) -> str:
+    """leaflet style url template for a feed's tiles, versioned by the feed's files so a re-uploaded
+    or updated feed isn't drawn from tiles the browser cached for the old one"""
+    version = feed_hash(gtfs_feed.gtfs_path())
+    return f"/tiles/{tile_source(gtfs_feed)}/{gtfs_feed.name}/{{z}}/{{x}}/{{y}}.geojson?v={version}"
+
+
+def tile_cache_dir(gtfs_feed) -> str:
+    """folder for a feed's built tiles, named after the database's modification time so tiles
+    from an older version of the feed are never served"""
+    version = os.stat(gtfs_feed.db_path).st_mtime_ns
+    return os.path.join(gtfs_feed.parent_dir, "tiles", gtfs_feed.name, str(version))
+
+
+def lonlat(lines: np.ndarray) -> np.ndarray:
+    """swaps the feed's (lat, lon) shape lines to the (lon, lat) order GeoJSON uses"""
+    return shapely.transform(lines, lambda coords: coords[:, ::-1])
+
+
+def stop_popups(stops: pd.DataFrame, departures) -> list:
+    """pop up text for each stop: its name and departure info if there is any"""
+    return [
+        f"{name}<br>{departures[stop_id]}" if stop_id in departures else f"{name}"
+        for stop_id, name in zip(stops['stop_id'], stops['stop_name'])
+    ]
+
+
+def route_features(routes: pd.DataFrame, lines) -> list:
+    """GeoJSON line features for routes (lines already in lon/lat) with the route colour and pop up text"""
+    return [
+        {
+            'type': 'Feature',
+            'geometry': shapely.geometry.mapping(line),
+            'properties': {
+                'kind': 'route',
+                'route_color': route_color,
+                'popup': f"Route: {short_name} - {long_name}"
+            }
+        }
+        for line, route_color, short_name, long_name in zip(
+            lines, routes['route_color'], routes['route_short_name'], routes['route_long_name'])
+    ]
+
+
+def stop_features(stops: pd.DataFrame) -> list:
+    """GeoJSON point features for stops with a popup column"""
+    return [
+        {
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [float(lon), float(lat)]},
+            'properties': {'kind': 'stop', 'popup': popup}
+        }
+        for lon, lat, popup in zip(stops['stop_lon'], stops['stop_lat'], stops['popup'])
+    ]
+
+
+class TileLayers:
+    """route lines (in lon/lat with a spatial index) and stops with their pop up text for one feed,
+    built once per feed and level of detail and reused for every tile"""
+    def __init__(
+    self,
+    gtfs_feed,
+    tolerance: float
+    ):
+        routes = gtfs_feed.trips_shapes_routes(tolerance)
+        self.lines = lonlat(routes['shape_points'].to_numpy())
+        self.routes = routes.drop(columns='shape_points').reset_index(drop=True)
+        self.tree = shapely.STRtree(self.lines)
+
+        self.stops = pd.read_sql(my_sql.map_stops_sql, gtfs_feed.conn).dropna(subset=['stop_lat', 'stop_lon'])
+        self.stops['popup'] = stop_popups(self.stops, gtfs_feed.departure_info())
+
+
+#(database path, database mtime, tolerance) -> TileLayers, least recently used first
+_layers = OrderedDict()
+_layers_lock = threading.Lock()
+max_tile_layers = int(os.environ.get("GTFS_TILE_LAYERS", DEFAULT_MAX_TILE_LAYERS))
+
+
+@metrics.timed('tile_layers')
+def tile_layers(gtfs_feed, tolerance: float) -> TileLayers:
+    """cached TileLayers for a feed, the least recently used are dropped once there are more
+    than max_tile_layers"""
+    key = (gtfs_feed.db_path, os.stat(gtfs_feed.db_path).st_mtime_ns, tolerance)
+    with _layers_lock:
+        layers = _layers.get(key)
+        if layers is not None:
+            _layers.move_to_end(key)
+    if layers is None:
+        layers = TileLayers(gtfs_feed, tolerance)
+        with _layers_lock:
+            #only the newest version of each feed is kept
+            for old_key in [k for k in _layers if k[0] == key[0] and k[1] != key[1]]:
+                del _layers[old_key]
+            _layers[key] = layers
+            while len(_layers) > max_tile_layers:
+                _layers.popitem(last=False)
+    return layers
+
+
+def build_tile(gtfs_feed, z: int, x: int, y: int) -> dict:
+    """GeoJSON FeatureCollection of the route lines (clipped to the tile) and stops in one tile"""
+    min_lon, min_lat, max_lon, max_lat = tile_bounds(z, x, y)
+
+    #route lines at the level of detail that matches the tile's pixel size
+    tolerance = gtfs_feed.lod_tolerance((max_lat - min_lat) / TILE_SIZE)
+    layers = tile_layers(gtfs_feed, tolerance)
+
+    hits = layers.tree.query(shapely.box(min_lon, min_lat, max_lon, max_lat))
+    clipped = shapely.clip_by_rect(layers.lines[hits], min_lon, min_lat, max_lon, max_lat)
+    keep = ~shapely.is_empty(clipped)
+    features = route_features(layers.routes.loc[hits[keep]], clipped[keep])
+
+    #each stop goes in exactly one tile (bounds include the west/south edge only)
+    stops = layers.stops
+    in_tile = stops[(stops['stop_lon'] >= min_lon) & (stops['stop_lon'] < max_lon) &
+                    (stops['stop_lat'] >= min_lat) & (stops['stop_lat'] < max_lat)]
+    features += stop_features(in_tile)
+
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+@metrics.timed('tile', size=len)
+def get_tile(gtfs_feed, z: int, x: int, y: int) -> bytes:
+    """GeoJSON bytes for a tile, read from the tile cache or built and saved there"""
+    tile_path = os.path.join(tile_cache_dir(gtfs_feed), str(z), str(x), f"{y}.geojson")
+    if os.path.exists(tile_path):
+        with open(tile_path, 'rb') as tile_file:
+            return tile_file.read()
+
+    data = json.dumps(build_tile(gtfs_feed, z, x, y), separators=(',', ':')).encode()
+
+    #first tile for a new version of the feed clears out the old version's tiles
+    version_dir = tile_cache_dir(gtfs_feed)
+    if not os.path.isdir(version_dir):
+        feed_dir = os.path.dirname(version_dir)
+        for old_version in (os.listdir(feed_dir) if os.path.isdir(feed_dir) else []):
+            shutil.rmtree(os.path.join(feed_dir, old_version), ignore_errors=True)
+
+    #written to a temporary name first so other workers never read half a tile
+    os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+    temp_path = f"{tile_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as tile_file:
+        tile_file.write(data)
+    os.replace(temp_path, tile_path)
+
+    return data
+
+
+def register_tile_routes(server: Flask) -> None:
+    """adds the tile endpoint to the dash app's flask server"""
+    @server.route("/tiles/<source>/<feed_name>/<int:z>/<int:x>/<int:y>.geojson")
+    def serve_tile(source, feed_name, z, x, y):
+        gtfs_path = os.path.join("data", source, "gtfs_files", feed_name)
+
+        #only feed folders that already exist with every required file can be served
+        if (source not in TILE_SOURCES or feed_name != os.path.basename(feed_name)
+                or feed_name.startswith('.') or not os.path.isdir(gtfs_path) or feed.missing_files(gtfs_path)):
+            abort(404)
+        if not MIN_TILE_ZOOM <= z <= MAX_TILE_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            abort(404)
+
+        with feed.open_feed(gtfs_path) as gtfs_feed:
+            data = get_tile(gtfs_feed, z, x, y)
+
+        return Response(data, mimetype='application/geo+json',
+                        headers={'Cache-Control': 'public, max-age=3600'})
+
+    return None
+
+
+class GeoJsonTileLayer(MacroElement):
+    """leaflet layer that fetches the GeoJSON tiles covering the visible part of the map
+    and draws routes as lines and stops as circle markers"""
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function() {
+            var map = {{ this._parent.get_name() }};
+            var url = {{ this.url|tojson }};
+            var minZoom = {{ this.min_zoom }}, maxZoom = {{ this.max_zoom }};
+            //one layer group per tile zoom, only the current one is shown
+            var groups = {};
+            var requested = {};
+
+            function style(feature) {
+                return {color: '#' + feature.properties.route_color, weight: 2.5, opacity: 1};
+            }
+            function stopMarker(feature, latlng) {
+                return L.circleMarker(latlng, {radius: 2, fill: true, fillColor: 'white', fillOpacity: 1,
+                                               color: 'black', weight: 1});
+            }
+            function bind(feature, layer) {
+                if (feature.properties.kind === 'stop') {
+                    layer.bindTooltip(feature.properties.popup);
+                } else {
+                    layer.bindPopup(feature.properties.popup);
+                }
+            }
+
+            function loadTiles() {
+                var z = Math.min(Math.max(Math.round(map.getZoom()), minZoom), maxZoom);
+                if (!groups[z]) {
+                    groups[z] = L.featureGroup();
+                }
+                Object.keys(groups).forEach(function(key) {
+                    if (Number(key) === z) {
+                        groups[key].addTo(map);
+                    } else {
+                        map.removeLayer(groups[key]);
+                    }
+                });
+
+                var bounds = map.getPixelBounds();
+                var scale = map.getZoomScale(z, map.getZoom());
+                var n = Math.pow(2, z);
+                var minX = Math.floor(bounds.min.x * scale / 256), maxX = Math.floor(bounds.max.x * scale / 256);
+                var minY = Math.max(0, Math.floor(bounds.min.y * scale / 256));
+                var maxY = Math.min(n - 1, Math.floor(bounds.max.y * scale / 256));
+
+                for (var x = minX; x <= maxX; x++) {
+                    for (var y = minY; y <= maxY; y++) {
+                        var tileX = ((x % n) + n) % n;
+                        var key = z + '/' + tileX + '/' + y;
+                        if (requested[key]) {
+                            continue;
+                        }
+                        requested[key] = true;
+                        var tileUrl = url.replace('{z}', z).replace('{x}', tileX).replace('{y}', y);
+                        fetch(tileUrl).then(function(response) {
+                            return response.ok ? response.json() : null;
+                        }).then((function(group) {
+                            return function(data) {
+                                if (data) {
+                                    L.geoJSON(data, {style: style, pointToLayer: stopMarker, onEachFeature: bind}).addTo(group);
+                                }
+                            };
+                        })(groups[z]));
+                    }
+                }
+            }
+
+            map.on('moveend', loadTiles);
+            loadTiles();
+        })();
+        {% endmacro %}
+        """)
+
+    def __init__(
+    self,
+    url: str,
+    min_zoom: int = MIN_TILE_ZOOM,
+    max_zoom: int = MAX_TILE_ZOOM
+    ):
+        super().__init__()
+        self._name = 'GeoJsonTileLayer'
+        self.url = url
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
@@ -0,0 +1,224 @@
+import os
+import threading
+import zipfile
+from flask import Flask, request, jsonify
+from werkzeug.utils import secure_filename
+
+from src import feed
+from src import metrics
+
+#uploaded feeds are posted as the raw zip to /upload?name=<file name> and streamed to
+#   data/user_data/gtfs_files/zipped_files/<name>.zip
+#a block at a time. the zip's directory is checked for the required files without extracting
+#anything, then only the files the app reads are copied out of it into
+#   data/user_data/gtfs_files/<name>/
+#and the feed's database is built (or updated if the feed was uploaded before)
+
+UPLOAD_DIR = "data/user_data/gtfs_files"
+ZIP_DIR = os.path.join(UPLOAD_DIR, "zipped_files")
+
+#bytes read from the request or a zip member at a time
+COPY_BLOCK_SIZE = 1024 * 1024
+
+#largest upload accepted (GTFS_MAX_UPLOAD_MB environment variable)
+DEFAULT_MAX_UPLOAD_MB = 500
+
+#largest total size of the used files once uncompressed, so a small zip can't fill the disk
+#(GTFS_MAX_FEED_MB environment variable)
+DEFAULT_MAX_FEED_MB = 4000
+
+#one upload is unpacked and loaded at a time
+_upload_lock = threading.Lock()
+
+
+def feed_name(filename: str) -> str:
+    """feed folder name for an uploaded zip's file name, raises ValueError if it isn't a usable .zip name"""
+    name = secure_filename(filename or '')
+    if not name.lower().endswith('.zip') or len(name) <= len('.zip'):
+        raise ValueError("Upload a .zip of a GTFS folder")
+    return name[:-len('.zip')]
+
+
+def save_upload(stream, zip_path: str, max_bytes: int) -> int:
+    """copies an upload stream to zip_path a block at a time, returns its size. raises ValueError
+    (and keeps nothing) if it goes past max_bytes"""
+    os.makedirs(os.path.dirname(zip_path), exist_ok=True)
+    temp_path = f"{zip_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    size = 0
+    try:
+        with open(temp_path, 'wb') as zip_file:
+            while True:
+                block = stream.read(COPY_BLOCK_SIZE)
+                if not block:
+                    break
+                size += len(block)
+                if size > max_bytes:
+                    raise ValueError(f"Upload is larger than {max_bytes // (1024 * 1024)} MB")
+                zip_file.write(block)
+        os.replace(temp_path, zip_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return size
+
+
+def feed_members(zip_file: zipfile.ZipFile) -> dict:
+    """zip entries of the files the app reads (feed.FEED_FILES) by file name. files can be at the
+    top of the zip or inside one folder (zips of a folder), top level ones win"""
+    members = {}
+    for info in zip_file.infolist():
+        parts = info.filename.split('/')
+        if info.is_dir() or len(parts) > 2 or parts[0] == '__MACOSX':
+            continue
+        name = parts[-1]
+        if name in feed.FEED_FILES and (name not in members or len(parts) == 1):
+            members[name] = info
+    return members
+
+
+def validate_zip(zip_path: str, max_feed_bytes: int) -> dict:
+    """checks a feed zip from its directory alone (nothing is extracted) and returns its used
+    members, raises ValueError if it isn't a zip, is missing required files or is too large"""
+    try:
+        with zipfile.ZipFile(zip_path) as zip_file:
+            members = feed_members(zip_file)
+    except zipfile.BadZipFile:
+        raise ValueError("Upload is not a zip file")
+
+    missing_files = [name for name in feed.REQUIRED_FILES if name not in members]
+    if missing_files:
+        raise ValueError(f"Missing required GTFS files: {', '.join(missing_files)}")
+    if any(info.flag_bits & 0x1 for info in members.values()):
+        raise ValueError("Password protected zips can't be read")
+    if sum(info.file_size for info in members.values()) > max_feed_bytes:
+        raise ValueError(f"Feed files are larger than {max_feed_bytes // (1024 * 1024)} MB uncompressed")
+
+    return members
+
+
+def extract_feed_files(zip_path: str, gtfs_path: str, members: dict) -> list:
+    """streams the used members out of the zip into gtfs_path (each replaced in one step so an open
+    feed never reads half a file) and removes used files the new zip doesn't have. returns the files written"""
+    os.makedirs(gtfs_path, exist_ok=True)
+    with zipfile.ZipFile(zip_path) as zip_file:
+        for name, info in members.items():
+            file_path = os.path.join(gtfs_path, name)
+            temp_path = f"{file_path}.{os.getpid()}.tmp"
+            with zip_file.open(info) as source, open(temp_path, 'wb') as target:
+                while block := source.read(COPY_BLOCK_SIZE):
+                    target.write(block)
+            os.replace(temp_path, file_path)
+
+    #e.g. a calendar_dates.txt left from an earlier upload of the same feed
+    for name in feed.FEED_FILES:
+        if name not in members and os.path.exists(os.path.join(gtfs_path, name)):
+            os.remove(os.path.join(gtfs_path, name))
+
+    return sorted(members)
+
+
+def receive_upload(stream, filename: str, max_bytes: int, max_feed_bytes: int) -> str:
+    """saves, checks and unpacks an uploaded feed zip and builds or updates its database,
+    returns the feed folder. raises ValueError for uploads that aren't a usable feed"""
+    name = feed_name(filename)
+    zip_path = os.path.join(ZIP_DIR, f"{name}.zip")
+    gtfs_path = os.path.join(UPLOAD_DIR, name)
+
+    with _upload_lock:
+        with metrics.span('upload', name) as span:
+            span.bytes = save_upload(stream, zip_path, max_bytes)
+        try:
+            members = validate_zip(zip_path, max_feed_bytes)
+        except ValueError:
+            os.remove(zip_path)
+            raise
+        with metrics.span('unzip', name) as span:
+            extract_feed_files(zip_path, gtfs_path, members)
+            span.bytes = sum(info.file_size for info in members.values())
+
+        #an older open copy of this feed is dropped, reopening it applies the changed files to its database
+        feed.feed_registry.discard(gtfs_path)
+        with feed.open_feed(gtfs_path):
+            pass
+
+    return gtfs_path
+
+
+def register_upload_routes(server: Flask) -> None:
+    """adds the upload endpoint to the dash app's flask server"""
+    max_bytes = int(os.environ.get("GTFS_MAX_UPLOAD_MB", DEFAULT_MAX_UPLOAD_MB)) * 1024 * 1024
+    max_feed_bytes = int(os.environ.get("GTFS_MAX_FEED_MB", DEFAULT_MAX_FEED_MB)) * 1024 * 1024
+
+    @server.route("/upload", methods=['POST'])
+    def upload_feed():
+        if request.content_length is not None and request.content_length > max_bytes:
+            return jsonify(error=f"Upload is larger than {max_bytes // (1024 * 1024)} MB"), 413
+        try:
+            gtfs_path = receive_upload(request.stream, request.args.get('name'), max_bytes, max_feed_bytes)
+        except ValueError as error:
+            return jsonify(error=str(error)), 400
+        except Exception as error:
+            #files that passed the checks but couldn't be loaded (e.g. malformed csv)
+            return jsonify(error=f"Feed could not be loaded: {error}"), 422
+        return jsonify(feed_path=gtfs_path)
+
+    return None
+
+
+#attaches the upload box's click and drag and drop handlers once the page loads. the file
+#is posted as is (the browser streams it from disk) and the feed folder it was unpacked to
+#is put in the upload-result store
+UPLOAD_SCRIPT = """
+function(zoneId) {
+    var zone = document.getElementById(zoneId);
+    if (!zone || zone.dataset.ready) {
+        return window.dash_clientside.no_update;
+    }
+    zone.dataset.ready = 'true';
+    var setProps = window.dash_clientside.set_props;
+
+    var input = document.createElement('input');
+    input.type = 'file';
+    input.accept = '.zip';
+    input.style.display = 'none';
+    document.body.appendChild(input);
+
+    function send(file) {
+        if (!file) {
+            return;
+        }
+        setProps('upload-status', {children: 'Uploading and loading ' + file.name + '...'});
+        fetch('/upload?name=' + encodeURIComponent(file.name),
+              {method: 'POST', body: file, headers: {'Content-Type': 'application/zip'}})
+            .then(function(response) {
+                return response.json().catch(function() {
+                    return {error: 'server error ' + response.status};
+                });
+            })
+            .then(function(data) {
+                if (data.error) {
+                    setProps('upload-status', {children: data.error});
+                } else {
+                    setProps('upload-status', {children: ''});
+                    //the time makes uploading the same feed again count as a change
+                    setProps('upload-result', {data: {feed_path: data.feed_path, uploaded: Date.now()}});
+                }
+            })
+            .catch(function(error) {
+                setProps('upload-status', {children: 'Upload failed: ' + error});
+            });
+    }
+
+    zone.addEventListener('click', function() { input.click(); });
+    input.addEventListener('change', function() {
+        send(input.files[0]);
+        input.value = '';
+    });
+    zone.addEventListener('dragover', function(event) { event.preventDefault(); });
+    zone.addEventListener('drop', function(event) {
+        event.preventDefault();
+        send(event.dataTransfer.files[0]);
+    });
+    return window.dash_clientside.no_update;
+}
+"""